@@ -132,6 +132,29 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Read-only memory-mapped city graph snapshots shared by all worker processes
+GRAPH_SNAPSHOT_DIR = os.getenv('GRAPH_SNAPSHOT_DIR', str(BASE_DIR / "snapshots"))
+
+# Rendered vector tiles, one directory per city and graph version
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR', str(BASE_DIR / "tile_cache"))
+
+# Sampled centrality metrics (BET, BMX, CLO): number of source nodes and the
+# wall-clock limit in seconds after which no more sources are started
+CENTRALITY_SAMPLES = int(os.getenv('CENTRALITY_SAMPLES', 200))
+CENTRALITY_TIME_BUDGET = float(os.getenv('CENTRALITY_TIME_BUDGET', 600))
+
+# Network circuity metric (NCI): sampled origins and destinations per origin
+NETWORK_CIRCUITY_ORIGINS = int(os.getenv('NETWORK_CIRCUITY_ORIGINS', 500))
+NETWORK_CIRCUITY_DESTINATIONS = int(os.getenv('NETWORK_CIRCUITY_DESTINATIONS', 20))
+
+# Cursor pagination of the node, edge and metric value API lists; clients
+# may ask for up to API_MAX_PAGE_SIZE rows with ?page_size=
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 500))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 5000))
+
+# Worker processes of a metrics recompute started through the API
+RECOMPUTE_API_MAX_WORKERS = int(os.getenv('RECOMPUTE_API_MAX_WORKERS', 4))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -32,7 +32,12 @@ urlpatterns = [
     path('db_map/', views.db_map_view, name='db_map'),
     # path('api/db_map/', views.get_data, name='network_data'),
     path('city-metrics/', views.city_metrics_page, name='city_metrics_page'),
+    path('api/isochrones/', views.IsochroneView.as_view(), name='isochrones'),
+    path('api/route/', views.RouteView.as_view(), name='route'),
+    path('api/snap/', views.SnapView.as_view(), name='snap'),
+    path('api/orientation/', views.OrientationView.as_view(), name='orientation'),
     path('api/', include(router.urls)),
     path('geojson/edges/', views.EdgeGeoJSONView.as_view(), name='geojson-edges'),
     path('geojson/nodes/', views.NodeGeoJSONView.as_view(), name='geojson-nodes'),
+    path('tiles/<str:city>/<int:z>/<int:x>/<int:y>.mvt', views.tile_view, name='tiles'),
 ]
@@ -0,0 +1,220 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from math import sqrt
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .metrics import (
+    load_city_arrays,
+    load_incident_edge_arrays,
+    get_built_up_area_km2,
+    haversine,
+    bearings,
+    node_degrees,
+    entropy_from_counts,
+    metrics_dict,
+    _scores,
+)
+from .models import City, CityAggregate, Node, Edge
+
+BEARING_BINS = 36
+SUM_FIELDS = (
+    'edge_count', 'total_length', 'circuity_sum', 'circuity_count',
+    'steepness_sum', 'steepness_count', 'walking_score_sum', 'biking_score_sum',
+)
+
+NODE_DEGREE_SQL = """
+    SELECT n.osm_id,
+           (SELECT count(*) FROM {edge_table} e WHERE e.city_id = %(city_id)s AND e.start_node_id = n.osm_id)
+         + (SELECT count(*) FROM {edge_table} e WHERE e.city_id = %(city_id)s AND e.end_node_id = n.osm_id)
+    FROM {node_table} n
+    WHERE n.city_id = %(city_id)s AND n.osm_id = ANY(%(node_ids)s)
+"""
+
+
+def graph_sums(arrays, degrees):
+    """
+    The contribution of the edges in ``arrays`` and of nodes with the given
+    ``degrees`` to a city's aggregates. Uses the same formulas as
+    ``compute_urban_metrics``, so sums over the whole city reproduce it.
+    """
+    length = arrays['length']
+    straight = haversine(arrays['start_xy'], arrays['end_xy'])
+    positive = straight > 0
+
+    elevation_difference = np.abs(arrays['start_elevation'] - arrays['end_elevation'])
+    elevation_difference[np.isnan(elevation_difference)] = 0
+    has_length = length > 0
+
+    angle_index = np.minimum((bearings(arrays['geom_start'], arrays['geom_end']) // 10).astype(np.int64), 35)
+    mode = arrays['mode']
+
+    return {
+        'edge_count': len(length),
+        'total_length': float(length.sum()),
+        'circuity_sum': float((length[positive] / straight[positive]).sum()),
+        'circuity_count': int(positive.sum()),
+        'steepness_sum': float((elevation_difference[has_length] / length[has_length]).sum()),
+        'steepness_count': int(has_length.sum()),
+        'walking_score_sum': float(_scores(arrays['speed_limit'], mode == 'pedestrian', 0.5).sum()),
+        'biking_score_sum': float(_scores(arrays['speed_limit'], mode == 'cycling', 0.6).sum()),
+        'bearing_bins': np.bincount(angle_index, minlength=BEARING_BINS).tolist(),
+        # JSON object keys are strings
+        'degree_counts': Counter(str(degree) for degree in np.asarray(degrees).tolist()),
+        'mode_counts': Counter(m for m in mode.tolist() if m is not None),
+    }
+
+
+def combine(aggregate, sums, sign: int = 1):
+    """Add (``sign=1``) or remove (``sign=-1``) ``sums`` to/from an aggregate in place."""
+    for field in SUM_FIELDS:
+        setattr(aggregate, field, getattr(aggregate, field) + sign * sums[field])
+
+    bins = aggregate.bearing_bins or [0] * BEARING_BINS
+    aggregate.bearing_bins = [count + sign * delta for count, delta in zip(bins, sums['bearing_bins'])]
+
+    for field in ('degree_counts', 'mode_counts'):
+        counts = Counter(getattr(aggregate, field))
+        for key, delta in sums[field].items():
+            counts[key] += sign * delta
+        setattr(aggregate, field, {key: count for key, count in counts.items() if count})
+
+
+def city_graph_sums(city):
+    arrays = load_city_arrays(city)
+    return graph_sums(arrays, node_degrees(arrays['node_ids'], arrays['start_node'], arrays['end_node']))
+
+
+def rebuild_aggregate(city):
+    """Recompute a city's aggregates with a full scan of its graph."""
+    # Read the version first: a write racing the scan bumps it and the next
+    # read rebuilds again
+    version = City.objects.filter(pk=city.pk).values_list('graph_version', flat=True).get()
+    aggregate = CityAggregate(city=city, graph_version=version)
+    combine(aggregate, city_graph_sums(city))
+    aggregate.save()
+    return aggregate
+
+
+def get_aggregate(city):
+    """A city's aggregates for its current graph version, rebuilt if they are stale."""
+    aggregate = CityAggregate.objects.filter(city=city).first()
+    version = City.objects.filter(pk=city.pk).values_list('graph_version', flat=True).get()
+    if aggregate is None or aggregate.graph_version != version:
+        aggregate = rebuild_aggregate(city)
+    return aggregate
+
+
+def metrics_from_aggregate(aggregate, built_up_area_km2):
+    """The urban metrics of a city from its aggregates, without touching its graph."""
+    edge_count = aggregate.edge_count
+    degree_counts = {int(degree): count for degree, count in aggregate.degree_counts.items()}
+    node_count = sum(degree_counts.values())
+
+    bins = aggregate.bearing_bins or [0] * BEARING_BINS
+    entropy = entropy_from_counts(bins) if edge_count else 0
+
+    connectivity = sum(degree * count for degree, count in degree_counts.items()) / node_count if node_count else 0
+    variance = (sum(count * (degree - connectivity) ** 2 for degree, count in degree_counts.items()) / node_count
+                if node_count else 0)
+    intersection_count = sum(count for degree, count in degree_counts.items() if degree >= 3)
+
+    modes = aggregate.mode_counts
+    driving_edges = modes.get('driving', 0)
+
+    return metrics_dict(
+        aggregate.circuity_sum / aggregate.circuity_count if aggregate.circuity_count else 0,
+        entropy,
+        edge_count / built_up_area_km2 if built_up_area_km2 > 0 else 0,
+        aggregate.steepness_sum / aggregate.steepness_count if aggregate.steepness_count else 0,
+        aggregate.total_length / edge_count if edge_count else 0,
+        intersection_count / built_up_area_km2 if built_up_area_km2 > 0 else 0,
+        modes.get('pedestrian', 0) / driving_edges if driving_edges > 0 else 0,
+        modes.get('cycling', 0) / driving_edges if driving_edges > 0 else 0,
+        aggregate.walking_score_sum / edge_count if edge_count else 0,
+        aggregate.biking_score_sum / edge_count if edge_count else 0,
+        connectivity,
+        sqrt(max(variance, 0)),
+    )
+
+
+def calculate_urban_metrics_incremental(city_name: str):
+    city = City.objects.get(name=city_name)
+    return metrics_from_aggregate(get_aggregate(city), get_built_up_area_km2(city))
+
+
+def _neighbor_ids(city_id, node_ids):
+    rows = Edge.objects.filter(
+        Q(start_node_id__in=node_ids) | Q(end_node_id__in=node_ids), city_id=city_id,
+    ).values_list('start_node_id', 'end_node_id')
+    return {osm_id for row in rows for osm_id in row}
+
+
+def _local_sums(city_id, node_ids, degree_node_ids):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            NODE_DEGREE_SQL.format(edge_table=Edge._meta.db_table, node_table=Node._meta.db_table),
+            {'city_id': city_id, 'node_ids': list(degree_node_ids)},
+        )
+        degrees = [degree for _, degree in cursor.fetchall()]
+    return graph_sums(load_incident_edge_arrays(city_id, node_ids), degrees)
+
+
+@contextmanager
+def track_graph_change(changes):
+    """
+    Wrap a small write to the graph of one or more cities, then bump their
+    graph version and update their aggregates by the difference.
+
+    ``changes`` maps city ids to the osm_ids of the nodes the write creates,
+    moves or deletes and of the endpoints of the edges it creates, changes or
+    deletes. Only the edges touching those nodes and the degrees of those
+    nodes and their neighbours are read, before and after the write, so the
+    cost is independent of the city size. Aggregates that are already stale
+    are left for the next full rebuild.
+    """
+    city_ids = sorted(changes)
+    with transaction.atomic():
+        # Locking the cities makes concurrent bumps wait for this transaction
+        versions = dict(City.objects.select_for_update().filter(pk__in=city_ids)
+                        .order_by('pk').values_list('pk', 'graph_version'))
+        aggregates = [
+            aggregate for aggregate in CityAggregate.objects.select_for_update().filter(city_id__in=city_ids)
+            if aggregate.graph_version == versions.get(aggregate.city_id)
+        ]
+
+        scopes = {}
+        for aggregate in aggregates:
+            node_ids = set(changes[aggregate.city_id])
+            # A deleted node takes its edges along, changing its neighbours' degrees
+            scopes[aggregate.city_id] = (node_ids, node_ids | _neighbor_ids(aggregate.city_id, node_ids))
+        before = {city_id: _local_sums(city_id, *scope) for city_id, scope in scopes.items()}
+
+        yield
+
+        City.bump_graph_version(*city_ids)
+        for aggregate in aggregates:
+            combine(aggregate, before[aggregate.city_id], -1)
+            combine(aggregate, _local_sums(aggregate.city_id, *scopes[aggregate.city_id]))
+            aggregate.graph_version = versions[aggregate.city_id] + 1
+            aggregate.save()
+
+
+def graph_changes(records, node_fields):
+    """
+    Build the ``changes`` mapping of ``track_graph_change`` from model
+    instances or serializer ``validated_data`` dicts, reading the node ids
+    from ``node_fields`` (e.g. ``('start_node', 'end_node')``).
+    """
+    changes = defaultdict(set)
+    for record in records:
+        if isinstance(record, dict):
+            city_id = record['city'].pk
+            node_ids = [getattr(record[name], 'pk', record[name]) for name in node_fields]
+        else:
+            city_id = record.city_id
+            node_ids = [getattr(record, record._meta.get_field(name).attname) for name in node_fields]
+        changes[city_id].update(node_ids)
+    return changes
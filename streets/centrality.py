@@ -0,0 +1,158 @@
+import math
+import time
+from heapq import heappush, heappop
+from itertools import count
+
+import numpy as np
+
+from .graph import get_city_graph
+from .models import City
+from .parallel import run_city_jobs, default_workers
+
+
+def sample_size(node_count: int, epsilon: float, delta: float = 0.1):
+    """
+    Number of sampled sources for which every normalized betweenness estimate
+    is within ``epsilon`` of the exact value with probability ``1 - delta``
+    (Hoeffding's bound over all nodes, as in Brandes & Pich).
+    """
+    return math.ceil(math.log(2 * max(node_count, 1) / delta) / (2 * epsilon ** 2))
+
+
+def _single_source(offsets, neighbors, lengths, source):
+    """
+    Weighted Brandes pass from ``source``: returns the settled nodes in order
+    of distance, their distances, shortest-path counts and predecessors.
+    """
+    settled = []
+    distance = {}
+    sigma = {source: 1}
+    predecessors = {source: []}
+    seen = {source: 0.0}
+    tie = count()
+    queue = [(0.0, next(tie), source, source)]
+
+    while queue:
+        dist, _, pred, v = heappop(queue)
+        if v in distance:
+            continue
+        if v != source:
+            sigma[v] += sigma[pred]
+        settled.append(v)
+        distance[v] = dist
+        for i in range(offsets[v], offsets[v + 1]):
+            w = neighbors[i]
+            w_dist = dist + lengths[i]
+            if w not in distance and (w not in seen or w_dist < seen[w]):
+                seen[w] = w_dist
+                heappush(queue, (w_dist, next(tie), v, w))
+                sigma[w] = 0
+                predecessors[w] = [v]
+            elif w_dist == seen.get(w) and w not in distance:
+                sigma[w] += sigma[v]
+                predecessors[w].append(v)
+
+    return settled, distance, sigma, predecessors
+
+
+def _centrality_chunk(city_id, sources, deadline):
+    """
+    Accumulate betweenness dependencies and closeness for a chunk of sampled
+    sources, stopping early once ``deadline`` (a ``time.time()`` value) passes.
+    """
+    start = time.perf_counter()
+    graph = get_city_graph(City.objects.get(pk=city_id))
+    offsets, neighbors, lengths = graph.offsets.tolist(), graph.neighbors.tolist(), graph.lengths.tolist()
+    node_count = graph.node_count
+
+    betweenness = np.zeros(node_count)
+    dependency_totals = []
+    closeness = []
+    for source in sources:
+        if deadline is not None and time.time() > deadline:
+            break
+        settled, distance, sigma, predecessors = _single_source(offsets, neighbors, lengths, int(source))
+
+        delta = dict.fromkeys(settled, 0.0)
+        while settled:
+            w = settled.pop()
+            coefficient = (1 + delta[w]) / sigma[w]
+            for v in predecessors[w]:
+                delta[v] += sigma[v] * coefficient
+            if w != source:
+                betweenness[w] += delta[w]
+        dependency_totals.append(sum(delta.values()) - delta[int(source)])
+
+        # Wasserman-Faust closeness over outward distances from the source. networkx uses
+        # inward distances for directed graphs, so one-way streets give different values;
+        # it matches closeness_centrality(G.reverse(), wf_improved=True)
+        reachable, total = len(distance) - 1, sum(distance.values())
+        closeness.append(reachable / total * reachable / (node_count - 1) if total > 0 and node_count > 1 else 0.0)
+
+    return {
+        'ok': True,
+        'betweenness': betweenness,
+        'dependency_totals': dependency_totals,
+        'closeness': closeness,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def sampled_centrality(city, samples: int = 200, epsilon: float = None, delta: float = 0.1,
+                       workers: int = None, time_budget: float = None, seed: int = 0):
+    """
+    Approximate betweenness and closeness centrality of a city's street graph
+    from uniformly sampled source nodes, spread over a process pool. Workers
+    share the city's memory-mapped graph snapshot.
+
+    The sample size is ``samples`` or, given ``epsilon``, ``sample_size(n,
+    epsilon, delta)``. With ``time_budget`` (seconds) workers stop taking new
+    sources once it is spent, and the estimates use the sources completed.
+    Returns per-node normalized betweenness and city-level means with their
+    standard errors.
+    """
+    start = time.perf_counter()
+    graph = get_city_graph(city)
+    node_count = graph.node_count
+    if epsilon is not None:
+        samples = sample_size(node_count, epsilon, delta)
+    samples = min(samples, node_count)
+
+    rng = np.random.default_rng(seed)
+    sources = rng.choice(node_count, size=samples, replace=False)
+    workers = workers or default_workers()
+    deadline = time.time() + time_budget if time_budget is not None else None
+    chunks = [chunk for chunk in np.array_split(sources, workers * 4) if len(chunk)]
+
+    betweenness = np.zeros(node_count)
+    dependency_totals, closeness = [], []
+    jobs = [(graph.city_id, chunk, deadline) for chunk in chunks]
+    for _, result in run_city_jobs(_centrality_chunk, jobs, workers):
+        if not result['ok']:
+            raise RuntimeError(f"Centrality worker failed:\n{result['error']}")
+        betweenness += result['betweenness']
+        dependency_totals += result['dependency_totals']
+        closeness += result['closeness']
+
+    processed = len(dependency_totals)
+    # Directed normalization, as networkx betweenness_centrality(normalized=True)
+    scale = 1 / ((node_count - 1) * (node_count - 2)) if node_count > 2 else 0
+    if processed:
+        betweenness *= node_count / processed * scale
+    totals = np.asarray(dependency_totals) * scale
+    closeness = np.asarray(closeness)
+
+    def _stderr(values):
+        return float(values.std(ddof=1) / math.sqrt(len(values))) if len(values) > 1 else 0.0
+
+    return {
+        'betweenness': betweenness,
+        'betweenness_mean': float(totals.mean()) if processed else 0.0,
+        'betweenness_mean_stderr': _stderr(totals),
+        'betweenness_max': float(betweenness.max()) if node_count else 0.0,
+        'closeness_mean': float(closeness.mean()) if processed else 0.0,
+        'closeness_mean_stderr': _stderr(closeness),
+        'sources': processed,
+        'requested_sources': samples,
+        'seconds': time.perf_counter() - start,
+    }
@@ -0,0 +1,128 @@
+import time
+from heapq import heappush, heappop
+from math import inf
+
+import numpy as np
+
+from .graph import get_city_graph
+from .metrics import haversine
+from .models import City
+from .parallel import run_city_jobs, default_workers
+
+
+def sample_od_pairs(graph, origins: int, destinations_per_origin: int, min_distance: float,
+                    max_distance: float, seed: int = 0):
+    """
+    Sample origin nodes uniformly and, for each, up to ``destinations_per_origin``
+    destination nodes whose great-circle distance from it lies in
+    ``[min_distance, max_distance]`` meters. Returns a list of
+    ``(origin, destinations, straight_distances)`` in node indices.
+    """
+    rng = np.random.default_rng(seed)
+    node_count = graph.node_count
+    if node_count < 2:
+        return []
+
+    origin_index = rng.choice(node_count, size=min(origins, node_count), replace=False)
+    # Oversample candidates; those outside the distance band are dropped
+    candidates = rng.integers(0, node_count, size=(len(origin_index), destinations_per_origin * 4))
+    straight = haversine(
+        np.repeat(graph.coords[origin_index], candidates.shape[1], axis=0),
+        graph.coords[candidates.ravel()],
+    ).reshape(candidates.shape)
+    keep = (straight >= min_distance) & (straight <= max_distance) & (candidates != origin_index[:, None])
+
+    batches = []
+    for origin, row, distances, kept in zip(origin_index, candidates, straight, keep):
+        row, distances = row[kept][:destinations_per_origin], distances[kept][:destinations_per_origin]
+        if len(row):
+            batches.append((int(origin), row, distances))
+    return batches
+
+
+def _distances_to(offsets, neighbors, lengths, source, targets, max_distance):
+    """
+    Dijkstra from ``source`` that stops once every target is settled or the
+    search radius exceeds ``max_distance``. Returns ``{target: distance}`` for
+    the targets reached.
+    """
+    remaining = set(targets)
+    distance = {}
+    seen = {source: 0.0}
+    queue = [(0.0, source)]
+
+    while queue and remaining:
+        dist, v = heappop(queue)
+        if v in distance:
+            continue
+        if dist > max_distance:
+            break
+        distance[v] = dist
+        remaining.discard(v)
+        for i in range(offsets[v], offsets[v + 1]):
+            w = neighbors[i]
+            w_dist = dist + lengths[i]
+            if w not in distance and w_dist < seen.get(w, inf):
+                seen[w] = w_dist
+                heappush(queue, (w_dist, w))
+
+    return {target: distance[target] for target in targets if target in distance}
+
+
+def _circuity_chunk(city_id, batches, max_detour):
+    start = time.perf_counter()
+    graph = get_city_graph(City.objects.get(pk=city_id))
+    offsets, neighbors, lengths = graph.offsets.tolist(), graph.neighbors.tolist(), graph.lengths.tolist()
+
+    network, straight, unreachable = [], [], 0
+    for origin, destinations, distances in batches:
+        # One search serves every destination of the origin
+        reached = _distances_to(offsets, neighbors, lengths, origin, destinations.tolist(),
+                                float(distances.max()) * max_detour)
+        for destination, distance in zip(destinations.tolist(), distances.tolist()):
+            if destination in reached:
+                network.append(reached[destination])
+                straight.append(distance)
+            else:
+                unreachable += 1
+
+    return {'ok': True, 'network': network, 'straight': straight, 'unreachable': unreachable,
+            'seconds': time.perf_counter() - start}
+
+
+def network_circuity(city, origins: int = 500, destinations_per_origin: int = 20, min_distance: float = 500,
+                     max_distance: float = 5000, max_detour: float = 4.0, workers: int = None, seed: int = 0):
+    """
+    Network circuity of a city: the total shortest-path length over the total
+    great-circle distance of sampled origin-destination pairs.
+
+    Pairs are drawn in a ``[min_distance, max_distance]`` meter band. Each
+    origin is searched once for all its destinations, and origins are spread
+    over a process pool sharing the city's graph snapshot. Searches give up
+    beyond ``max_detour`` times the farthest destination, so pairs that are
+    not connected cost a bounded amount and are reported as unreachable.
+    """
+    start = time.perf_counter()
+    graph = get_city_graph(city)
+    batches = sample_od_pairs(graph, origins, destinations_per_origin, min_distance, max_distance, seed)
+
+    workers = workers or default_workers()
+    chunks = [batches[i::workers * 4] for i in range(workers * 4)]
+    jobs = [(graph.city_id, chunk, max_detour) for chunk in chunks if chunk]
+
+    network, straight, unreachable = [], [], 0
+    for _, result in run_city_jobs(_circuity_chunk, jobs, workers):
+        if not result['ok']:
+            raise RuntimeError(f"Circuity worker failed:\n{result['error']}")
+        network += result['network']
+        straight += result['straight']
+        unreachable += result['unreachable']
+
+    network, straight = np.asarray(network), np.asarray(straight)
+    return {
+        'circuity': float(network.sum() / straight.sum()) if len(straight) else 0.0,
+        'mean_ratio': float((network / straight).mean()) if len(straight) else 0.0,
+        'pairs': len(straight),
+        'unreachable': unreachable,
+        'seconds': time.perf_counter() - start,
+    }
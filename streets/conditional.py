@@ -0,0 +1,39 @@
+import hashlib
+import json
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def graph_validators(cities, kind: str):
+    """
+    ``(etag, last_modified)`` of responses built from the graphs of a City
+    queryset. Only the City rows are read: their graph version changes with
+    every Node/Edge write, so it stands in for the rows themselves.
+    """
+    versions = list(cities.order_by('pk').values_list('pk', 'graph_version', 'graph_updated_at'))
+    digest = hashlib.md5(json.dumps([[pk, version] for pk, version, _ in versions]).encode()).hexdigest()
+    updated = [updated_at for _, _, updated_at in versions if updated_at is not None]
+    # Weak: the same graph may be serialized with its rows in another order
+    return f'W/"{kind}-{digest}"', int(max(updated).timestamp()) if updated else None
+
+
+def graph_conditional_response(request, cities, kind: str, respond):
+    """
+    Answer a conditional GET with 304 Not Modified when its If-None-Match
+    shows the cities' graphs have not changed, before ``respond()`` touches
+    any Node/Edge row; otherwise return ``respond()`` with ``ETag`` and
+    ``Last-Modified`` set.
+    """
+    etag, last_modified = graph_validators(cities, kind)
+    # Only the ETag is compared: Last-Modified has one second resolution, so a client
+    # sending just If-Modified-Since could miss a second write within the same second
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = respond()
+        if response.status_code != 200:
+            return response
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
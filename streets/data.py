@@ -94,7 +94,11 @@ metric_data = {
     "RDE": "Road Density",
     "AST": "Average Steepness",
     "ASL": "Average Street Length",
-    "IND": "Intersection Density"
+    "IND": "Intersection Density",
+    "BET": "Average Betweenness Centrality",
+    "BMX": "Maximum Betweenness Centrality",
+    "CLO": "Average Closeness Centrality",
+    "NCI": "Network Circuity",
 }
 
 
@@ -0,0 +1,99 @@
+from django.db import connection, transaction
+
+from .models import Node, Edge, SimplifiedEdge
+from .simplify import simplification_zoom, is_materialized, zoom_tolerance, zoom_min_length
+
+# Rows fetched from the server-side cursor per round trip
+GEOJSON_CHUNK_SIZE = 2000
+
+# Each row is one Feature already serialized by PostGIS, so Python only joins strings
+FEATURE_SQL = """
+    SELECT '{{"type": "Feature", "id": ' || {pk} || ', "geometry": ' || ST_AsGeoJSON({geometry})
+           || ', "properties": {{}}}}'
+    FROM {table} t
+    WHERE {where}
+"""
+ENVELOPE = "ST_MakeEnvelope(%s, %s, %s, %s, 4326)"
+
+
+def parse_bbox(bbox: str):
+    values = tuple(map(float, bbox.split(',')))
+    if len(values) != 4:
+        raise ValueError("'bbox' must be lng1,lat1,lng2,lat2.")
+    return values
+
+
+def feature_query(table, pk, city=None, bbox=None, geography=True, geometry='t.geom', geometry_params=(),
+                  where=(), where_params=()):
+    """SQL and params selecting one serialized Feature per row, optionally within a city and a bbox."""
+    where, params = list(where), list(geometry_params) + list(where_params)
+    if city is not None:
+        where.append('t.city_id = %s')
+        params.append(city.pk)
+    if bbox is not None:
+        if geography:
+            # The geography && uses the spatial index, ST_Within keeps the "fully inside" semantics
+            where += [f't.geom && {ENVELOPE}::geography', f'ST_Within(t.geom::geometry, {ENVELOPE})']
+            params += list(bbox) * 2
+        else:
+            where.append(f'ST_Within(t.geom, {ENVELOPE})')
+            params += list(bbox)
+    sql = FEATURE_SQL.format(pk=pk, geometry=geometry, table=table, where=' AND '.join(where) or 'TRUE')
+    return sql, params
+
+
+def stream_feature_collection(sql, params, chunk_size: int = GEOJSON_CHUNK_SIZE):
+    """
+    Yield a GeoJSON FeatureCollection piece by piece from a query returning
+    one serialized Feature per row. Rows are read through a server-side
+    cursor, so memory stays flat however large the city is.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    # Inside a transaction the named cursor streams; in autocommit Django declares it
+    # WITH HOLD, and PostgreSQL materializes the whole result before the first fetch
+    with transaction.atomic(), connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        separator = ''
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield separator + ','.join(row[0] for row in rows)
+            separator = ','
+    yield ']}'
+
+
+def stream_nodes(city=None, bbox=None):
+    return stream_feature_collection(*feature_query(Node._meta.db_table, 't.osm_id', city, bbox))
+
+
+def edge_query(city=None, bbox=None, zoom: int = None, tolerance: float = None):
+    """
+    The edge feature query at full resolution, simplified with ``tolerance``
+    degrees, or drawn for a map ``zoom``. A zoom is served from the
+    materialized ``SimplifiedEdge`` level when it matches the city's graph
+    version, and simplified on the fly with the same rules otherwise.
+    """
+    table = Edge._meta.db_table
+    if tolerance is not None:
+        return feature_query(table, 't.id', city, bbox,
+                             geometry='ST_SimplifyPreserveTopology(t.geom::geometry, %s)',
+                             geometry_params=[tolerance])
+
+    level = simplification_zoom(zoom) if zoom is not None else None
+    if level is None:
+        return feature_query(table, 't.id', city, bbox)
+
+    if city is not None and is_materialized(city, level):
+        return feature_query(SimplifiedEdge._meta.db_table, 't.edge_id', city, bbox, geography=False,
+                             where=['t.zoom = %s', 't.graph_version = %s'],
+                             where_params=[level, city.graph_version])
+
+    return feature_query(table, 't.id', city, bbox,
+                         geometry='ST_SimplifyPreserveTopology(t.geom::geometry, %s)',
+                         geometry_params=[zoom_tolerance(level)],
+                         where=['ST_Length(t.geom) >= %s'], where_params=[zoom_min_length(level)])
+
+
+def stream_edges(city=None, bbox=None, zoom: int = None, tolerance: float = None):
+    return stream_feature_collection(*edge_query(city, bbox, zoom, tolerance))
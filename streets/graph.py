@@ -0,0 +1,315 @@
+import json
+import os
+import shutil
+import tempfile
+from heapq import heappush, heappop
+from math import inf
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from .metrics import node_degrees
+from .models import City, Node, Edge
+from .snapping import SnapIndex
+
+NODE_ARRAYS_SQL = """
+    SELECT osm_id, ST_X(geom::geometry), ST_Y(geom::geometry)
+    FROM {node_table}
+    WHERE city_id = %s
+    ORDER BY osm_id
+"""
+
+EDGE_ARRAYS_SQL = """
+    SELECT id, start_node_id, end_node_id, ST_Length(geom)
+    FROM {edge_table}
+    WHERE city_id = %s
+"""
+
+
+class CityGraph:
+    """
+    Directed street graph of one city in compressed sparse row (CSR) form.
+
+    Node ``i`` is ``node_ids[i]`` (sorted osm_ids) at ``coords[i]`` (lon, lat).
+    Its outgoing edges are ``offsets[i]:offsets[i + 1]``; for each of them
+    ``neighbors`` holds the target node index, ``lengths`` the length in
+    meters and ``edge_ids`` the ``Edge`` primary key.
+    """
+
+    def __init__(self, city_id, node_ids, coords, offsets, neighbors, lengths, edge_ids):
+        self.city_id = city_id
+        self.node_ids = node_ids
+        self.coords = coords
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.lengths = lengths
+        self.edge_ids = edge_ids
+        self._adjacency = None
+        self._snap_index = None
+
+    @classmethod
+    def from_edges(cls, city_id, node_ids, coords, sources, targets, lengths, edge_ids):
+        """
+        Build the CSR arrays from edge lists given as node indices. ``node_ids``
+        must be sorted and ``coords`` aligned with it.
+        """
+        node_count = len(node_ids)
+        order = np.argsort(sources, kind='stable')
+        offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count), out=offsets[1:])
+
+        return cls(
+            city_id,
+            node_ids,
+            coords,
+            offsets,
+            targets[order].astype(np.int32),
+            lengths[order].astype(np.float64),
+            edge_ids[order].astype(np.int64),
+        )
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @property
+    def edge_count(self):
+        return len(self.neighbors)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.node_ids, self.coords, self.offsets,
+                                      self.neighbors, self.lengths, self.edge_ids))
+
+    @property
+    def sources(self):
+        """Source node index of every edge, aligned with ``neighbors``."""
+        return np.repeat(np.arange(self.node_count, dtype=np.int32), np.diff(self.offsets))
+
+    def index_of(self, osm_ids):
+        """Node indices for an array of osm_ids; -1 where the id is not in the graph."""
+        osm_ids = np.asarray(osm_ids, dtype=np.int64)
+        if not self.node_count:
+            return np.full(osm_ids.shape, -1, dtype=np.int64)
+        index = np.searchsorted(self.node_ids, osm_ids)
+        index[index == self.node_count] = 0
+        return np.where(self.node_ids[index] == osm_ids, index, -1)
+
+    def out_edges(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.neighbors[start:end], self.lengths[start:end]
+
+    def adjacency_lists(self):
+        """
+        ``offsets``, ``neighbors`` and ``lengths`` as Python lists, built once
+        per graph: pure-Python searches index lists much faster than arrays.
+        """
+        if self._adjacency is None:
+            self._adjacency = (self.offsets.tolist(), self.neighbors.tolist(), self.lengths.tolist())
+        return self._adjacency
+
+    def distances_from(self, source: int, max_distance: float = inf):
+        """
+        Dijkstra from node index ``source`` over edge lengths, settling only
+        nodes within ``max_distance`` meters. Returns the node indices reached
+        and their distances, in order of distance.
+        """
+        offsets, neighbors, lengths = self.adjacency_lists()
+        distance = {}
+        seen = {source: 0.0}
+        queue = [(0.0, source)]
+
+        while queue:
+            dist, v = heappop(queue)
+            if v in distance:
+                continue
+            distance[v] = dist
+            for i in range(offsets[v], offsets[v + 1]):
+                w = neighbors[i]
+                w_dist = dist + lengths[i]
+                if w_dist <= max_distance and w not in distance and w_dist < seen.get(w, inf):
+                    seen[w] = w_dist
+                    heappush(queue, (w_dist, w))
+
+        return (np.fromiter(distance.keys(), dtype=np.int64, count=len(distance)),
+                np.fromiter(distance.values(), dtype=np.float64, count=len(distance)))
+
+    def snap_index(self):
+        """The graph's ``SnapIndex``, built on first use."""
+        if self._snap_index is None:
+            self._snap_index = SnapIndex(self.coords)
+        return self._snap_index
+
+    def nearest_nodes(self, lonlat):
+        """Indices of the nodes closest to each ``(lon, lat)`` and their distances in meters."""
+        return self.snap_index().nearest(lonlat)
+
+    def nearest_node(self, lon: float, lat: float):
+        """Index of the node closest to a point."""
+        return int(self.nearest_nodes([(lon, lat)])[0][0])
+
+    def degrees(self):
+        """In + out degree of every node, as counted by the urban metrics."""
+        return node_degrees(self.node_ids, self.node_ids[self.sources], self.node_ids[self.neighbors])
+
+    def reversed(self):
+        """The same graph with every edge pointing the other way."""
+        return CityGraph.from_edges(self.city_id, self.node_ids, self.coords,
+                                    self.neighbors, self.sources, self.lengths, self.edge_ids)
+
+    def to_networkx(self):
+        """Export as an osmnx-style ``MultiDiGraph`` keyed by osm_id."""
+        import networkx as nx
+
+        G = nx.MultiDiGraph()
+        G.add_nodes_from(
+            (int(osm_id), {'x': float(x), 'y': float(y)}) for osm_id, (x, y) in zip(self.node_ids, self.coords)
+        )
+        G.add_edges_from(
+            (int(self.node_ids[u]), int(self.node_ids[v]), {'length': float(length), 'edge_id': int(edge_id)})
+            for u, v, length, edge_id in zip(self.sources, self.neighbors, self.lengths, self.edge_ids)
+        )
+        return G
+
+    def __repr__(self):
+        return f"<CityGraph city={self.city_id} nodes={self.node_count} edges={self.edge_count}>"
+
+
+def build_city_graph(city):
+    """
+    Build a city's ``CityGraph`` from one bulk query per table. Edges whose
+    endpoints are not nodes of the city are left out.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(NODE_ARRAYS_SQL.format(node_table=Node._meta.db_table), [city.id])
+        node_rows = cursor.fetchall()
+        cursor.execute(EDGE_ARRAYS_SQL.format(edge_table=Edge._meta.db_table), [city.id])
+        edge_rows = cursor.fetchall()
+
+    node_ids = np.fromiter((row[0] for row in node_rows), dtype=np.int64, count=len(node_rows))
+    coords = np.array([row[1:] for row in node_rows], dtype=np.float64).reshape(-1, 2)
+    edge_ids = np.fromiter((row[0] for row in edge_rows), dtype=np.int64, count=len(edge_rows))
+    starts = np.fromiter((row[1] for row in edge_rows), dtype=np.int64, count=len(edge_rows))
+    ends = np.fromiter((row[2] for row in edge_rows), dtype=np.int64, count=len(edge_rows))
+    lengths = np.fromiter((row[3] for row in edge_rows), dtype=np.float64, count=len(edge_rows))
+
+    graph = CityGraph(city.id, node_ids, coords, None, None, None, None)
+    sources = graph.index_of(starts)
+    targets = graph.index_of(ends)
+    known = (sources >= 0) & (targets >= 0)
+
+    return CityGraph.from_edges(
+        city.id, node_ids, coords, sources[known], targets[known], lengths[known], edge_ids[known],
+    )
+
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_ARRAYS = ('node_ids', 'coords', 'offsets', 'neighbors', 'lengths', 'edge_ids')
+
+# city_id -> (graph_version, CityGraph) for this process
+_graph_cache = {}
+
+
+def snapshot_root(city_id):
+    return Path(settings.GRAPH_SNAPSHOT_DIR) / f"city_{city_id}"
+
+
+def write_snapshot(graph, graph_version: int):
+    """
+    Store the graph's arrays as raw ``.npy`` files under
+    ``GRAPH_SNAPSHOT_DIR/city_<id>/v<graph_version>/``. The directory is
+    written under a temporary name and renamed into place, so readers never
+    see a partial snapshot. Versions older than ``graph_version`` are
+    removed; newer ones may have been published by another worker meanwhile.
+    """
+    root = snapshot_root(graph.city_id)
+    root.mkdir(parents=True, exist_ok=True)
+    target = root / f"v{graph_version}"
+
+    if not target.exists():
+        tmp = Path(tempfile.mkdtemp(dir=root, prefix=".tmp-"))
+        for name in SNAPSHOT_ARRAYS:
+            np.save(tmp / f"{name}.npy", np.ascontiguousarray(getattr(graph, name)))
+        (tmp / "meta.json").write_text(json.dumps({
+            'format': SNAPSHOT_FORMAT,
+            'city_id': graph.city_id,
+            'graph_version': graph_version,
+            'node_count': graph.node_count,
+            'edge_count': graph.edge_count,
+        }))
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            # Another worker published the same version first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # Processes still mapping an old version keep their pages until they unmap
+    for old in root.glob("v*"):
+        try:
+            stale = int(old.name[1:]) < graph_version
+        except ValueError:
+            continue
+        if stale:
+            shutil.rmtree(old, ignore_errors=True)
+    return target
+
+
+def load_snapshot(city_id, graph_version: int):
+    """
+    Memory-map a city's snapshot read-only, so every process using it shares
+    one page-cache copy. Returns ``None`` when there is no snapshot for this
+    exact graph version or it fails validation.
+    """
+    path = snapshot_root(city_id) / f"v{graph_version}"
+    try:
+        meta = json.loads((path / "meta.json").read_text())
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode='r') for name in SNAPSHOT_ARRAYS}
+    except (OSError, ValueError):
+        return None
+
+    node_count, edge_count = meta.get('node_count'), meta.get('edge_count')
+    if (meta.get('format') != SNAPSHOT_FORMAT or meta.get('city_id') != city_id
+            or meta.get('graph_version') != graph_version
+            or len(arrays['node_ids']) != node_count or len(arrays['coords']) != node_count
+            or len(arrays['offsets']) != node_count + 1
+            or not len(arrays['neighbors']) == len(arrays['lengths']) == len(arrays['edge_ids']) == edge_count):
+        return None
+
+    return CityGraph(city_id, **arrays)
+
+
+def _current_graph_version(city_id):
+    return City.objects.filter(pk=city_id).values_list('graph_version', flat=True).get()
+
+
+def get_versioned_city_graph(city):
+    """
+    Return ``(graph_version, CityGraph)`` of a city (a ``City`` or its name)
+    for its current graph version: from this process's cache, else from the
+    on-disk snapshot, else built from the database and snapshotted for the
+    other workers.
+    """
+    if isinstance(city, str):
+        city = City.objects.get(name=city)
+    version = _current_graph_version(city.pk)
+
+    cached = _graph_cache.get(city.pk)
+    if cached is not None and cached[0] == version:
+        return cached
+
+    graph = load_snapshot(city.pk, version)
+    if graph is None:
+        graph = build_city_graph(city)
+        # Only publish the snapshot if nothing was written while building it
+        if _current_graph_version(city.pk) == version:
+            write_snapshot(graph, version)
+
+    _graph_cache[city.pk] = (version, graph)
+    return version, graph
+
+
+def get_city_graph(city):
+    """The ``CityGraph`` of a city for its current graph version, see ``get_versioned_city_graph``."""
+    return get_versioned_city_graph(city)[1]
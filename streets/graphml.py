@@ -0,0 +1,52 @@
+from xml.etree.ElementTree import iterparse
+
+GRAPHML_NS = '{http://graphml.graphdrawing.org/xmlns}'
+
+
+def iter_graphml(graphml_path: str, batch_size: int = 5000):
+    """
+    Stream a GraphML file and yield ``('node', batch)`` / ``('edge', batch)``.
+
+    Node records are ``(node_id, data)`` and edge records ``(source, target, data)``,
+    the same shapes as ``G.nodes(data=True)`` and ``G.edges(data=True)``, with
+    attribute values left as strings. Elements are discarded as soon as they are
+    read, so memory is bounded by one batch rather than the whole graph.
+    """
+    keys = {}
+    graph = None
+    kind = None
+    batch = []
+
+    for event, elem in iterparse(graphml_path, events=('start', 'end')):
+        tag = elem.tag.replace(GRAPHML_NS, '')
+
+        if event == 'start':
+            if tag == 'graph' and graph is None:
+                graph = elem
+            continue
+
+        if tag == 'key':
+            keys[elem.get('id')] = elem.get('attr.name', elem.get('id'))
+            continue
+
+        if tag not in ('node', 'edge'):
+            continue
+
+        data = {keys.get(d.get('key'), d.get('key')): d.text for d in elem.iter(f'{GRAPHML_NS}data')}
+        if tag == 'node':
+            record = (elem.get('id'), data)
+        else:
+            record = (elem.get('source'), elem.get('target'), data)
+
+        if kind is not None and (tag != kind or len(batch) >= batch_size):
+            yield kind, batch
+            batch = []
+        kind = tag
+        batch.append(record)
+
+        elem.clear()
+        if graph is not None:
+            graph.clear()
+
+    if batch:
+        yield kind, batch
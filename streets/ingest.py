@@ -0,0 +1,363 @@
+import hashlib
+import struct
+from itertools import chain
+import numpy as np
+import shapely
+from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import WKBWriter
+from django.db import connection, transaction
+from .models import City, Node, Edge
+from .graphml import iter_graphml
+
+BATCH_SIZE = 5000
+
+
+def batched(iterable, size: int = BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_linestrings(wkt_geoms):
+    """
+    Decode a batch of ``LINESTRING`` WKT strings with shapely's vectorized
+    parser and hand them to GEOS as WKB. Returns a list aligned with the input
+    holding a ``LineString`` or ``None`` for missing/malformed geometries.
+    """
+    wkts = np.array([w if isinstance(w, str) else None for w in wkt_geoms], dtype=object)
+    geoms = shapely.from_wkt(wkts, on_invalid='ignore')
+    valid = (shapely.get_type_id(geoms) == 1) & (shapely.get_num_points(geoms) >= 2)
+
+    linestrings = [None] * len(wkts)
+    for i, wkb in zip(np.flatnonzero(valid), shapely.to_wkb(geoms[valid])):
+        linestrings[i] = GEOSGeometry(memoryview(wkb), srid=4326)
+    return linestrings
+
+
+def upsert_nodes(city, node_rows):
+    """
+    Insert or update ``(osm_id, x, y)`` rows in batches with a single
+    ``INSERT ... ON CONFLICT DO UPDATE`` per batch. Returns the number of
+    nodes that did not exist before.
+    """
+    created_count = 0
+    written = False
+
+    for batch in batched(node_rows):
+        rows = {osm_id: (x, y) for osm_id, x, y in batch}
+        existing = set(Node.objects.filter(osm_id__in=list(rows)).values_list('osm_id', flat=True))
+
+        Node.objects.bulk_create(
+            [Node(osm_id=osm_id, city=city, geom=Point(x, y, srid=4326)) for osm_id, (x, y) in rows.items()],
+            update_conflicts=True,
+            unique_fields=['osm_id'],
+            # A node shared with another city moves to the one being imported, as in publish_stage
+            update_fields=['geom', 'city'],
+        )
+        created_count += len(rows.keys() - existing)
+        written = True
+
+    if written:
+        City.bump_graph_version(city.id)
+    return created_count
+
+
+def upsert_edges(city, edge_rows, node_ids=None):
+    """
+    Insert or update ``(u, v, geom)`` rows in batches. ``start_node``/``end_node``
+    are resolved against the in-memory set of the city's node osm_ids instead
+    of one lookup per endpoint. Returns ``(created_count, skipped_count)``.
+    """
+    if node_ids is None:
+        node_ids = set(Node.objects.filter(city=city).values_list('osm_id', flat=True))
+    existing = set(Edge.objects.filter(city=city).values_list('start_node_id', 'end_node_id'))
+
+    created_count = 0
+    skipped_count = 0
+    written = False
+
+    for batch in batched(edge_rows):
+        # One row per (u, v): ON CONFLICT DO UPDATE cannot touch a row twice in a statement
+        rows = {}
+        for u, v, geom in batch:
+            if u not in node_ids or v not in node_ids:
+                print(f"Skipping edge  {u}→{v}: node lookup failed - Node matching query does not exist.")
+                skipped_count += 1
+                continue
+            rows[(u, v)] = geom
+
+        Edge.objects.bulk_create(
+            [Edge(city=city, start_node_id=u, end_node_id=v, geom=geom) for (u, v), geom in rows.items()],
+            update_conflicts=True,
+            unique_fields=['city', 'start_node', 'end_node'],
+            update_fields=['geom'],
+        )
+
+        new_keys = rows.keys() - existing
+        created_count += len(new_keys)
+        existing |= new_keys
+        written = written or bool(rows)
+
+    if written:
+        City.bump_graph_version(city.id)
+    return created_count, skipped_count
+
+
+def _graphml_node_rows(nodes, stats):
+    for node_id, data in nodes:
+        try:
+            osm_id = int(data.get('osmid', node_id))
+            x = float(data['x'])
+            y = float(data['y'])
+        except (KeyError, TypeError, ValueError):
+            stats['skipped'] += 1
+            continue
+        yield osm_id, x, y
+
+
+def _graphml_edge_rows(edges, stats):
+    for batch in batched(edges):
+        rows = []
+        for source, target, edge_data in batch:
+            try:
+                rows.append((int(source), int(target), edge_data.get('geometry'), source, target))
+            except ValueError as e:
+                print(f"Skipping edge  {source}→{target}: node lookup failed - {e}")
+                stats['skipped'] += 1
+
+        linestrings = parse_linestrings([wkt for _, _, wkt, _, _ in rows])
+        for (u, v, wkt, source, target), linestring in zip(rows, linestrings):
+            if linestring is None:
+                reason = 'missing geometry' if wkt is None else f'malformed WKT {wkt[:40]!r}'
+                print(f"Skipping edge {source}→{target}: invalid geometry - {reason}")
+                stats['skipped'] += 1
+                continue
+            yield u, v, linestring
+
+
+def _graphml_records(graphml_path: str, kind: str):
+    for batch_kind, batch in iter_graphml(graphml_path, BATCH_SIZE):
+        if batch_kind == kind:
+            yield from batch
+
+
+def split_graphml(graphml_path: str):
+    """
+    Split one streaming pass over a GraphML file into node and edge record
+    iterators. The node iterator has to be exhausted before the edge iterator
+    is started, which matches how networkx/osmnx lay the file out.
+    """
+    batches = iter_graphml(graphml_path, BATCH_SIZE)
+    first_edges = []
+
+    def nodes():
+        for kind, batch in batches:
+            if kind == 'edge':
+                first_edges.extend(batch)
+                return
+            yield from batch
+
+    def edges():
+        yield from first_edges
+        for kind, batch in batches:
+            if kind == 'edge':
+                yield from batch
+
+    return nodes(), edges()
+
+
+def bulk_save_graphml_nodes(city_name: str, graphml_path: str):
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Bulk importing {city.name} graphml file...")
+
+    stats = {'skipped': 0}
+    created_count = upsert_nodes(city, _graphml_node_rows(_graphml_records(graphml_path, 'node'), stats))
+
+    print(f"Nodes imported or updated: {created_count}, skipped: {stats['skipped']}")
+    return created_count, stats['skipped']
+
+
+def bulk_save_graphml_edges(city_name: str, graphml_path: str):
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Bulk importing edges for {city.name} from graphml file...")
+
+    stats = {'skipped': 0}
+    created_count, missing_count = upsert_edges(
+        city, _graphml_edge_rows(_graphml_records(graphml_path, 'edge'), stats))
+    skipped_count = stats['skipped'] + missing_count
+
+    print(f"Edges imported: {created_count}, skipped: {skipped_count}")
+    return created_count, skipped_count
+
+
+def save_graphml(city_name: str, graphml_path: str):
+    """
+    Import nodes and edges with a single streaming pass over the GraphML file.
+    GraphML written by networkx/osmnx lists every node before the first edge,
+    so node batches are upserted as they arrive and edge batches are resolved
+    against the nodes stored by then.
+    """
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Importing {city.name} graphml file...")
+    batches = iter_graphml(graphml_path, BATCH_SIZE)
+
+    node_stats = {'skipped': 0}
+    node_created = 0
+    first_edges = []
+    for kind, batch in batches:
+        if kind == 'edge':
+            first_edges = batch
+            break
+        node_created += upsert_nodes(city, _graphml_node_rows(batch, node_stats))
+
+    print(f"Nodes imported or updated: {node_created}, skipped: {node_stats['skipped']}")
+
+    edge_stats = {'skipped': 0}
+    edges = chain(first_edges, chain.from_iterable(batch for kind, batch in batches if kind == 'edge'))
+    edge_created, missing_count = upsert_edges(city, _graphml_edge_rows(edges, edge_stats))
+    edge_skipped = edge_stats['skipped'] + missing_count
+
+    print(f"Edges imported: {edge_created}, skipped: {edge_skipped}")
+    return (node_created, node_stats['skipped']), (edge_created, edge_skipped)
+
+
+# Hashes are md5 of the little-endian 2D WKB, which is what PostGIS returns for
+# ST_AsBinary(geom::geometry, 'NDR'), so stored rows are hashed in the database.
+def node_hash(x: float, y: float):
+    return hashlib.md5(struct.pack('<BIdd', 1, 1, x, y)).hexdigest()
+
+
+def edge_hash(geom):
+    writer = WKBWriter()
+    writer.byteorder = 1
+    return hashlib.md5(bytes(writer.write(geom))).hexdigest()
+
+
+def _stored_node_hashes(city):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT osm_id, md5(ST_AsBinary(geom::geometry, 'NDR')) FROM {Node._meta.db_table} WHERE city_id = %s",
+            [city.id],
+        )
+        return dict(cursor.fetchall())
+
+
+def _stored_edge_hashes(city):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT start_node_id, end_node_id, id, md5(ST_AsBinary(geom::geometry, 'NDR')) "
+            f"FROM {Edge._meta.db_table} WHERE city_id = %s",
+            [city.id],
+        )
+        return {(u, v): (edge_id, digest) for u, v, edge_id, digest in cursor.fetchall()}
+
+
+def apply_graph_diff(city, node_rows, edge_rows):
+    """
+    Bring the city's stored graph in line with ``node_rows`` (``(osm_id, x, y)``)
+    and ``edge_rows`` (``(u, v, geom)``) by writing only what changed. Rows are
+    compared by content hash; stored nodes and edges missing from the input are
+    deleted. Returns the size of the diff.
+    """
+    diff = {
+        'nodes': {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0},
+        'edges': {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0, 'skipped': 0},
+    }
+
+    with transaction.atomic():
+        stored_nodes = _stored_node_hashes(city)
+        seen_nodes = set()
+        changed_nodes = []
+        for osm_id, x, y in node_rows:
+            seen_nodes.add(osm_id)
+            stored = stored_nodes.get(osm_id)
+            if stored == node_hash(x, y):
+                diff['nodes']['unchanged'] += 1
+                continue
+            diff['nodes']['inserted' if stored is None else 'updated'] += 1
+            changed_nodes.append((osm_id, x, y))
+        upsert_nodes(city, changed_nodes)
+
+        stored_edges = _stored_edge_hashes(city)
+        seen_edges = set()
+        changed_edges = []
+        for u, v, geom in edge_rows:
+            if u not in seen_nodes or v not in seen_nodes:
+                diff['edges']['skipped'] += 1
+                continue
+            if (u, v) in seen_edges:
+                continue
+            seen_edges.add((u, v))
+            stored = stored_edges.get((u, v))
+            if stored is not None and stored[1] == edge_hash(geom):
+                diff['edges']['unchanged'] += 1
+                continue
+            diff['edges']['inserted' if stored is None else 'updated'] += 1
+            changed_edges.append((u, v, geom))
+        upsert_edges(city, changed_edges, node_ids=seen_nodes)
+
+        removed_edges = [edge_id for key, (edge_id, _) in stored_edges.items() if key not in seen_edges]
+        for batch in batched(removed_edges):
+            Edge.objects.filter(id__in=batch).delete()
+        diff['edges']['deleted'] = len(removed_edges)
+
+        removed_nodes = [osm_id for osm_id in stored_nodes if osm_id not in seen_nodes]
+        for batch in batched(removed_nodes):
+            Node.objects.filter(osm_id__in=batch).delete()
+        diff['nodes']['deleted'] = len(removed_nodes)
+
+        if removed_edges or removed_nodes:
+            City.bump_graph_version(city.id)
+
+    return diff
+
+
+def format_diff(diff):
+    return "; ".join(
+        f"{kind}: +{counts['inserted']} ~{counts['updated']} -{counts['deleted']} ={counts['unchanged']}"
+        for kind, counts in diff.items()
+    )
+
+
+def reingest_graphml(city_name: str, graphml_path: str):
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Re-importing {city.name} graphml file...")
+    node_stats = {'skipped': 0}
+    edge_stats = {'skipped': 0}
+
+    # Nodes precede edges in the file: hold the nodes, then stream the edges
+    nodes, edges = split_graphml(graphml_path)
+    node_rows = list(_graphml_node_rows(nodes, node_stats))
+    edge_rows = _graphml_edge_rows(edges, edge_stats)
+    diff = apply_graph_diff(city, node_rows, edge_rows)
+    diff['nodes']['skipped'] = node_stats['skipped']
+    diff['edges']['skipped'] += edge_stats['skipped']
+
+    print(f"Graph diff for {city.name}: {format_diff(diff)}")
+    return diff
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from threading import Lock
+
+import shapely
+from shapely.geometry import mapping
+
+from .graph import get_versioned_city_graph
+
+# Average travel speeds used to turn minutes into meters
+TRAVEL_SPEEDS_KMH = {
+    'walk': 5.0,
+    'bike': 15.0,
+    'drive': 30.0,
+}
+ISOCHRONE_UNITS = ('meters', 'minutes')
+ISOCHRONE_CACHE_SIZE = 512
+# Ratio passed to shapely.concave_hull: lower follows the reachable nodes more tightly
+HULL_RATIO = 0.3
+
+
+def budget_to_meters(budget: float, unit: str, mode: str):
+    if unit == 'meters':
+        return float(budget)
+    return float(budget) * TRAVEL_SPEEDS_KMH[mode] * 1000 / 60
+
+
+def isochrone_polygon(coords):
+    """A concave hull around the reachable node coordinates."""
+    if len(coords) < 3:
+        return shapely.buffer(shapely.multipoints(coords), 0.0001) if len(coords) else None
+    return shapely.concave_hull(shapely.multipoints(coords), ratio=HULL_RATIO)
+
+
+# (city_id, graph_version, source node, budgets in meters) -> results, least recently used first
+_isochrone_cache = OrderedDict()
+_isochrone_cache_lock = Lock()
+
+
+def _isochrones(graph, source: int, budgets_m):
+    reached, distance = graph.distances_from(source, max(budgets_m))
+
+    results = []
+    for budget in budgets_m:
+        within = reached[distance <= budget]
+        polygon = isochrone_polygon(graph.coords[within])
+        results.append((budget, len(within), mapping(polygon) if polygon is not None else None))
+    return results
+
+
+def cached_isochrones(graph, graph_version: int, source: int, budgets_m: tuple):
+    # The graph version is part of the key, so results never outlive the graph they came from
+    key = (graph.city_id, graph_version, source, budgets_m)
+    with _isochrone_cache_lock:
+        if key in _isochrone_cache:
+            _isochrone_cache.move_to_end(key)
+            return _isochrone_cache[key]
+
+    results = _isochrones(graph, source, budgets_m)
+    with _isochrone_cache_lock:
+        _isochrone_cache[key] = results
+        if len(_isochrone_cache) > ISOCHRONE_CACHE_SIZE:
+            _isochrone_cache.popitem(last=False)
+    return results
+
+
+def isochrones(city, lon: float, lat: float, budgets, unit: str = 'minutes', mode: str = 'walk'):
+    """
+    Isochrones around a point: the point is snapped to the nearest node of the
+    city's graph, one bounded Dijkstra runs up to the largest budget, and each
+    budget gets a polygon around the nodes reached within it plus their count.
+
+    Results are kept in an LRU cache per city, graph version, snapped node and
+    budgets, so repeated queries on a warm city skip the search entirely.
+    """
+    if unit not in ISOCHRONE_UNITS:
+        raise ValueError(f"Unknown unit '{unit}'. Choose from: {', '.join(ISOCHRONE_UNITS)}")
+    if mode not in TRAVEL_SPEEDS_KMH:
+        raise ValueError(f"Unknown mode '{mode}'. Choose from: {', '.join(TRAVEL_SPEEDS_KMH)}")
+    budgets = sorted({float(budget) for budget in budgets})
+    if not budgets or budgets[0] <= 0:
+        raise ValueError("Budgets must be a non-empty list of positive numbers.")
+
+    graph_version, graph = get_versioned_city_graph(city)
+    if not graph.node_count:
+        raise ValueError(f"City {city.name} has no network.")
+    source = graph.nearest_node(lon, lat)
+    budgets_m = tuple(budget_to_meters(budget, unit, mode) for budget in budgets)
+
+    results = cached_isochrones(graph, graph_version, source, budgets_m)
+
+    return {
+        'type': 'FeatureCollection',
+        'origin': {
+            'node': int(graph.node_ids[source]),
+            'coordinates': graph.coords[source].tolist(),
+        },
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': {
+                    'budget': budget,
+                    'unit': unit,
+                    'mode': mode,
+                    'meters': meters,
+                    'reachable_nodes': reachable,
+                },
+            }
+            for budget, (meters, reachable, geometry) in zip(budgets, results)
+        ],
+    }
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from streets.models import City, Node, Edge
+from streets import utils, ingest
+
+
+def _legacy_save_graphml(city_name, graphml_path):
+    utils.save_graphml_nodes(city_name, graphml_path)
+    utils.save_graphml_edges(city_name, graphml_path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-row GraphML loader (utils) with the bulk loader (ingest) on one city. "
+        "Each run starts from an empty graph and is rolled back, so the database is left unchanged."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help="Name of an existing City")
+        parser.add_argument('graphml', help="Path to the city's .graphml file")
+        parser.add_argument('--skip-legacy', action='store_true', help="Only time the bulk loader")
+
+    def handle(self, *args, **options):
+        city_name = options['city']
+        graphml_path = options['graphml']
+        if not City.objects.filter(name=city_name).exists():
+            raise CommandError(f"City {city_name} not found.")
+
+        loaders = [('bulk', ingest.save_graphml)]
+        if not options['skip_legacy']:
+            loaders.insert(0, ('legacy', _legacy_save_graphml))
+
+        results = []
+        for label, save_graph in loaders:
+            with transaction.atomic():
+                Node.objects.filter(city__name=city_name).delete()
+
+                start = time.perf_counter()
+                save_graph(city_name, graphml_path)
+                elapsed = time.perf_counter() - start
+
+                rows = (Node.objects.filter(city__name=city_name).count()
+                        + Edge.objects.filter(city__name=city_name).count())
+                transaction.set_rollback(True)
+
+            results.append((label, rows, elapsed))
+
+        self.stdout.write("")
+        for label, rows, elapsed in results:
+            rate = rows / elapsed if elapsed > 0 else 0
+            self.stdout.write(f"{label:>8}: {rows} rows in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+        if len(results) == 2 and results[1][2] > 0:
+            self.stdout.write(f" speedup: {results[0][2] / results[1][2]:.1f}x")
@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+from django.contrib.gis.geos import LineString
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from streets.ingest import upsert_nodes, upsert_edges
+from streets.models import City, GeoAreaMapping
+from streets.utils import get_metrics_engine
+
+BENCHMARK_CITY = "__benchmark__"
+
+
+def build_synthetic_city(size: int, seed: int = 0):
+    """
+    Create a jittered ``size`` x ``size`` street grid with two-way edges around
+    Milan. Node osm_ids are negative so they never collide with real OSM ids.
+    """
+    rng = np.random.default_rng(seed)
+    geo_area, _ = GeoAreaMapping.objects.get_or_create(geo_area='EU', defaults={'full_name': 'Europe'})
+    city = City.objects.create(name=BENCHMARK_CITY, country="Nowhere", geo_area=geo_area)
+
+    step = 0.001
+    lon = 9.15 + np.arange(size)[:, None] * step + rng.normal(0, step / 10, (size, size))
+    lat = 45.45 + np.arange(size)[None, :] * step + rng.normal(0, step / 10, (size, size))
+    ids = -(np.arange(size * size).reshape(size, size) + 1)
+
+    upsert_nodes(city, ((int(ids[i, j]), float(lon[i, j]), float(lat[i, j]))
+                        for i in range(size) for j in range(size)))
+
+    def edges():
+        for i in range(size):
+            for j in range(size):
+                for di, dj in ((1, 0), (0, 1)):
+                    if i + di < size and j + dj < size:
+                        a = (float(lon[i, j]), float(lat[i, j]))
+                        b = (float(lon[i + di, j + dj]), float(lat[i + di, j + dj]))
+                        mid = ((a[0] + b[0]) / 2 + rng.normal(0, step / 20), (a[1] + b[1]) / 2)
+                        u, v = int(ids[i, j]), int(ids[i + di, j + dj])
+                        yield u, v, LineString([a, mid, b], srid=4326)
+                        yield v, u, LineString([b, mid, a], srid=4326)
+
+    upsert_edges(city, edges(), node_ids=set(ids.ravel().tolist()))
+    return city
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the metric engines on a synthetic grid city and check that they agree. "
+        "The city is created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=300, help="Grid side length (size^2 nodes)")
+        parser.add_argument('--engines', nargs='+', default=['legacy', 'numpy', 'sql'],
+                            help="Engines to compare; the first one is the reference")
+
+    def handle(self, *args, **options):
+        size = options['size']
+        with transaction.atomic():
+            self.stdout.write(f"Building a {size}x{size} synthetic city...")
+            city = build_synthetic_city(size)
+            edge_count = city.edge_set.count()
+            self.stdout.write(f"{size * size} nodes, {edge_count} edges")
+
+            results = {}
+            for engine in options['engines']:
+                start = time.perf_counter()
+                values = get_metrics_engine(engine)(city.name)
+                elapsed = time.perf_counter() - start
+                results[engine] = values
+                rate = edge_count / elapsed if elapsed > 0 else 0
+                self.stdout.write(f"{engine:>8}: {elapsed:.3f}s ({rate:,.0f} edges/s)")
+
+            transaction.set_rollback(True)
+
+        reference_name = options['engines'][0]
+        reference = results[reference_name]
+        for engine, values in results.items():
+            if engine == reference_name:
+                continue
+            worst = max(abs(values[key] - reference[key]) / max(abs(reference[key]), 1e-12) for key in reference)
+            self.stdout.write(f"{engine} vs {reference_name}: max relative difference {worst:.2e}")
@@ -0,0 +1,67 @@
+import math
+import time
+
+import networkx as nx
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from streets.models import City
+from streets.routing import get_hierarchy, prepare_routing
+
+
+class Command(BaseCommand):
+    help = (
+        "Time contraction-hierarchy routes against networkx shortest_path on random node pairs "
+        "of a city and check that both find paths of the same length."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help="City name")
+        parser.add_argument('--queries', type=int, default=100, help="Number of random origin-destination pairs")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the pairs")
+
+    def handle(self, *args, **options):
+        try:
+            city = City.objects.get(name=options['city'])
+        except City.DoesNotExist:
+            raise CommandError(f"City {options['city']} not found.")
+
+        start = time.perf_counter()
+        prepare_routing(city)
+        hierarchy = get_hierarchy(city)
+        if hierarchy is None:
+            raise CommandError(f"The graph of {city.name} changed while contracting it, run again.")
+        graph = hierarchy.graph
+        self.stdout.write(f"Hierarchy ready in {time.perf_counter() - start:.1f}s "
+                          f"({graph.node_count} nodes, {graph.edge_count} edges)")
+
+        G = graph.to_networkx()
+        rng = np.random.default_rng(options['seed'])
+        pairs = rng.integers(0, graph.node_count, size=(options['queries'], 2))
+
+        ch_time = nx_time = 0.0
+        mismatches = unreachable = 0
+        for source, target in pairs.tolist():
+            start = time.perf_counter()
+            length, path = hierarchy.shortest_path(source, target)
+            ch_time += time.perf_counter() - start
+
+            u, v = int(graph.node_ids[source]), int(graph.node_ids[target])
+            start = time.perf_counter()
+            try:
+                nx_path = nx.shortest_path(G, u, v, weight='length')
+                nx_length = nx.path_weight(G, nx_path, weight='length')
+            except nx.NetworkXNoPath:
+                nx_length = math.inf
+            nx_time += time.perf_counter() - start
+
+            if math.isinf(nx_length):
+                unreachable += 1
+            if not math.isclose(length, nx_length, rel_tol=1e-9, abs_tol=1e-6):
+                mismatches += 1
+
+        queries = len(pairs)
+        self.stdout.write(f"contraction hierarchy: {ch_time / queries * 1000:8.2f} ms/query")
+        self.stdout.write(f"networkx shortest_path: {nx_time / queries * 1000:7.2f} ms/query")
+        self.stdout.write(f"speedup {nx_time / ch_time if ch_time > 0 else 0:.1f}x, "
+                          f"{unreachable} unreachable pairs, {mismatches} length mismatches")
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from streets.graph import get_city_graph
+from streets.models import City
+
+
+class Command(BaseCommand):
+    help = "Build or refresh the memory-mapped graph snapshots of the given cities (default: all)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('cities', nargs='*', help="City names")
+
+    def handle(self, *args, **options):
+        cities = City.objects.all()
+        if options['cities']:
+            cities = cities.filter(name__in=options['cities'])
+
+        for city in cities:
+            start = time.perf_counter()
+            graph = get_city_graph(city)
+            self.stdout.write(
+                f"{city.name}: v{city.graph_version}, {graph.node_count} nodes, {graph.edge_count} edges, "
+                f"{graph.nbytes / 1e6:.1f} MB in {time.perf_counter() - start:.2f}s"
+            )
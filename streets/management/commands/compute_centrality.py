@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from streets.centrality import sampled_centrality
+from streets.models import City, Metric, MetricValue
+from streets.parallel import default_workers
+
+
+class Command(BaseCommand):
+    help = (
+        "Estimate betweenness and closeness centrality of a city's street network from sampled "
+        "source nodes and optionally save them as the BET, BMX and CLO metrics."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help="City name")
+        parser.add_argument('--samples', type=int, default=200, help="Number of sampled source nodes")
+        parser.add_argument('--epsilon', type=float,
+                            help="Target absolute error of every normalized betweenness value; "
+                                 "overrides --samples")
+        parser.add_argument('--delta', type=float, default=0.1,
+                            help="Allowed probability of exceeding --epsilon")
+        parser.add_argument('--workers', type=int, default=default_workers(),
+                            help="Number of worker processes (default: number of CPUs)")
+        parser.add_argument('--time-budget', type=float,
+                            help="Seconds after which no more sources are started")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the source sample")
+        parser.add_argument('--save', action='store_true', help="Save the results as metric values")
+
+    def handle(self, *args, **options):
+        try:
+            city = City.objects.get(name=options['city'])
+        except City.DoesNotExist:
+            raise CommandError(f"City {options['city']} not found.")
+
+        result = sampled_centrality(
+            city,
+            samples=options['samples'],
+            epsilon=options['epsilon'],
+            delta=options['delta'],
+            workers=options['workers'],
+            time_budget=options['time_budget'],
+            seed=options['seed'],
+        )
+
+        self.stdout.write(f"{city.name}: {result['sources']} of {result['requested_sources']} sources "
+                          f"in {result['seconds']:.2f}s")
+        self.stdout.write(f"  Average betweenness {result['betweenness_mean']:.6g} "
+                          f"(± {result['betweenness_mean_stderr']:.2g})")
+        self.stdout.write(f"  Maximum betweenness {result['betweenness_max']:.6g}")
+        self.stdout.write(f"  Average closeness   {result['closeness_mean']:.6g} "
+                          f"(± {result['closeness_mean_stderr']:.2g})")
+
+        if options['save']:
+            values = {
+                'BET': result['betweenness_mean'],
+                'BMX': result['betweenness_max'],
+                'CLO': result['closeness_mean'],
+            }
+            now = timezone.now()
+            for metric in Metric.objects.filter(name__in=values, type__in=['walk', 'bike']):
+                MetricValue.objects.update_or_create(
+                    city=city, metric=metric, datetime=now, defaults={'value': values[metric.name]})
+            self.stdout.write("Saved.")
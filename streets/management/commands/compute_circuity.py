@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from streets.circuity import network_circuity
+from streets.models import City, Metric, MetricValue
+from streets.parallel import default_workers
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure network circuity (shortest-path over great-circle distance) of sampled "
+        "origin-destination pairs in a city and optionally save it as the NCI metric."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help="City name")
+        parser.add_argument('--origins', type=int, default=500, help="Number of sampled origins")
+        parser.add_argument('--destinations', type=int, default=20, help="Destinations per origin")
+        parser.add_argument('--min-distance', type=float, default=500, help="Minimum pair distance in meters")
+        parser.add_argument('--max-distance', type=float, default=5000, help="Maximum pair distance in meters")
+        parser.add_argument('--workers', type=int, default=default_workers(),
+                            help="Number of worker processes (default: number of CPUs)")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the pair sample")
+        parser.add_argument('--save', action='store_true', help="Save the result as a metric value")
+
+    def handle(self, *args, **options):
+        try:
+            city = City.objects.get(name=options['city'])
+        except City.DoesNotExist:
+            raise CommandError(f"City {options['city']} not found.")
+
+        result = network_circuity(
+            city,
+            origins=options['origins'],
+            destinations_per_origin=options['destinations'],
+            min_distance=options['min_distance'],
+            max_distance=options['max_distance'],
+            workers=options['workers'],
+            seed=options['seed'],
+        )
+
+        self.stdout.write(f"{city.name}: {result['pairs']} pairs ({result['unreachable']} unreachable) "
+                          f"in {result['seconds']:.2f}s")
+        self.stdout.write(f"  Network circuity {result['circuity']:.4f} (mean ratio {result['mean_ratio']:.4f})")
+
+        if options['save']:
+            now = timezone.now()
+            for metric in Metric.objects.filter(name='NCI'):
+                MetricValue.objects.update_or_create(
+                    city=city, metric=metric, datetime=now, defaults={'value': result['circuity']})
+            self.stdout.write("Saved.")
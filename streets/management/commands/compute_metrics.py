@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from streets.parallel import default_workers
+from streets.utils import recompute_metric_values
+
+
+class Command(BaseCommand):
+    help = "Recompute and save the urban metrics of the given cities (default: all) in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument('cities', nargs='*', help="City names")
+        parser.add_argument('--workers', type=int, default=default_workers(),
+                            help="Number of worker processes (default: number of CPUs)")
+        parser.add_argument('--engine', default='numpy', choices=['numpy', 'sql', 'incremental', 'registry', 'legacy'],
+                            help="Metrics engine to use")
+        parser.add_argument('--metrics', nargs='+', help="Metric codes to compute (default: all)")
+
+    def handle(self, *args, **options):
+        try:
+            report, wall_time = recompute_metric_values(
+                options['cities'] or None, workers=options['workers'], engine=options['engine'],
+                metrics=options['metrics'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not report:
+            raise CommandError("No cities to compute.")
+
+        for result in report:
+            if result['ok']:
+                self.stdout.write(f"{result['city']:<20} {result['seconds']:8.2f}s  {result['saved']} values")
+            else:
+                self.stderr.write(f"{result['city']:<20} FAILED")
+                self.stderr.write(result['error'])
+
+        cpu_time = sum(r['seconds'] for r in report)
+        failed = sum(1 for r in report if not r['ok'])
+        self.stdout.write("")
+        self.stdout.write(f"Cities: {len(report) - failed} computed, {failed} failed")
+        self.stdout.write(f"Wall time {wall_time:.2f}s for {cpu_time:.2f}s of per-city work "
+                          f"({cpu_time / wall_time if wall_time > 0 else 0:.1f}x parallel speedup)")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from streets.osm import import_osm, reingest_osm
+from streets.simplify import materialize_simplified_edges
+
+
+class Command(BaseCommand):
+    help = "Import a city's street network from a local .osm or .osm.pbf extract, without network access."
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help="Name of an existing City")
+        parser.add_argument('osm_path', help="Path to the .osm or .osm.pbf extract")
+        parser.add_argument('--modality', default='drive', choices=['drive', 'walk', 'bike'],
+                            help="Network type; one-way tags are only honoured for drive")
+        parser.add_argument('--bbox', type=float, nargs=4, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                            help="Clip the extract to this lon/lat box; without it every street of the extract is held in memory")
+        parser.add_argument('--incremental', action='store_true',
+                            help="Only write the nodes and edges that changed since the last import")
+
+    def handle(self, *args, **options):
+        importer = reingest_osm if options['incremental'] else import_osm
+        result = importer(options['city'], options['osm_path'], modality=options['modality'], bbox=options['bbox'])
+        if result is None:
+            raise CommandError(f"City {options['city']} not found.")
+        materialize_simplified_edges(options['city'])
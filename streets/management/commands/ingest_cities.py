@@ -0,0 +1,150 @@
+import contextlib
+import io
+import os
+import time
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+
+from streets.data import city_info
+from streets.ingest import format_diff, save_graphml, reingest_graphml
+from streets.models import City, GeoAreaMapping
+from streets.parallel import run_city_jobs, default_workers
+from streets.simplify import materialize_simplified_edges
+from streets.staging import staged_save_graphml
+
+
+def _ingest_city(city_name: str, graphml_path: str, city_defaults: dict = None, verbose: bool = False,
+                 mode: str = 'bulk', materialize: bool = True):
+    loaders = {'bulk': save_graphml, 'incremental': reingest_graphml, 'staged': staged_save_graphml}
+    start = time.perf_counter()
+    log = io.StringIO()
+    try:
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(log):
+            if city_defaults:
+                City.objects.get_or_create(
+                    name=city_name,
+                    defaults={
+                        'country': city_defaults['country'],
+                        'geo_area': GeoAreaMapping.objects.get(geo_area=city_defaults['geo_area']),
+                    }
+                )
+            result = loaders[mode](city_name, graphml_path)
+            if result is not None and materialize:
+                materialize_simplified_edges(city_name)
+        if result is None:
+            raise ValueError(f"City {city_name} not found.")
+    except Exception:
+        return {
+            'city': city_name,
+            'ok': False,
+            'error': log.getvalue()[-2000:] + traceback.format_exc(),
+            'seconds': time.perf_counter() - start,
+        }
+
+    if isinstance(result, dict):
+        return {
+            'city': city_name,
+            'ok': True,
+            'nodes': sum(result['nodes'][k] for k in ('inserted', 'updated', 'deleted')),
+            'edges': sum(result['edges'][k] for k in ('inserted', 'updated', 'deleted')),
+            'skipped': result['nodes']['skipped'] + result['edges']['skipped'],
+            'diff': result,
+            'seconds': time.perf_counter() - start,
+        }
+
+    (nodes_created, nodes_skipped), (edges_created, edges_skipped) = result
+    return {
+        'city': city_name,
+        'ok': True,
+        'nodes': nodes_created,
+        'edges': edges_created,
+        'skipped': nodes_skipped + edges_skipped,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingest the street networks of several cities from GraphML files in parallel. "
+        "Files are given as PATH (city name taken from the file name) or NAME=PATH; "
+        "--city-info ingests every city listed in streets/data.py from --graphml-dir."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('graphml', nargs='*', help="GraphML files, as PATH or NAME=PATH")
+        parser.add_argument('--city-info', action='store_true',
+                            help="Ingest the cities of streets.data.city_info, creating missing City rows")
+        parser.add_argument('--graphml-dir', default='.',
+                            help="Directory holding <city name>.graphml files for --city-info")
+        parser.add_argument('--workers', type=int, default=default_workers(),
+                            help="Number of worker processes (default: number of CPUs)")
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--incremental', action='store_const', dest='mode', const='incremental',
+                          help="Diff against the stored graph and only write changed nodes and edges")
+        mode.add_argument('--staged', action='store_const', dest='mode', const='staged',
+                          help="Load into per-city staging tables and publish them in one transaction")
+        parser.set_defaults(mode='bulk')
+        parser.add_argument('--no-simplify', action='store_true',
+                            help="Skip materializing the simplified edge geometries after ingest")
+
+    def _jobs(self, options):
+        jobs = []
+        for arg in options['graphml']:
+            if '=' in arg:
+                city_name, path = arg.split('=', 1)
+            else:
+                path = arg
+                city_name = os.path.splitext(os.path.basename(path))[0]
+            jobs.append((city_name, path, None))
+
+        if options['city_info']:
+            for info in city_info:
+                path = os.path.join(options['graphml_dir'], f"{info['name']}.graphml")
+                jobs.append((info['name'], path, info))
+
+        return jobs
+
+    def handle(self, *args, **options):
+        jobs = self._jobs(options)
+        if not jobs:
+            raise CommandError("Give at least one GraphML file or --city-info.")
+
+        workers = max(1, min(options['workers'], len(jobs)))
+        verbose = options['verbosity'] > 1
+        self.stdout.write(f"Ingesting {len(jobs)} cities with {workers} worker(s)...")
+
+        results = []
+        wall_start = time.perf_counter()
+        pool_jobs = [(city_name, path, info, verbose, options['mode'], not options['no_simplify'])
+                     for city_name, path, info in jobs]
+        for done, (job, result) in enumerate(run_city_jobs(_ingest_city, pool_jobs, workers), start=1):
+            city_name = job[0]
+            result.setdefault('city', city_name)
+            results.append(result)
+
+            if result['ok'] and 'diff' in result:
+                self.stdout.write(
+                    f"[{done}/{len(jobs)}] {city_name}: {format_diff(result['diff'])} "
+                    f"in {result['seconds']:.1f}s"
+                )
+            elif result['ok']:
+                self.stdout.write(
+                    f"[{done}/{len(jobs)}] {city_name}: {result['nodes']} nodes, {result['edges']} edges "
+                    f"created, {result['skipped']} skipped in {result['seconds']:.1f}s"
+                )
+            else:
+                self.stderr.write(f"[{done}/{len(jobs)}] {city_name}: FAILED after {result['seconds']:.1f}s")
+                self.stderr.write(result['error'])
+        wall_time = time.perf_counter() - wall_start
+
+        succeeded = [r for r in results if r['ok']]
+        failed = [r['city'] for r in results if not r['ok']]
+        rows = sum(r['nodes'] + r['edges'] for r in succeeded)
+        rate = rows / wall_time if wall_time > 0 else 0
+
+        self.stdout.write("")
+        self.stdout.write(f"Cities ingested: {len(succeeded)}, failed: {len(failed)}")
+        self.stdout.write(f"Rows {'created' if options['mode'] == 'bulk' else 'written'}: {rows} in {wall_time:.1f}s wall time ({rate:,.0f} rows/s)")
+        if failed:
+            self.stdout.write(f"Failed cities: {', '.join(sorted(failed))}")
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from streets.models import City
+from streets.routing import prepare_routing
+
+
+class Command(BaseCommand):
+    help = "Build the contraction hierarchies used by the routing API for the given cities (default: all)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('cities', nargs='*', help="City names")
+
+    def handle(self, *args, **options):
+        cities = City.objects.all()
+        if options['cities']:
+            cities = cities.filter(name__in=options['cities'])
+
+        for city in cities:
+            start = time.perf_counter()
+            version = prepare_routing(city, verbose=options['verbosity'] > 1)
+            if version is None:
+                self.stderr.write(f"{city.name}: the graph changed while contracting, run again")
+                continue
+            self.stdout.write(f"{city.name}: routing ready for v{version} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from streets.models import City
+from streets.registry import METRICS, evaluate_metrics
+
+
+class Command(BaseCommand):
+    help = "Evaluate registered metrics for one city and show the time spent per intermediate and per metric."
+
+    def add_arguments(self, parser):
+        parser.add_argument('city', help="City name")
+        parser.add_argument('--metrics', nargs='+', help="Metric codes to evaluate (default: all)")
+
+    def handle(self, *args, **options):
+        try:
+            city = City.objects.get(name=options['city'])
+        except City.DoesNotExist:
+            raise CommandError(f"City {options['city']} not found.")
+
+        try:
+            values, timings = evaluate_metrics(city, options['metrics'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Intermediates:")
+        for name, seconds in timings['intermediates'].items():
+            self.stdout.write(f"  {name:<20} {seconds * 1000:10.1f} ms")
+
+        self.stdout.write("Metrics:")
+        for code, seconds in timings['metrics'].items():
+            spec = METRICS[code]
+            value = values[f"{code}_{spec['types'][0]}"]
+            self.stdout.write(f"  {code:<5} {spec['description'] or '':<35} {value:14.6f} {seconds * 1000:10.1f} ms")
+
+        total = sum(timings['metrics'].values())
+        self.stdout.write(f"Total {total * 1000:.1f} ms")
@@ -0,0 +1,58 @@
+from math import isclose
+
+from django.core.management.base import BaseCommand
+
+from streets.aggregates import city_graph_sums, combine, rebuild_aggregate, SUM_FIELDS
+from streets.models import City, CityAggregate
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the incrementally maintained metric aggregates of the given cities (default: all) "
+        "against a full recompute, and optionally rebuild the ones that drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('cities', nargs='*', help="City names")
+        parser.add_argument('--fix', action='store_true', help="Rebuild aggregates that do not match")
+        parser.add_argument('--tolerance', type=float, default=1e-9,
+                            help="Relative tolerance for the floating point sums")
+
+    def handle(self, *args, **options):
+        cities = City.objects.order_by('name')
+        if options['cities']:
+            cities = cities.filter(name__in=options['cities'])
+
+        mismatched = 0
+        for city in cities:
+            aggregate = CityAggregate.objects.filter(city=city).first()
+            if aggregate is None or aggregate.graph_version != city.graph_version:
+                self.stdout.write(f"{city.name:<20} stale (rebuilt on next read)")
+                continue
+
+            expected = CityAggregate(city=city)
+            combine(expected, city_graph_sums(city))
+            problems = [
+                field for field in SUM_FIELDS
+                if not isclose(getattr(aggregate, field), getattr(expected, field),
+                               rel_tol=options['tolerance'], abs_tol=options['tolerance'])
+            ]
+            problems += [
+                field for field in ('bearing_bins', 'degree_counts', 'mode_counts')
+                if getattr(aggregate, field) != getattr(expected, field)
+            ]
+
+            if not problems:
+                self.stdout.write(f"{city.name:<20} ok")
+                continue
+
+            mismatched += 1
+            self.stdout.write(f"{city.name:<20} MISMATCH in {', '.join(problems)}")
+            for field in problems:
+                self.stdout.write(f"    {field}: stored {getattr(aggregate, field)!r}, "
+                                  f"recomputed {getattr(expected, field)!r}")
+            if options['fix']:
+                rebuild_aggregate(city)
+                self.stdout.write("    rebuilt")
+
+        self.stdout.write(f"{mismatched} city aggregate(s) did not match")
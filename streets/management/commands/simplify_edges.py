@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from streets.models import City
+from streets.simplify import materialize_simplified_edges
+
+
+class Command(BaseCommand):
+    help = (
+        "Materialize the simplified edge geometries served by /geojson/edges/?zoom= "
+        "for the given cities (default: all)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('cities', nargs='*', help="City names")
+
+    def handle(self, *args, **options):
+        cities = City.objects.all()
+        if options['cities']:
+            cities = cities.filter(name__in=options['cities'])
+
+        for city in cities:
+            start = time.perf_counter()
+            version = materialize_simplified_edges(city, verbose=options['verbosity'] > 1)
+            self.stdout.write(f"{city.name}: simplified edges ready for v{version} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,325 @@
+from math import log
+
+import numpy as np
+from django.db import connection
+
+from .models import City, Node, Edge
+
+EARTH_RADIUS_M = 6371000
+
+
+def get_built_up_area_km2(city):
+    # City.built_up_area_km2 was dropped in migration 0008; fall back to the
+    # figures kept alongside the city list in streets/data.py
+    area = getattr(city, 'built_up_area_km2', None)
+    if area is None:
+        from .data import city_info
+        area = next((info['built_up_area_km2'] for info in city_info if info['name'] == city.name), 0)
+    return area
+
+
+def node_elevation(node):
+    # Node.elevation was dropped in migration 0007
+    return getattr(node, 'elevation', None)
+
+
+def edge_data(edge):
+    # Edge.data was dropped in migration 0006
+    return getattr(edge, 'data', None) or {}
+
+
+def edge_has_data_field():
+    return any(field.name == 'data' for field in Edge._meta.get_fields())
+
+
+def count_edges_by_mode(city, mode):
+    if not edge_has_data_field():
+        return 0
+    return Edge.objects.filter(city=city, data__mode=mode).count()
+
+
+EDGE_ARRAYS_SQL = """
+    SELECT e.start_node_id, e.end_node_id,
+           ST_Length(e.geom::geometry),
+           ST_X(ST_StartPoint(e.geom::geometry)), ST_Y(ST_StartPoint(e.geom::geometry)),
+           ST_X(ST_EndPoint(e.geom::geometry)), ST_Y(ST_EndPoint(e.geom::geometry)),
+           ST_X(s.geom::geometry), ST_Y(s.geom::geometry),
+           ST_X(t.geom::geometry), ST_Y(t.geom::geometry)
+    FROM {edge_table} e
+    JOIN {node_table} s ON s.osm_id = e.start_node_id
+    JOIN {node_table} t ON t.osm_id = e.end_node_id
+    WHERE e.city_id = %s
+"""
+
+
+def _fetch_edge_arrays(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(edge_table=Edge._meta.db_table, node_table=Node._meta.db_table), params)
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 11)
+
+    edge_count = len(rows)
+    return {
+        'start_node': rows[:, 0].astype(np.int64),
+        'end_node': rows[:, 1].astype(np.int64),
+        'length': rows[:, 2],
+        'geom_start': rows[:, 3:5],
+        'geom_end': rows[:, 5:7],
+        'start_xy': rows[:, 7:9],
+        'end_xy': rows[:, 9:11],
+        # Elevation and edge attributes are not stored any more: the arrays
+        # hold the values the per-edge code falls back to when they are missing
+        'start_elevation': np.full(edge_count, np.nan),
+        'end_elevation': np.full(edge_count, np.nan),
+        'speed_limit': np.zeros(edge_count),
+        'mode': np.full(edge_count, None, dtype=object),
+    }
+
+
+def load_city_arrays(city):
+    """
+    Load everything the metrics need for one city in two queries: one row per
+    edge with its endpoints, planar geometry length (the same value as GEOS
+    ``geom.length``), first/last vertex and endpoint node coordinates, plus the
+    osm_ids of all the city's nodes.
+    """
+    arrays = _fetch_edge_arrays(EDGE_ARRAYS_SQL + " ORDER BY e.id", [city.id])
+    arrays['node_ids'] = np.sort(np.fromiter(
+        Node.objects.filter(city=city).values_list('osm_id', flat=True), dtype=np.int64))
+    return arrays
+
+
+def load_incident_edge_arrays(city_id, node_ids):
+    """The ``load_city_arrays`` edge rows of a city's edges touching any of ``node_ids``."""
+    node_ids = list(node_ids)
+    return _fetch_edge_arrays(
+        EDGE_ARRAYS_SQL + " AND (e.start_node_id = ANY(%s) OR e.end_node_id = ANY(%s))",
+        [city_id, node_ids, node_ids],
+    )
+
+
+def haversine(lonlat1, lonlat2):
+    lon1, lat1 = np.radians(lonlat1[:, 0]), np.radians(lonlat1[:, 1])
+    lon2, lat2 = np.radians(lonlat2[:, 0]), np.radians(lonlat2[:, 1])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_M
+
+
+def bearings(lonlat1, lonlat2):
+    lon1, lat1 = np.radians(lonlat1[:, 0]), np.radians(lonlat1[:, 1])
+    lon2, lat2 = np.radians(lonlat2[:, 0]), np.radians(lonlat2[:, 1])
+    dlon = lon2 - lon1
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def node_degrees(node_ids, start_node, end_node):
+    """Number of edge endpoints at each node of ``node_ids`` (sorted)."""
+    degrees = np.zeros(len(node_ids), dtype=np.int64)
+    for endpoint in (start_node, end_node):
+        index = np.searchsorted(node_ids, endpoint)
+        index[index == len(node_ids)] = 0
+        known = node_ids[index] == endpoint if len(node_ids) else np.zeros(len(endpoint), dtype=bool)
+        degrees += np.bincount(index[known], minlength=len(node_ids))
+    return degrees
+
+
+def _scores(speed_limit, has_access, low_speed_without_access):
+    # Vectorized calculate_biking_score / calculate_walking_score
+    known = ~np.isnan(speed_limit)
+    with_access = np.select([speed_limit <= 30, speed_limit <= 50], [1.0, 0.8], 0.6)
+    without_access = np.where(speed_limit <= 30, low_speed_without_access, 0.3)
+    return np.where(known, np.where(has_access, with_access, without_access), np.where(has_access, 0.7, 0.3))
+
+
+def _mean(values):
+    return float(values.sum() / len(values)) if len(values) else 0
+
+
+def metrics_dict(average_circuity, entropy, road_density, average_steepness, average_street_length,
+                 intersection_density, walking_driving_ratio, biking_driving_ratio, average_walking_score,
+                 average_biking_score, connectivity, connectivity_std):
+    return {
+        'CIR_walk': average_circuity,
+        'CIR_bike': average_circuity,
+        'ORE_walk': entropy,
+        'ORE_bike': entropy,
+        'RDE_walk': road_density,
+        'RDE_bike': road_density,
+        'AST_walk': average_steepness,
+        'AST_bike': average_steepness,
+        'ASL_walk': average_street_length,
+        'ASL_bike': average_street_length,
+        'IND_walk': intersection_density,
+        'IND_bike': intersection_density,
+        'WDR_walk': walking_driving_ratio,
+        'BDR_bike': biking_driving_ratio,
+        'AWS_walk': average_walking_score,
+        'ABS_bike': average_biking_score,
+        'ACO_walk': connectivity,
+        'ACO_bike': connectivity,
+        'SCO_walk': connectivity_std,
+        'SCO_bike': connectivity_std,
+    }
+
+
+def entropy_from_counts(angle_counts):
+    total = sum(angle_counts)
+    return -sum((count / total) * log(count / total) for count in angle_counts if count > 0)
+
+
+def compute_urban_metrics(arrays, built_up_area_km2):
+    edge_count = len(arrays['length'])
+    length = arrays['length']
+
+    # 1. Average Circuity
+    straight = haversine(arrays['start_xy'], arrays['end_xy'])
+    positive = straight > 0
+    average_circuity = _mean(length[positive] / straight[positive])
+
+    # 2. Orientation Entropy
+    angle_index = np.minimum((bearings(arrays['geom_start'], arrays['geom_end']) // 10).astype(np.int64), 35)
+    entropy = entropy_from_counts(np.bincount(angle_index, minlength=36).tolist())
+
+    # 3. Road Density
+    road_density = edge_count / built_up_area_km2 if built_up_area_km2 > 0 else 0
+
+    # 4. Average Steepness
+    elevation_difference = np.abs(arrays['start_elevation'] - arrays['end_elevation'])
+    elevation_difference[np.isnan(elevation_difference)] = 0
+    has_length = length > 0
+    average_steepness = _mean(elevation_difference[has_length] / length[has_length])
+
+    # 5. Average Street Length
+    average_street_length = _mean(length)
+
+    # 6. Intersection Density / 11. Connectivity
+    degrees = node_degrees(arrays['node_ids'], arrays['start_node'], arrays['end_node'])
+    intersection_count = int((degrees >= 3).sum())
+    intersection_density = intersection_count / built_up_area_km2 if built_up_area_km2 > 0 else 0
+    connectivity = _mean(degrees)
+    connectivity_std = np.std(degrees) if len(degrees) else 0
+
+    # 7./8. Walking and Biking to Driving Segments Ratio
+    mode = arrays['mode']
+    walking = mode == 'pedestrian'
+    cycling = mode == 'cycling'
+    driving_edges = int((mode == 'driving').sum())
+    walking_driving_ratio = int(walking.sum()) / driving_edges if driving_edges > 0 else 0
+    biking_driving_ratio = int(cycling.sum()) / driving_edges if driving_edges > 0 else 0
+
+    # 9./10. Average Biking and Walking Score
+    average_biking_score = _mean(_scores(arrays['speed_limit'], cycling, 0.6))
+    average_walking_score = _mean(_scores(arrays['speed_limit'], walking, 0.5))
+
+    return metrics_dict(
+        average_circuity, entropy, road_density, average_steepness, average_street_length, intersection_density,
+        walking_driving_ratio, biking_driving_ratio, average_walking_score, average_biking_score,
+        connectivity, connectivity_std,
+    )
+
+
+def calculate_urban_metrics_vectorized(city_name: str):
+    city = City.objects.get(name=city_name)
+    return compute_urban_metrics(load_city_arrays(city), get_built_up_area_km2(city))
+
+
+# The same formulas as the NumPy engine, evaluated inside PostGIS. Haversine and
+# the initial bearing are spelled out rather than using ST_Distance/ST_Azimuth,
+# which work on a different sphere/spheroid and would shift the results.
+EDGE_MEASURES_SQL = """
+    WITH edges AS (
+        SELECT ST_Length(e.geom::geometry) AS length,
+               radians(ST_X(s.geom::geometry)) AS lon1, radians(ST_Y(s.geom::geometry)) AS lat1,
+               radians(ST_X(t.geom::geometry)) AS lon2, radians(ST_Y(t.geom::geometry)) AS lat2,
+               radians(ST_X(ST_StartPoint(e.geom::geometry))) AS glon1,
+               radians(ST_Y(ST_StartPoint(e.geom::geometry))) AS glat1,
+               radians(ST_X(ST_EndPoint(e.geom::geometry))) AS glon2,
+               radians(ST_Y(ST_EndPoint(e.geom::geometry))) AS glat2
+        FROM {edge_table} e
+        JOIN {node_table} s ON s.osm_id = e.start_node_id
+        JOIN {node_table} t ON t.osm_id = e.end_node_id
+        WHERE e.city_id = %(city_id)s
+    ), measures AS (
+        SELECT length,
+               2 * asin(sqrt(power(sin((lat2 - lat1) / 2), 2)
+                             + cos(lat1) * cos(lat2) * power(sin((lon2 - lon1) / 2), 2))) * {radius} AS straight,
+               degrees(atan2(sin(glon2 - glon1) * cos(glat2),
+                             cos(glat1) * sin(glat2) - sin(glat1) * cos(glat2) * cos(glon2 - glon1))) + 360 AS bearing
+        FROM edges
+    )
+"""
+
+EDGE_AGGREGATES_SQL = EDGE_MEASURES_SQL + """
+    SELECT count(*),
+           coalesce(sum(length), 0),
+           avg(length / straight) FILTER (WHERE straight > 0),
+           -- elevation is no longer stored, so every edge with a length is flat
+           avg(0.0::float8) FILTER (WHERE length > 0)
+    FROM measures
+"""
+
+BEARING_HISTOGRAM_SQL = EDGE_MEASURES_SQL + """
+    SELECT LEAST(floor((bearing - 360 * floor(bearing / 360)) / 10)::int, 35) AS bin, count(*)
+    FROM measures
+    GROUP BY bin
+"""
+
+NODE_DEGREE_SQL = """
+    SELECT count(*),
+           -- sum() of a bigint is numeric, which psycopg2 returns as Decimal
+           coalesce(sum(degree), 0)::float8,
+           count(*) FILTER (WHERE degree >= 3),
+           stddev_pop(degree::float8)
+    FROM (
+        SELECT n.osm_id, count(endpoint.node_id) AS degree
+        FROM {node_table} n
+        LEFT JOIN (
+            SELECT start_node_id AS node_id FROM {edge_table} WHERE city_id = %(city_id)s
+            UNION ALL
+            SELECT end_node_id FROM {edge_table} WHERE city_id = %(city_id)s
+        ) endpoint ON endpoint.node_id = n.osm_id
+        WHERE n.city_id = %(city_id)s
+        GROUP BY n.osm_id
+    ) degrees
+"""
+
+
+def _run_sql(cursor, sql, city):
+    cursor.execute(
+        sql.format(edge_table=Edge._meta.db_table, node_table=Node._meta.db_table, radius=EARTH_RADIUS_M),
+        {'city_id': city.id},
+    )
+    return cursor.fetchall()
+
+
+def calculate_urban_metrics_sql(city_name: str):
+    """
+    Compute the urban metrics with aggregates inside PostGIS. Only a few dozen
+    numbers leave the database, whatever the size of the city.
+    """
+    city = City.objects.get(name=city_name)
+    built_up_area_km2 = get_built_up_area_km2(city)
+
+    with connection.cursor() as cursor:
+        [(edge_count, total_length, average_circuity, average_steepness)] = _run_sql(cursor, EDGE_AGGREGATES_SQL, city)
+        bins = dict(_run_sql(cursor, BEARING_HISTOGRAM_SQL, city))
+        [(node_count, total_degree, intersection_count, connectivity_std)] = _run_sql(cursor, NODE_DEGREE_SQL, city)
+
+    entropy = entropy_from_counts([bins.get(i, 0) for i in range(36)])
+    road_density = edge_count / built_up_area_km2 if built_up_area_km2 > 0 else 0
+    average_street_length = total_length / edge_count if edge_count > 0 else 0
+    intersection_density = intersection_count / built_up_area_km2 if built_up_area_km2 > 0 else 0
+    connectivity = total_degree / node_count if node_count > 0 else 0
+
+    # Edge modes and speed limits are not stored (Edge.data was dropped), so
+    # no edge is walking/cycling/driving and every edge scores like speed 0
+    walking_driving_ratio = biking_driving_ratio = 0
+    average_biking_score = float(_scores(np.zeros(1), np.zeros(1, dtype=bool), 0.6)[0]) if edge_count else 0
+    average_walking_score = float(_scores(np.zeros(1), np.zeros(1, dtype=bool), 0.5)[0]) if edge_count else 0
+
+    return metrics_dict(
+        average_circuity or 0, entropy, road_density, average_steepness or 0, average_street_length,
+        intersection_density, walking_driving_ratio, biking_driving_ratio, average_walking_score,
+        average_biking_score, connectivity, connectivity_std or 0,
+    )
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.7 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0009_alter_metric_type"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="city",
+            name="graph_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="city",
+            name="graph_updated_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
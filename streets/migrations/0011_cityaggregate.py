@@ -0,0 +1,41 @@
+# Generated by Django 5.1.7 on 2026-10-18 14:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0010_city_graph_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CityAggregate",
+            fields=[
+                (
+                    "city",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="aggregate",
+                        serialize=False,
+                        to="streets.city",
+                    ),
+                ),
+                ("graph_version", models.PositiveIntegerField(default=0)),
+                ("edge_count", models.BigIntegerField(default=0)),
+                ("total_length", models.FloatField(default=0)),
+                ("circuity_sum", models.FloatField(default=0)),
+                ("circuity_count", models.BigIntegerField(default=0)),
+                ("steepness_sum", models.FloatField(default=0)),
+                ("steepness_count", models.BigIntegerField(default=0)),
+                ("walking_score_sum", models.FloatField(default=0)),
+                ("biking_score_sum", models.FloatField(default=0)),
+                ("bearing_bins", models.JSONField(default=list)),
+                ("degree_counts", models.JSONField(default=dict)),
+                ("mode_counts", models.JSONField(default=dict)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+CENTRALITY_METRICS = ["BET", "BMX", "CLO"]
+
+
+def add_centrality_metrics(apps, schema_editor):
+    Metric = apps.get_model("streets", "Metric")
+    for name in CENTRALITY_METRICS:
+        for metric_type in ["walk", "bike"]:
+            Metric.objects.get_or_create(name=name, type=metric_type)
+
+
+def remove_centrality_metrics(apps, schema_editor):
+    Metric = apps.get_model("streets", "Metric")
+    Metric.objects.filter(name__in=CENTRALITY_METRICS).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0011_cityaggregate"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_centrality_metrics, remove_centrality_metrics),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def add_network_circuity_metric(apps, schema_editor):
+    Metric = apps.get_model("streets", "Metric")
+    for metric_type in ["walk", "bike"]:
+        Metric.objects.get_or_create(name="NCI", type=metric_type)
+
+
+def remove_network_circuity_metric(apps, schema_editor):
+    Metric = apps.get_model("streets", "Metric")
+    Metric.objects.filter(name="NCI").delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0012_centrality_metrics"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_network_circuity_metric, remove_network_circuity_metric),
+    ]
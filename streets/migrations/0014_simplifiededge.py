@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-18 16:00
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0013_network_circuity_metric"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SimplifiedEdge",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("zoom", models.PositiveSmallIntegerField()),
+                ("graph_version", models.PositiveIntegerField()),
+                ("geom", django.contrib.gis.db.models.fields.LineStringField(srid=4326)),
+                (
+                    "city",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="streets.city"),
+                ),
+                (
+                    "edge",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="simplified",
+                        to="streets.edge",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["city", "zoom", "graph_version"], name="streets_sim_city_id_deecc1_idx"),
+                ],
+                "constraints": [
+                    models.UniqueConstraint(fields=("edge", "zoom"), name="unique_simplified_edge_zoom"),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0014_simplifiededge"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="metricvalue",
+            index=models.Index(fields=["datetime", "id"], name="streets_met_datetim_eb38c6_idx"),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+def clear_simplified_edges(apps, schema_editor):
+    # Rebuilt by the next ingest or `manage.py simplify_edges`; until then edges are simplified on the fly
+    apps.get_model("streets", "SimplifiedEdge").objects.all().delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("streets", "0015_metricvalue_datetime_id_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_simplified_edges, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name="simplifiededge",
+            name="unique_simplified_edge_zoom",
+        ),
+        migrations.RemoveField(
+            model_name="simplifiededge",
+            name="edge",
+        ),
+        migrations.AddField(
+            model_name="simplifiededge",
+            name="edge_id",
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddConstraint(
+            model_name="simplifiededge",
+            constraint=models.UniqueConstraint(fields=("edge_id", "zoom"), name="unique_simplified_edge_id_zoom"),
+        ),
+    ]
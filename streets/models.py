@@ -1,5 +1,7 @@
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import MultiPolygon
+from django.db.models import F
+from django.utils import timezone
 
 
 class GeoAreaMapping(models.Model):
@@ -15,10 +17,20 @@ class City(models.Model):
     name = models.CharField(max_length=255, unique=True)
     country = models.CharField(max_length=255)
     geo_area = models.ForeignKey(GeoAreaMapping, on_delete=models.CASCADE)
+    graph_version = models.PositiveIntegerField(default=0, editable=False)
+    graph_updated_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def bump_graph_version(cls, *city_ids):
+        # Called by every code path that writes Node/Edge rows of a city
+        cls.objects.filter(pk__in=city_ids).update(
+            graph_version=F('graph_version') + 1,
+            graph_updated_at=timezone.now(),
+        )
+
 
 class Metric(models.Model):
     METRICS_TYPES = [
@@ -45,11 +57,42 @@ class MetricValue(models.Model):
 
     class Meta:
         unique_together = ('metric', 'city', 'datetime')
+        indexes = [
+            # Keyset pagination of the metric value API
+            models.Index(fields=['datetime', 'id']),
+        ]
 
     def __str__(self):
         return f"{self.city.name} - {self.metric.name} at {self.datetime}"
 
 
+class CityAggregate(models.Model):
+    """
+    Running sums the urban metrics are derived from, kept up to date as the
+    city's nodes and edges are written. Only valid while ``graph_version``
+    equals the city's.
+    """
+    city = models.OneToOneField(City, on_delete=models.CASCADE, primary_key=True, related_name='aggregate')
+    graph_version = models.PositiveIntegerField(default=0)
+    edge_count = models.BigIntegerField(default=0)
+    total_length = models.FloatField(default=0)
+    circuity_sum = models.FloatField(default=0)
+    circuity_count = models.BigIntegerField(default=0)
+    steepness_sum = models.FloatField(default=0)
+    steepness_count = models.BigIntegerField(default=0)
+    walking_score_sum = models.FloatField(default=0)
+    biking_score_sum = models.FloatField(default=0)
+    bearing_bins = models.JSONField(default=list)
+    degree_counts = models.JSONField(default=dict)
+    mode_counts = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Aggregates of {self.city.name} at graph version {self.graph_version}"
+
+
+# Every write to Node or Edge rows must call City.bump_graph_version for the cities it touches:
+# the graph version backs the API's ETags, snapshots and tile cache, and no signal bumps it
 class Node(models.Model):
     city = models.ForeignKey(City, on_delete=models.CASCADE, verbose_name="City")
     osm_id = models.BigIntegerField(primary_key=True)
@@ -59,6 +102,7 @@ class Node(models.Model):
         return f"Node {self.id} in  {self.city.name}"
 
 
+# Writes must bump the city's graph version, see Node
 class Edge(models.Model):
     city = models.ForeignKey('City', on_delete=models.CASCADE, verbose_name="City")
     start_node = models.ForeignKey('Node', on_delete=models.CASCADE, related_name='start_edges')
@@ -77,6 +121,32 @@ class Edge(models.Model):
         return f"Edge {self.id} in {self.city.name}: {self.start_node.id} → {self.end_node.id}"
 
 
+class SimplifiedEdge(models.Model):
+    """
+    An edge geometry simplified for drawing from ``zoom`` up to the next
+    level, materialized after ingest. Rows are only used while
+    ``graph_version`` equals the city's.
+    """
+    # Not a foreign key: rows of deleted edges are stale by graph version anyway, and a
+    # constraint would block the raw edge deletes of staged publishing
+    edge_id = models.BigIntegerField()
+    city = models.ForeignKey(City, on_delete=models.CASCADE)
+    zoom = models.PositiveSmallIntegerField()
+    graph_version = models.PositiveIntegerField()
+    geom = models.LineStringField(srid=4326)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['edge_id', 'zoom'], name='unique_simplified_edge_id_zoom')
+        ]
+        indexes = [
+            models.Index(fields=['city', 'zoom', 'graph_version']),
+        ]
+
+    def __str__(self):
+        return f"Edge {self.edge_id} simplified for zoom {self.zoom}"
+
+
 #
 # class Node(models.Model):
 #     city = models.ForeignKey(City, on_delete=models.CASCADE, verbose_name="City")
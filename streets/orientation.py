@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import tempfile
+from math import log
+
+import numpy as np
+import shapely
+
+from .graph import get_versioned_city_graph, snapshot_root
+from .metrics import bearings
+
+MAX_BINS = 360
+
+
+def orientation_histogram(bearing, weights=None, bins: int = 36, undirected: bool = False):
+    """
+    Histogram of compass bearings in degrees. With ``undirected`` a street and
+    its reverse count as the same orientation: bearings are folded onto
+    [0, 180). ``weights`` (e.g. edge lengths) replace the per-edge count.
+    Returns the bin edges and the (weighted) counts.
+    """
+    span = 180.0 if undirected else 360.0
+    folded = np.mod(bearing, span)
+    # Floating point can leave exactly `span` after the modulo; it belongs in the last bin
+    index = np.minimum((folded // (span / bins)).astype(np.int64), bins - 1)
+    counts = np.bincount(index, weights=weights, minlength=bins)
+    return np.linspace(0, span, bins + 1), counts
+
+
+def histogram_entropy(counts):
+    total = float(np.sum(counts))
+    if total <= 0:
+        return 0.0
+    p = np.asarray(counts, dtype=np.float64) / total
+    p = p[p > 0]
+    return float(-(p * np.log(p)).sum())
+
+
+def region_mask(lonlat, bbox=None, polygon=None):
+    """Which points lie inside a ``(west, south, east, north)`` bbox and/or a shapely polygon."""
+    mask = np.ones(len(lonlat), dtype=bool)
+    if bbox is not None:
+        west, south, east, north = bbox
+        mask &= (lonlat[:, 0] >= west) & (lonlat[:, 0] <= east) & (lonlat[:, 1] >= south) & (lonlat[:, 1] <= north)
+    if polygon is not None:
+        mask &= shapely.contains_xy(polygon, lonlat[:, 0], lonlat[:, 1])
+    return mask
+
+
+def graph_orientation(graph, bins: int = 36, undirected: bool = False, weighted: bool = False,
+                      bbox=None, polygon=None):
+    """
+    Street orientation of a ``CityGraph``, all edges at once. Each edge is
+    assigned to a region by its midpoint; with ``weighted`` it counts by its
+    length in meters instead of once.
+    """
+    start, end = graph.coords[graph.sources], graph.coords[graph.neighbors]
+    mask = region_mask((start + end) / 2, bbox, polygon)
+    bearing = bearings(start[mask], end[mask])
+    weights = np.asarray(graph.lengths)[mask] if weighted else None
+
+    edges, counts = orientation_histogram(bearing, weights, bins, undirected)
+    entropy = histogram_entropy(counts)
+    max_entropy = log(bins)
+    # A perfect grid fills 4 directed (2 undirected) bins equally
+    grid_entropy = log(2 if undirected else 4)
+    return {
+        'bins': bins,
+        'undirected': undirected,
+        'weighted': weighted,
+        'bin_edges': edges.tolist(),
+        'counts': counts.tolist(),
+        'edge_count': int(mask.sum()),
+        'entropy': entropy,
+        'max_entropy': max_entropy,
+        # Orientation order (Boeing 2019): 0 for uniformly spread streets, 1 for a perfect grid
+        'order': 1 - ((entropy - grid_entropy) / (max_entropy - grid_entropy)) ** 2
+        if max_entropy > grid_entropy else 0.0,
+    }
+
+
+def _cache_key(bins, undirected, weighted):
+    return hashlib.md5(json.dumps([bins, undirected, weighted]).encode()).hexdigest()
+
+
+def city_orientation(city, bins: int = 36, undirected: bool = False, weighted: bool = False,
+                     bbox=None, polygon=None):
+    """
+    ``graph_orientation`` of a city's current graph. Whole-city histograms
+    are cached as JSON next to its graph snapshot, so polar plots are served
+    without recomputation and the cache disappears with the snapshot when
+    the graph changes. Regions are computed on every call: there is no
+    bound on how many different ones can be asked for.
+    """
+    if not 1 <= bins <= MAX_BINS:
+        raise ValueError(f"'bins' must be between 1 and {MAX_BINS}.")
+    graph_version, graph = get_versioned_city_graph(city)
+    if bbox is not None or polygon is not None:
+        result = graph_orientation(graph, bins, undirected, weighted, bbox, polygon)
+        result['graph_version'] = graph_version
+        return result
+
+    cache_dir = snapshot_root(graph.city_id) / f"v{graph_version}" / "orientation"
+    cache_file = cache_dir / f"{_cache_key(bins, undirected, weighted)}.json"
+
+    try:
+        return json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        pass
+
+    result = graph_orientation(graph, bins, undirected, weighted)
+    result['graph_version'] = graph_version
+
+    # Only cache next to a published snapshot, or it would never be cleaned up
+    if (cache_dir.parent / "meta.json").exists():
+        cache_dir.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp, cache_file)
+    return result
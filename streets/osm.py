@@ -0,0 +1,217 @@
+from collections import Counter
+from xml.etree.ElementTree import iterparse
+
+from django.contrib.gis.geos import LineString
+
+from .ingest import upsert_nodes, upsert_edges, apply_graph_diff, format_diff
+from .models import City
+from .utils import highway_type_mapping
+
+ONEWAY_VALUES = {'yes', 'true', '1'}
+REVERSED_ONEWAY_VALUES = {'-1', 'reverse'}
+
+# Ways each modality may use, after osmnx's drive/walk/bike network types
+MOTOR_ONLY_HIGHWAYS = {'motorway', 'motorway_link', 'trunk', 'trunk_link'}
+MODALITY_HIGHWAYS = {
+    'drive': set(highway_type_mapping) - {'track', 'path'},
+    'walk': set(highway_type_mapping) - MOTOR_ONLY_HIGHWAYS | {'footway', 'pedestrian', 'steps', 'corridor'},
+    'bike': set(highway_type_mapping) - MOTOR_ONLY_HIGHWAYS | {'cycleway', 'pedestrian'},
+}
+EXCLUDED_SERVICES = {
+    'drive': {'parking', 'parking_aisle', 'driveway', 'private', 'emergency_access'},
+    'walk': {'private'},
+    'bike': {'private'},
+}
+# Tags overriding the generic access tag for each modality
+MODALITY_ACCESS_TAGS = {
+    'drive': ('motor_vehicle', 'motorcar'),
+    'walk': ('foot',),
+    'bike': ('bicycle',),
+}
+NO_ACCESS = {'no', 'private'}
+GRANTED_ACCESS = {'yes', 'designated', 'permissive'}
+
+
+def _iter_osm_xml(osm_path: str, want_nodes: bool, want_ways: bool):
+    root = None
+    for event, elem in iterparse(osm_path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+
+        if elem.tag == 'node' and want_nodes:
+            yield 'node', int(elem.get('id')), (float(elem.get('lon')), float(elem.get('lat')))
+        elif elem.tag == 'way' and want_ways:
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            if 'highway' in tags:
+                yield 'way', int(elem.get('id')), ([int(nd.get('ref')) for nd in elem.iter('nd')], tags)
+        elif elem.tag not in ('node', 'way', 'relation'):
+            continue
+
+        elem.clear()
+        root.clear()
+
+
+def _iter_osm_pbf(osm_path: str, want_nodes: bool, want_ways: bool):
+    try:
+        import osmium
+    except ImportError as e:
+        raise ImportError("Reading .osm.pbf extracts requires pyosmium (pip install osmium).") from e
+
+    entities = (osmium.osm.NODE if want_nodes else 0) | (osmium.osm.WAY if want_ways else 0)
+    for obj in osmium.FileProcessor(osm_path, entities):
+        if obj.is_node():
+            if obj.location.valid():
+                yield 'node', obj.id, (obj.location.lon, obj.location.lat)
+        elif obj.is_way() and 'highway' in obj.tags:
+            tags = {tag.k: tag.v for tag in obj.tags}
+            yield 'way', obj.id, ([nd.ref for nd in obj.nodes], tags)
+
+
+def iter_osm(osm_path: str, want_nodes: bool = True, want_ways: bool = True):
+    """
+    Stream ``('node', id, (lon, lat))`` and ``('way', id, (refs, tags))`` records
+    from an ``.osm`` or ``.osm.pbf`` file. Only ways carrying a ``highway`` tag
+    are yielded.
+    """
+    if osm_path.endswith('.pbf'):
+        return _iter_osm_pbf(osm_path, want_nodes, want_ways)
+    return _iter_osm_xml(osm_path, want_nodes, want_ways)
+
+
+def _in_bbox(lon, lat, bbox):
+    west, south, east, north = bbox
+    return west <= lon <= east and south <= lat <= north
+
+
+def way_allowed(tags, modality: str):
+    """Whether a way with these tags belongs to the ``modality`` network."""
+    if tags.get('highway') not in MODALITY_HIGHWAYS[modality] or tags.get('area') == 'yes':
+        return False
+    if tags.get('service') in EXCLUDED_SERVICES[modality]:
+        return False
+    modality_access = [tags[key] for key in MODALITY_ACCESS_TAGS[modality] if key in tags]
+    if any(value in NO_ACCESS for value in modality_access):
+        return False
+    # e.g. access=no with foot=yes is still walkable
+    return tags.get('access') not in NO_ACCESS or any(value in GRANTED_ACCESS for value in modality_access)
+
+
+def read_osm_network(osm_path: str, modality: str = "drive", bbox=None):
+    """
+    Build the street network of an OSM extract in two streaming passes.
+
+    Ways are kept when ``way_allowed`` for the modality, by their ``highway``,
+    ``service`` and access tags, and split into edges at intersections, so
+    the result has the same topology as an osmnx graph. Ways leaving
+    ``bbox`` are cut at the box. With ``bbox`` only the nodes inside it and
+    the ways touching it are held in memory; without it, every kept way of
+    the extract and its nodes are, so large extracts need a ``bbox``.
+    Returns ``(nodes, edges)`` where ``nodes`` maps osm_id to ``(lon, lat)``
+    and ``edges`` is a list of ``(u, v, coords)``.
+    """
+    if modality not in MODALITY_HIGHWAYS:
+        raise ValueError(f"Unknown modality '{modality}'. Choose from: {', '.join(MODALITY_HIGHWAYS)}")
+    ways = []
+    if bbox is None:
+        # Ways first: only the coordinates of nodes referenced by streets are kept
+        for _, _, (refs, tags) in iter_osm(osm_path, want_nodes=False):
+            if way_allowed(tags, modality):
+                ways.append((refs, tags))
+        needed = {ref for refs, _ in ways for ref in refs}
+        coords = {osm_id: lonlat for _, osm_id, lonlat in iter_osm(osm_path, want_ways=False) if osm_id in needed}
+    else:
+        # Nodes first: the bbox bounds memory to the city, not to the extract
+        coords = {osm_id: lonlat for _, osm_id, lonlat in iter_osm(osm_path, want_ways=False)
+                  if _in_bbox(*lonlat, bbox)}
+        for _, _, (refs, tags) in iter_osm(osm_path, want_nodes=False):
+            if way_allowed(tags, modality) and any(ref in coords for ref in refs):
+                ways.append((refs, tags))
+        needed = {ref for refs, _ in ways for ref in refs}
+        coords = {osm_id: lonlat for osm_id, lonlat in coords.items() if osm_id in needed}
+
+    # A node ends an edge if it is a way endpoint, shared between ways or revisited;
+    # where a way leaves the extract or bbox, the nodes on either side of the gap end it too
+    usage = Counter()
+    for refs, _ in ways:
+        run = []
+        for ref in refs + [None]:
+            if ref in coords:
+                run.append(ref)
+                continue
+            usage.update(run)
+            if run:
+                usage[run[0]] += 1
+                usage[run[-1]] += 1
+            run = []
+
+    edges = []
+
+    def add_edge(segment, oneway):
+        line = [coords[r] for r in segment]
+        edges.append((segment[0], segment[-1], line))
+        if oneway not in ONEWAY_VALUES and oneway not in REVERSED_ONEWAY_VALUES:
+            edges.append((segment[-1], segment[0], line[::-1]))
+
+    for refs, tags in ways:
+        oneway = tags.get('oneway', 'no') if modality == "drive" else 'no'
+        if oneway in REVERSED_ONEWAY_VALUES:
+            refs = refs[::-1]
+
+        segment = []
+        for ref in refs:
+            if ref not in coords:
+                # The way leaves the extract or bbox: keep the run so far and cut it here
+                if len(segment) > 1:
+                    add_edge(segment, oneway)
+                segment = []
+                continue
+            segment.append(ref)
+            if len(segment) > 1 and usage[ref] > 1:
+                add_edge(segment, oneway)
+                segment = [ref]
+
+    nodes = {osm_id: coords[osm_id] for u, v, _ in edges for osm_id in (u, v)}
+    return nodes, edges
+
+
+def import_osm(city_name: str, osm_path: str, modality: str = "drive", bbox=None):
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Importing {city.name} network from {osm_path}...")
+    nodes, edges = read_osm_network(osm_path, modality=modality, bbox=bbox)
+
+    node_created = upsert_nodes(city, ((osm_id, x, y) for osm_id, (x, y) in nodes.items()))
+    print(f"Nodes imported or updated: {node_created}, skipped: 0")
+
+    edge_created, edge_skipped = upsert_edges(
+        city,
+        ((u, v, LineString(line, srid=4326)) for u, v, line in edges if u != v),
+        node_ids=set(nodes),
+    )
+    print(f"Edges imported: {edge_created}, skipped: {edge_skipped}")
+    return (node_created, 0), (edge_created, edge_skipped)
+
+
+def reingest_osm(city_name: str, osm_path: str, modality: str = "drive", bbox=None):
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Re-importing {city.name} network from {osm_path}...")
+    nodes, edges = read_osm_network(osm_path, modality=modality, bbox=bbox)
+
+    diff = apply_graph_diff(
+        city,
+        ((osm_id, x, y) for osm_id, (x, y) in nodes.items()),
+        ((u, v, LineString(line, srid=4326)) for u, v, line in edges if u != v),
+    )
+    print(f"Graph diff for {city.name}: {format_diff(diff)}")
+    return diff
@@ -0,0 +1,87 @@
+import json
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+
+
+class PrimaryKeyCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the primary key: each page is a ``pk > last seen``
+    range scan, so deep pages cost the same as the first one.
+    """
+    ordering = 'pk'
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+class KeysetCursorPagination(PrimaryKeyCursorPagination):
+    """
+    Keyset pagination on several fields compared as one key, for orderings
+    whose first field is not unique. DRF's cursor only filters on the first
+    field and skips ties with an offset, which is capped and grows with the
+    number of rows sharing a value; here the cursor holds every field.
+    """
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        if cursor is None or cursor.position is None:
+            self.keyset_position = None
+            return cursor
+        try:
+            self.keyset_position = json.loads(cursor.position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(self.keyset_position, list) or len(self.keyset_position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        # The parent class filters on the first field only, so it gets no position
+        return Cursor(offset=cursor.offset, reverse=cursor.reverse, position=None)
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for order in ordering:
+            value = getattr(instance, order.lstrip('-'))
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else str(value))
+        return json.dumps(values)
+
+    def keyset_filter(self, reverse):
+        """Rows strictly after the cursor position in the (possibly reversed) ordering."""
+        conditions = []
+        for i, order in enumerate(self.ordering):
+            descending = order.startswith('-') != reverse
+            equal = {field.lstrip('-'): value for field, value in zip(self.ordering[:i], self.keyset_position)}
+            after = {order.lstrip('-') + ('__lt' if descending else '__gt'): self.keyset_position[i]}
+            conditions.append(Q(**equal, **after))
+        return reduce(or_, conditions)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = self.get_ordering(request, queryset, view)
+        cursor = self.decode_cursor(request)
+        if self.keyset_position is not None:
+            try:
+                queryset = queryset.filter(self.keyset_filter(cursor.reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        page = super().paginate_queryset(queryset, request, view)
+
+        # Restore the links the parent class derives from the position it never saw
+        if self.keyset_position is not None and page is not None:
+            position = json.dumps(self.keyset_position)
+            if self.cursor.reverse:
+                self.has_next, self.next_position = True, position
+            else:
+                self.has_previous, self.previous_position = True, position
+            if self.template is not None:
+                self.display_page_controls = True
+        return page
+
+
+class MetricValueCursorPagination(KeysetCursorPagination):
+    """Metric values, newest first; ``id`` breaks ties between values of the same run."""
+    ordering = ('-datetime', '-id')
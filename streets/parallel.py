@@ -0,0 +1,39 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connections
+
+
+def init_worker():
+    import django
+    django.setup()
+    # Never reuse a connection inherited from the parent process
+    connections.close_all()
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def run_city_jobs(fn, jobs, workers: int = None):
+    """
+    Run ``fn(*job)`` for every job in a process pool and yield ``(job, result)``
+    as each one finishes. ``fn`` is expected to catch its own errors; if a
+    worker process dies the job's result is ``{'ok': False, 'error': ...}``.
+    """
+    jobs = list(jobs)
+    workers = max(1, min(workers or default_workers(), len(jobs) or 1))
+
+    # Forked workers must not share the parent's database socket
+    connections.close_all()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(fn, *job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                result = {'ok': False, 'error': traceback.format_exc(), 'seconds': 0.0}
+            yield job, result
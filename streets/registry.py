@@ -0,0 +1,240 @@
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import (
+    load_city_arrays,
+    get_built_up_area_km2,
+    haversine,
+    bearings,
+    node_degrees,
+    entropy_from_counts,
+    _scores,
+    _mean,
+)
+from .centrality import sampled_centrality
+from .circuity import network_circuity
+from .models import City
+
+# name -> (function, names of the intermediates it takes as keyword arguments)
+INTERMEDIATES = {}
+# code -> {'function', 'requires', 'types', 'description', 'default'}
+METRICS = {}
+
+
+def intermediate(name: str, requires=()):
+    """Register a function computing a shared intermediate from other intermediates."""
+    def register(function):
+        INTERMEDIATES[name] = (function, tuple(requires))
+        return function
+    return register
+
+
+def metric(code: str, requires=(), types=('walk', 'bike'), description: str = None, default: bool = True):
+    """
+    Register a metric. Its function takes the intermediates named in
+    ``requires`` as keyword arguments and returns one value, saved as
+    ``<code>_<type>`` for each of ``types``. Metrics with ``default=False``
+    are only evaluated when asked for by code.
+    """
+    def register(function):
+        METRICS[code] = {
+            'function': function,
+            'requires': tuple(requires),
+            'types': tuple(types),
+            'description': description or function.__doc__,
+            'default': default,
+        }
+        return function
+    return register
+
+
+def evaluate_metrics(city, codes=None):
+    """
+    Evaluate the requested metrics (default: all registered as default) for a city.
+
+    Every intermediate is computed at most once, on first use, and only if a
+    requested metric depends on it. Returns the values keyed like
+    ``metrics_dict`` and the time spent per intermediate and per metric; a
+    metric's time includes the intermediates first computed for it.
+    """
+    codes = [code for code, spec in METRICS.items() if spec['default']] if codes is None else list(codes)
+    unknown = [code for code in codes if code not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}. Choose from: {', '.join(METRICS)}")
+
+    cache = {'city': city}
+    timings = {'intermediates': {}, 'metrics': {}}
+
+    def resolve(name, path=()):
+        if name in cache:
+            return cache[name]
+        if name in path:
+            raise ValueError(f"Circular intermediate dependency: {' -> '.join(path + (name,))}")
+        try:
+            function, requires = INTERMEDIATES[name]
+        except KeyError:
+            raise ValueError(f"Unknown intermediate '{name}'")
+        kwargs = {required: resolve(required, path + (name,)) for required in requires}
+        start = time.perf_counter()
+        cache[name] = function(**kwargs)
+        timings['intermediates'][name] = time.perf_counter() - start
+        return cache[name]
+
+    values = {}
+    for code in codes:
+        spec = METRICS[code]
+        start = time.perf_counter()
+        value = spec['function'](**{required: resolve(required) for required in spec['requires']})
+        timings['metrics'][code] = time.perf_counter() - start
+        for metric_type in spec['types']:
+            values[f"{code}_{metric_type}"] = value
+
+    return values, timings
+
+
+def calculate_urban_metrics_registry(city_name: str, codes=None):
+    city = City.objects.get(name=city_name)
+    return evaluate_metrics(city, codes)[0]
+
+
+@intermediate('area', requires=['city'])
+def _area(city):
+    return get_built_up_area_km2(city)
+
+
+@intermediate('arrays', requires=['city'])
+def _arrays(city):
+    return load_city_arrays(city)
+
+
+@intermediate('edge_length', requires=['arrays'])
+def _edge_length(arrays):
+    return arrays['length']
+
+
+@intermediate('straight_distance', requires=['arrays'])
+def _straight_distance(arrays):
+    return haversine(arrays['start_xy'], arrays['end_xy'])
+
+
+@intermediate('bearing_counts', requires=['arrays'])
+def _bearing_counts(arrays):
+    angle_index = np.minimum((bearings(arrays['geom_start'], arrays['geom_end']) // 10).astype(np.int64), 35)
+    return np.bincount(angle_index, minlength=36)
+
+
+@intermediate('node_degrees', requires=['arrays'])
+def _node_degrees(arrays):
+    return node_degrees(arrays['node_ids'], arrays['start_node'], arrays['end_node'])
+
+
+@intermediate('modes', requires=['arrays'])
+def _modes(arrays):
+    mode = arrays['mode']
+    return {'walking': mode == 'pedestrian', 'cycling': mode == 'cycling', 'driving': mode == 'driving'}
+
+
+@metric('CIR', requires=['edge_length', 'straight_distance'], description="Average Circuity")
+def average_circuity(edge_length, straight_distance):
+    positive = straight_distance > 0
+    return _mean(edge_length[positive] / straight_distance[positive])
+
+
+@metric('ORE', requires=['bearing_counts'], description="Orientation Entropy")
+def orientation_entropy(bearing_counts):
+    return entropy_from_counts(bearing_counts.tolist())
+
+
+@metric('RDE', requires=['edge_length', 'area'], description="Road Density")
+def road_density(edge_length, area):
+    return len(edge_length) / area if area > 0 else 0
+
+
+@metric('AST', requires=['arrays', 'edge_length'], description="Average Steepness")
+def average_steepness(arrays, edge_length):
+    elevation_difference = np.abs(arrays['start_elevation'] - arrays['end_elevation'])
+    elevation_difference[np.isnan(elevation_difference)] = 0
+    has_length = edge_length > 0
+    return _mean(elevation_difference[has_length] / edge_length[has_length])
+
+
+@metric('ASL', requires=['edge_length'], description="Average Street Length")
+def average_street_length(edge_length):
+    return _mean(edge_length)
+
+
+@metric('IND', requires=['node_degrees', 'area'], description="Intersection Density")
+def intersection_density(node_degrees, area):
+    return int((node_degrees >= 3).sum()) / area if area > 0 else 0
+
+
+@metric('WDR', requires=['modes'], types=['walk'], description="Walking to Driving Segments Ratio")
+def walking_driving_ratio(modes):
+    driving_edges = int(modes['driving'].sum())
+    return int(modes['walking'].sum()) / driving_edges if driving_edges > 0 else 0
+
+
+@metric('BDR', requires=['modes'], types=['bike'], description="Biking to Driving Segments Ratio")
+def biking_driving_ratio(modes):
+    driving_edges = int(modes['driving'].sum())
+    return int(modes['cycling'].sum()) / driving_edges if driving_edges > 0 else 0
+
+
+@metric('AWS', requires=['arrays', 'modes'], types=['walk'], description="Average Walking Score")
+def average_walking_score(arrays, modes):
+    return _mean(_scores(arrays['speed_limit'], modes['walking'], 0.5))
+
+
+@metric('ABS', requires=['arrays', 'modes'], types=['bike'], description="Average Biking Score")
+def average_biking_score(arrays, modes):
+    return _mean(_scores(arrays['speed_limit'], modes['cycling'], 0.6))
+
+
+@metric('ACO', requires=['node_degrees'], description="Average Connectivity")
+def average_connectivity(node_degrees):
+    return _mean(node_degrees)
+
+
+@metric('SCO', requires=['node_degrees'], description="Connectivity Standard Deviation")
+def connectivity_std(node_degrees):
+    return np.std(node_degrees) if len(node_degrees) else 0
+
+
+@intermediate('centrality', requires=['city'])
+def _centrality(city):
+    return sampled_centrality(
+        city,
+        samples=settings.CENTRALITY_SAMPLES,
+        time_budget=settings.CENTRALITY_TIME_BUDGET,
+    )
+
+
+@metric('BET', requires=['centrality'], description="Average Betweenness Centrality", default=False)
+def average_betweenness(centrality):
+    return centrality['betweenness_mean']
+
+
+@metric('BMX', requires=['centrality'], description="Maximum Betweenness Centrality", default=False)
+def max_betweenness(centrality):
+    return centrality['betweenness_max']
+
+
+@metric('CLO', requires=['centrality'], description="Average Closeness Centrality", default=False)
+def average_closeness(centrality):
+    return centrality['closeness_mean']
+
+
+@intermediate('network_circuity', requires=['city'])
+def _network_circuity(city):
+    return network_circuity(
+        city,
+        origins=settings.NETWORK_CIRCUITY_ORIGINS,
+        destinations_per_origin=settings.NETWORK_CIRCUITY_DESTINATIONS,
+    )
+
+
+@metric('NCI', requires=['network_circuity'], description="Network Circuity", default=False)
+def network_circuity_metric(network_circuity):
+    return network_circuity['circuity']
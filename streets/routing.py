@@ -0,0 +1,377 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from heapq import heappush, heappop, heapify
+from math import inf
+
+import numpy as np
+
+from .graph import get_versioned_city_graph, snapshot_root
+from .models import Edge
+
+CH_FORMAT = 1
+CH_ARRAYS = (
+    'rank',
+    'up_offsets', 'up_targets', 'up_weights', 'up_middles',
+    'down_offsets', 'down_sources', 'down_weights', 'down_middles',
+)
+# Nodes a witness search may settle before giving up and adding the shortcut
+WITNESS_SETTLE_LIMIT = 500
+PRIORITY_SETTLE_LIMIT = 50
+
+# city_id -> (graph_version, ContractionHierarchy) for this process
+_hierarchy_cache = {}
+
+
+def _witness_distances(out_adj, source, avoid, max_distance, settle_limit):
+    """Bounded Dijkstra from ``source`` in the remaining graph, not passing through ``avoid``."""
+    distance = {source: 0.0}
+    settled = set()
+    queue = [(0.0, source)]
+    while queue:
+        dist, x = heappop(queue)
+        if x in settled:
+            continue
+        if dist > max_distance or len(settled) >= settle_limit:
+            break
+        settled.add(x)
+        for y, length in out_adj[x].items():
+            if y == avoid:
+                continue
+            y_dist = dist + length
+            if y_dist < distance.get(y, inf):
+                distance[y] = y_dist
+                heappush(queue, (y_dist, y))
+    return distance
+
+
+def _shortcuts(out_adj, in_adj, v, settle_limit):
+    """The ``(u, w, length)`` shortcuts needed to contract ``v``."""
+    shortcuts = []
+    outgoing = out_adj[v]
+    for u, in_length in in_adj[v].items():
+        if not outgoing:
+            break
+        max_distance = in_length + max(outgoing.values())
+        witness = _witness_distances(out_adj, u, v, max_distance, settle_limit)
+        for w, out_length in outgoing.items():
+            if w == u:
+                continue
+            via = in_length + out_length
+            if witness.get(w, inf) > via:
+                shortcuts.append((u, w, via))
+    return shortcuts
+
+
+def _to_csr(rows, node_count):
+    offsets = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    flat = [entry for row in rows for entry in row]
+    return (
+        offsets,
+        np.array([entry[0] for entry in flat], dtype=np.int32),
+        np.array([entry[1] for entry in flat], dtype=np.float64),
+        np.array([entry[2] for entry in flat], dtype=np.int32),
+    )
+
+
+def build_contraction_hierarchy(graph, verbose: bool = False):
+    """
+    Contract a ``CityGraph`` node by node, in order of edge difference with
+    lazy updates, adding a shortcut whenever a bounded witness search finds no
+    path at least as short around the node being contracted.
+
+    Returns the arrays of a ``ContractionHierarchy``. The upward graph holds
+    for every node its edges to higher-ranked nodes, the downward graph the
+    edges reaching it from higher-ranked nodes. For both, ``*_middles`` is the
+    contracted node a shortcut bypasses, or -1 for an original edge.
+    """
+    start = time.perf_counter()
+    node_count = graph.node_count
+    offsets, neighbors, lengths = graph.adjacency_lists()
+
+    out_adj = [{} for _ in range(node_count)]
+    in_adj = [{} for _ in range(node_count)]
+    for u in range(node_count):
+        for i in range(offsets[u], offsets[u + 1]):
+            w, length = neighbors[i], lengths[i]
+            # Self-loops are never on a shortest path
+            if w != u and length < out_adj[u].get(w, inf):
+                out_adj[u][w] = length
+                in_adj[w][u] = length
+
+    middles = {}
+    deleted_neighbors = [0] * node_count
+
+    def priority(v):
+        shortcut_count = len(_shortcuts(out_adj, in_adj, v, PRIORITY_SETTLE_LIMIT))
+        return shortcut_count - len(out_adj[v]) - len(in_adj[v]) + deleted_neighbors[v]
+
+    queue = [(priority(v), v) for v in range(node_count)]
+    heapify(queue)
+
+    rank = np.zeros(node_count, dtype=np.int32)
+    up_rows = [None] * node_count
+    down_rows = [None] * node_count
+    shortcut_count = 0
+    next_rank = 0
+
+    while queue:
+        _, v = heappop(queue)
+        # Lazy update: contract only if v is still the cheapest node
+        current = priority(v)
+        if queue and current > queue[0][0]:
+            heappush(queue, (current, v))
+            continue
+
+        rank[v] = next_rank
+        next_rank += 1
+        # Every remaining neighbor gets contracted later, so ranks higher
+        up_rows[v] = [(w, length, middles.get((v, w), -1)) for w, length in out_adj[v].items()]
+        down_rows[v] = [(u, length, middles.get((u, v), -1)) for u, length in in_adj[v].items()]
+
+        for u, w, length in _shortcuts(out_adj, in_adj, v, WITNESS_SETTLE_LIMIT):
+            if length < out_adj[u].get(w, inf):
+                out_adj[u][w] = length
+                in_adj[w][u] = length
+                middles[(u, w)] = v
+                shortcut_count += 1
+
+        for w in out_adj[v]:
+            del in_adj[w][v]
+            deleted_neighbors[w] += 1
+        for u in in_adj[v]:
+            del out_adj[u][v]
+            deleted_neighbors[u] += 1
+        out_adj[v] = {}
+        in_adj[v] = {}
+
+        if verbose and next_rank % 10000 == 0:
+            print(f"Contracted {next_rank}/{node_count} nodes, {shortcut_count} shortcuts")
+
+    up_offsets, up_targets, up_weights, up_middles = _to_csr(up_rows, node_count)
+    down_offsets, down_sources, down_weights, down_middles = _to_csr(down_rows, node_count)
+    if verbose:
+        print(f"Contracted {node_count} nodes with {shortcut_count} shortcuts "
+              f"in {time.perf_counter() - start:.1f}s")
+
+    return {
+        'rank': rank,
+        'up_offsets': up_offsets, 'up_targets': up_targets,
+        'up_weights': up_weights, 'up_middles': up_middles,
+        'down_offsets': down_offsets, 'down_sources': down_sources,
+        'down_weights': down_weights, 'down_middles': down_middles,
+    }
+
+
+class ContractionHierarchy:
+    """Point-to-point shortest paths on a contracted ``CityGraph``."""
+
+    def __init__(self, graph, arrays):
+        self.graph = graph
+        self.rank = arrays['rank'].tolist()
+        # Pure-Python searches index lists much faster than arrays
+        self.up = tuple(arrays[name].tolist() for name in ('up_offsets', 'up_targets', 'up_weights', 'up_middles'))
+        self.down = tuple(arrays[name].tolist()
+                          for name in ('down_offsets', 'down_sources', 'down_weights', 'down_middles'))
+
+    def shortest_path(self, source: int, target: int):
+        """
+        Bidirectional upward Dijkstra between two node indices. Returns the
+        path length in meters and the node indices along it, or ``(inf, [])``
+        when the target cannot be reached.
+        """
+        if source == target:
+            return 0.0, [source]
+
+        distance = ({source: 0.0}, {target: 0.0})
+        parent = ({source: None}, {target: None})
+        settled = (set(), set())
+        queues = ([(0.0, source)], [(0.0, target)])
+        best, meeting = inf, None
+
+        while queues[0] or queues[1]:
+            for side, (offsets, nodes, weights, _) in enumerate((self.up, self.down)):
+                queue = queues[side]
+                if not queue:
+                    continue
+                dist, x = heappop(queue)
+                if x in settled[side]:
+                    continue
+                if dist >= best:
+                    # Nothing left on this side can improve the best path
+                    queue.clear()
+                    continue
+                settled[side].add(x)
+                for i in range(offsets[x], offsets[x + 1]):
+                    y = nodes[i]
+                    y_dist = dist + weights[i]
+                    if y_dist < distance[side].get(y, inf):
+                        distance[side][y] = y_dist
+                        parent[side][y] = (x, i)
+                        heappush(queue, (y_dist, y))
+                        other = distance[1 - side].get(y)
+                        if other is not None and y_dist + other < best:
+                            best, meeting = y_dist + other, y
+
+        if meeting is None:
+            return inf, []
+
+        # Hierarchy edges from the source up to the meeting node, then down to the target
+        edges = []
+        node = meeting
+        while parent[0][node] is not None:
+            previous, i = parent[0][node]
+            edges.append((previous, node, self.up[3][i]))
+            node = previous
+        edges.reverse()
+        node = meeting
+        while parent[1][node] is not None:
+            following, i = parent[1][node]
+            edges.append((node, following, self.down[3][i]))
+            node = following
+
+        return best, self._unpack(edges)
+
+    def _middle(self, a, b):
+        """The middle node of the hierarchy edge a -> b (-1 for an original edge)."""
+        if self.rank[a] < self.rank[b]:
+            offsets, nodes, weights, middles = self.up
+            row, other = a, b
+        else:
+            offsets, nodes, weights, middles = self.down
+            row, other = b, a
+        candidates = [i for i in range(offsets[row], offsets[row + 1]) if nodes[i] == other]
+        return middles[min(candidates, key=lambda i: weights[i])]
+
+    def _unpack(self, edges):
+        path = [edges[0][0]]
+        stack = list(reversed(edges))
+        while stack:
+            a, b, middle = stack.pop()
+            if middle < 0:
+                path.append(b)
+            else:
+                stack.append((middle, b, self._middle(middle, b)))
+                stack.append((a, middle, self._middle(a, middle)))
+        return path
+
+
+def hierarchy_path(city_id, graph_version: int):
+    return snapshot_root(city_id) / f"v{graph_version}" / "ch"
+
+
+def write_hierarchy(graph, graph_version: int, arrays):
+    """
+    Store the hierarchy inside the graph snapshot of the same version, written
+    atomically, so it is removed together with the snapshot once outdated.
+    """
+    target = hierarchy_path(graph.city_id, graph_version)
+    if target.exists():
+        return target
+    if not (target.parent / "meta.json").exists():
+        # The graph changed while contracting and its snapshot was never written
+        return None
+
+    tmp = tempfile.mkdtemp(dir=target.parent, prefix=".tmp-ch-")
+    for name in CH_ARRAYS:
+        np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(arrays[name]))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({'format': CH_FORMAT, 'city_id': graph.city_id, 'graph_version': graph_version,
+                   'node_count': graph.node_count}, f)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return target
+
+
+def load_hierarchy(graph, graph_version: int):
+    path = hierarchy_path(graph.city_id, graph_version)
+    try:
+        meta = json.loads((path / "meta.json").read_text())
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode='r') for name in CH_ARRAYS}
+    except (OSError, ValueError):
+        return None
+    if (meta.get('format') != CH_FORMAT or meta.get('graph_version') != graph_version
+            or meta.get('node_count') != graph.node_count or len(arrays['rank']) != graph.node_count):
+        return None
+    return ContractionHierarchy(graph, arrays)
+
+
+def prepare_routing(city, verbose: bool = False):
+    """
+    Build and persist the contraction hierarchy of a city's current graph,
+    unless it exists. Returns the graph version, or ``None`` when the graph
+    changed while contracting and nothing was written.
+    """
+    graph_version, graph = get_versioned_city_graph(city)
+    if load_hierarchy(graph, graph_version) is None:
+        if write_hierarchy(graph, graph_version, build_contraction_hierarchy(graph, verbose=verbose)) is None:
+            return None
+    return graph_version
+
+
+def get_hierarchy(city):
+    """The city's ``ContractionHierarchy`` for its current graph, or ``None`` if it has not been prepared."""
+    graph_version, graph = get_versioned_city_graph(city)
+    cached = _hierarchy_cache.get(graph.city_id)
+    if cached is not None and cached[0] == graph_version:
+        return cached[1]
+
+    hierarchy = load_hierarchy(graph, graph_version)
+    if hierarchy is not None:
+        _hierarchy_cache[graph.city_id] = (graph_version, hierarchy)
+    return hierarchy
+
+
+def path_edge_ids(graph, path):
+    """``Edge`` ids along a node index path, taking the shortest edge between each pair."""
+    edge_ids = []
+    for a, b in zip(path, path[1:]):
+        start, end = graph.offsets[a], graph.offsets[a + 1]
+        candidates = np.nonzero(graph.neighbors[start:end] == b)[0]
+        best = candidates[np.argmin(graph.lengths[start:end][candidates])]
+        edge_ids.append(int(graph.edge_ids[start + best]))
+    return edge_ids
+
+
+def route(city, from_lonlat, to_lonlat):
+    """
+    Shortest route between two points as a GeoJSON Feature: both points are
+    snapped to the nearest node, the path is found in the city's contraction
+    hierarchy and drawn with the stored edge geometries.
+    """
+    hierarchy = get_hierarchy(city)
+    if hierarchy is None:
+        raise LookupError(f"Routing has not been prepared for {city.name}; run 'manage.py prepare_routing'.")
+    graph = hierarchy.graph
+
+    start = time.perf_counter()
+    source = graph.nearest_node(*from_lonlat)
+    target = graph.nearest_node(*to_lonlat)
+    length, path = hierarchy.shortest_path(source, target)
+    query_ms = (time.perf_counter() - start) * 1000
+    if not path:
+        return None
+
+    edge_ids = path_edge_ids(graph, path)
+    geoms = dict(Edge.objects.filter(pk__in=edge_ids).values_list('id', 'geom'))
+    coordinates = [graph.coords[path[0]].tolist()]
+    for edge_id, (a, b) in zip(edge_ids, zip(path, path[1:])):
+        line = geoms[edge_id].coords if edge_id in geoms else [graph.coords[a].tolist(), graph.coords[b].tolist()]
+        coordinates.extend(list(point) for point in line[1:])
+
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': coordinates},
+        'properties': {
+            'length': length,
+            'from_node': int(graph.node_ids[source]),
+            'to_node': int(graph.node_ids[target]),
+            'edges': len(edge_ids),
+            'query_ms': query_ms,
+        },
+    }
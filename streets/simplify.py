@@ -0,0 +1,68 @@
+import time
+
+from django.db import connection, transaction
+
+from .models import City, Edge, SimplifiedEdge
+
+# Zoom levels with materialized geometries; at FULL_RESOLUTION_ZOOM and above edges are served as stored
+SIMPLIFICATION_ZOOMS = (8, 10, 12, 14)
+FULL_RESOLUTION_ZOOM = 16
+# Web Mercator meters per 256px tile pixel at the equator, zoom 0
+METERS_PER_PIXEL_Z0 = 156543.03
+# Edges shorter than this many pixels are dropped: they would not be visible anyway
+MIN_EDGE_PIXELS = 2
+
+SIMPLIFY_SQL = """
+    INSERT INTO {simplified_table} (edge_id, city_id, zoom, graph_version, geom)
+    SELECT e.id, e.city_id, %s, %s, ST_SimplifyPreserveTopology(e.geom::geometry, %s)
+    FROM {edge_table} e
+    WHERE e.city_id = %s AND ST_Length(e.geom) >= %s
+"""
+
+
+def zoom_tolerance(zoom: int):
+    """Simplification tolerance in degrees: half a pixel at ``zoom``."""
+    return 360.0 / (256 * 2 ** zoom) / 2
+
+
+def zoom_min_length(zoom: int):
+    """Length in meters under which an edge is left out at ``zoom``."""
+    return MIN_EDGE_PIXELS * METERS_PER_PIXEL_Z0 / 2 ** zoom
+
+
+def simplification_zoom(zoom: int):
+    """The materialized level serving ``zoom``, or ``None`` for full resolution."""
+    if zoom >= FULL_RESOLUTION_ZOOM:
+        return None
+    return max([level for level in SIMPLIFICATION_ZOOMS if level <= zoom], default=SIMPLIFICATION_ZOOMS[0])
+
+
+def is_materialized(city, zoom: int):
+    return SimplifiedEdge.objects.filter(city=city, zoom=zoom, graph_version=city.graph_version).exists()
+
+
+def materialize_simplified_edges(city, verbose: bool = True):
+    """
+    Store the edges of a city simplified with ``ST_SimplifyPreserveTopology``
+    for every level of ``SIMPLIFICATION_ZOOMS``, leaving out edges too short
+    to be seen at that level. Meant to run after each ingest; the rows are
+    tagged with the graph version they were built from.
+    """
+    if isinstance(city, str):
+        city = City.objects.get(name=city)
+    sql = SIMPLIFY_SQL.format(simplified_table=SimplifiedEdge._meta.db_table, edge_table=Edge._meta.db_table)
+
+    start = time.perf_counter()
+    with transaction.atomic():
+        # Graph edits through the API lock the city row too, so the version holds while we copy
+        version = City.objects.select_for_update().values_list('graph_version', flat=True).get(pk=city.pk)
+        SimplifiedEdge.objects.filter(city=city).delete()
+        with connection.cursor() as cursor:
+            for zoom in SIMPLIFICATION_ZOOMS:
+                cursor.execute(sql, [zoom, version, zoom_tolerance(zoom), city.pk, zoom_min_length(zoom)])
+                if verbose:
+                    print(f"{city.name}: {cursor.rowcount} edges simplified for zoom {zoom}")
+
+    if verbose:
+        print(f"Simplified geometries of {city.name} materialized in {time.perf_counter() - start:.2f}s")
+    return version
@@ -0,0 +1,170 @@
+import io
+import time
+
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+
+from .ingest import batched, split_graphml, format_diff, _graphml_node_rows, _graphml_edge_rows
+from .models import City, Node, Edge
+
+
+def _stage_tables(city):
+    return f"{Node._meta.db_table}_stage_{city.id}", f"{Edge._meta.db_table}_stage_{city.id}"
+
+
+def create_stage(city):
+    """
+    (Re)create the city's UNLOGGED staging tables. They live outside the
+    tables readers query, so loading them takes no locks on live data.
+    """
+    node_stage, edge_stage = _stage_tables(city)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {node_stage}, {edge_stage}")
+        cursor.execute(f"CREATE UNLOGGED TABLE {node_stage} (osm_id bigint NOT NULL, geom geography(Point, 4326))")
+        cursor.execute(
+            f"CREATE UNLOGGED TABLE {edge_stage} "
+            f"(start_node_id bigint NOT NULL, end_node_id bigint NOT NULL, geom geography(LineString, 4326))"
+        )
+    return node_stage, edge_stage
+
+
+def drop_stage(city):
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {}, {}".format(*_stage_tables(city)))
+
+
+def _copy_rows(table: str, columns: str, rows):
+    count = 0
+    with connection.cursor() as cursor:
+        for batch in batched(rows):
+            buffer = io.StringIO("".join("\t".join(map(str, row)) + "\n" for row in batch))
+            cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", buffer)
+            count += len(batch)
+    return count
+
+
+def stage_graph(city, node_rows, edge_rows):
+    """
+    COPY ``(osm_id, x, y)`` node rows and ``(u, v, geom)`` edge rows into fresh
+    staging tables. Returns the number of staged nodes and edges.
+    """
+    node_stage, edge_stage = create_stage(city)
+
+    node_count = _copy_rows(
+        node_stage, "osm_id, geom",
+        ((osm_id, Point(x, y, srid=4326).hexewkb.decode()) for osm_id, x, y in node_rows),
+    )
+    edge_count = _copy_rows(
+        edge_stage, "start_node_id, end_node_id, geom",
+        ((u, v, geom.hexewkb.decode()) for u, v, geom in edge_rows),
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE UNIQUE INDEX ON {node_stage} (osm_id)")
+        cursor.execute(f"CREATE INDEX ON {edge_stage} (start_node_id, end_node_id)")
+        cursor.execute(f"ANALYZE {node_stage}")
+        cursor.execute(f"ANALYZE {edge_stage}")
+
+    return node_count, edge_count
+
+
+def publish_stage(city):
+    """
+    Replace the city's live graph with its staged copy in one transaction,
+    then drop the staging tables, whether or not the publish succeeded.
+
+    Readers keep seeing the previous complete graph until the commit. Only rows
+    whose geometry (or, for nodes, city) differs are rewritten, so the publish costs time in
+    proportion to what changed and holds row locks only for its duration.
+    Returns the diff size and the publish time in seconds.
+    """
+    node_stage, edge_stage = _stage_tables(city)
+    node_table, edge_table = Node._meta.db_table, Edge._meta.db_table
+
+    start = time.perf_counter()
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {node_table} (osm_id, city_id, geom) "
+                f"SELECT DISTINCT ON (osm_id) osm_id, %s, geom FROM {node_stage} "
+                f"ON CONFLICT (osm_id) DO UPDATE SET geom = EXCLUDED.geom, city_id = EXCLUDED.city_id "
+                f"WHERE ST_AsBinary({node_table}.geom) IS DISTINCT FROM ST_AsBinary(EXCLUDED.geom) "
+                f"OR {node_table}.city_id <> EXCLUDED.city_id "
+                f"RETURNING (xmax = 0)",
+                [city.id],
+            )
+            node_changes = [inserted for inserted, in cursor.fetchall()]
+
+            cursor.execute(
+                f"INSERT INTO {edge_table} (city_id, start_node_id, end_node_id, geom) "
+                f"SELECT DISTINCT ON (e.start_node_id, e.end_node_id) %s, e.start_node_id, e.end_node_id, e.geom "
+                f"FROM {edge_stage} e "
+                f"JOIN {node_stage} s ON s.osm_id = e.start_node_id "
+                f"JOIN {node_stage} t ON t.osm_id = e.end_node_id "
+                f"ON CONFLICT (city_id, start_node_id, end_node_id) DO UPDATE SET geom = EXCLUDED.geom "
+                f"WHERE ST_AsBinary({edge_table}.geom) IS DISTINCT FROM ST_AsBinary(EXCLUDED.geom) "
+                f"RETURNING (xmax = 0)",
+                [city.id],
+            )
+            edge_changes = [inserted for inserted, in cursor.fetchall()]
+
+            cursor.execute(
+                f"DELETE FROM {edge_table} e WHERE e.city_id = %s AND NOT EXISTS ("
+                f"SELECT 1 FROM {edge_stage} s JOIN {node_stage} a ON a.osm_id = s.start_node_id "
+                f"JOIN {node_stage} b ON b.osm_id = s.end_node_id "
+                f"WHERE s.start_node_id = e.start_node_id AND s.end_node_id = e.end_node_id)",
+                [city.id],
+            )
+            edges_deleted = cursor.rowcount
+
+            cursor.execute(
+                f"DELETE FROM {node_table} n WHERE n.city_id = %s AND NOT EXISTS ("
+                f"SELECT 1 FROM {node_stage} s WHERE s.osm_id = n.osm_id)",
+                [city.id],
+            )
+            nodes_deleted = cursor.rowcount
+
+            if node_changes or edge_changes or edges_deleted or nodes_deleted:
+                City.bump_graph_version(city.id)
+        publish_seconds = time.perf_counter() - start
+    finally:
+        drop_stage(city)
+
+    def _counts(changes, deleted):
+        inserted = sum(changes)
+        return {'inserted': inserted, 'updated': len(changes) - inserted, 'deleted': deleted}
+
+    return {
+        'nodes': _counts(node_changes, nodes_deleted),
+        'edges': _counts(edge_changes, edges_deleted),
+    }, publish_seconds
+
+
+def staged_save_graphml(city_name: str, graphml_path: str):
+    try:
+        city = City.objects.get(name=city_name)
+    except City.DoesNotExist:
+        print(f"City {city_name} not found.")
+        return
+
+    print(f"Staging {city.name} graphml file...")
+    node_stats = {'skipped': 0}
+    edge_stats = {'skipped': 0}
+    nodes, edges = split_graphml(graphml_path)
+
+    try:
+        node_count, edge_count = stage_graph(
+            city, _graphml_node_rows(nodes, node_stats), _graphml_edge_rows(edges, edge_stats))
+        print(f"Staged {node_count} nodes and {edge_count} edges, skipped: "
+              f"{node_stats['skipped'] + edge_stats['skipped']}")
+
+        diff, publish_seconds = publish_stage(city)
+    finally:
+        drop_stage(city)
+    diff['nodes']['skipped'] = node_stats['skipped']
+    diff['edges']['skipped'] = edge_stats['skipped']
+    diff['nodes']['unchanged'] = node_count - diff['nodes']['inserted'] - diff['nodes']['updated']
+    diff['edges']['unchanged'] = edge_count - diff['edges']['inserted'] - diff['edges']['updated']
+
+    print(f"Published {city.name} in {publish_seconds * 1000:.0f} ms: {format_diff(diff)}")
+    return diff
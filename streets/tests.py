@@ -1,3 +1,408 @@
-from django.test import TestCase
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from math import inf
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.gis.geos import Point, LineString
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .conditional import graph_validators
+from .graph import CityGraph
+from .metrics import calculate_urban_metrics_sql, calculate_urban_metrics_vectorized
+from .models import City, GeoAreaMapping, Metric, MetricValue, Node, Edge, SimplifiedEdge
+from .osm import read_osm_network, way_allowed
+from .routing import build_contraction_hierarchy, ContractionHierarchy
+from .simplify import materialize_simplified_edges, is_materialized
+from .staging import stage_graph, publish_stage
+from .utils import recompute_metric_values, get_metrics_engine
+
+
+def make_city(name='Testville'):
+    geo_area, _ = GeoAreaMapping.objects.get_or_create(geo_area='EU', defaults={'full_name': 'Europe'})
+    return City.objects.create(name=name, country='Nowhere', geo_area=geo_area)
+
+
+def make_grid(city, size=4, spacing=0.001, first_osm_id=1):
+    """A ``size`` x ``size`` grid of two-way streets; returns the node ids by (row, column)."""
+    ids = {}
+    for row in range(size):
+        for col in range(size):
+            osm_id = first_osm_id + row * size + col
+            Node.objects.create(osm_id=osm_id, city=city, geom=Point(col * spacing, row * spacing, srid=4326))
+            ids[row, col] = osm_id
+
+    nodes = {node.osm_id: node for node in Node.objects.filter(city=city)}
+    edges = []
+    for (row, col), osm_id in ids.items():
+        for neighbor in (ids.get((row, col + 1)), ids.get((row + 1, col))):
+            if neighbor is None:
+                continue
+            for u, v in ((osm_id, neighbor), (neighbor, osm_id)):
+                edges.append(Edge(city=city, start_node=nodes[u], end_node=nodes[v],
+                                  geom=LineString(nodes[u].geom.coords, nodes[v].geom.coords, srid=4326)))
+    Edge.objects.bulk_create(edges)
+    return ids
+
+
+def run_in_process(fn, jobs, workers=None):
+    for job in jobs:
+        yield job, fn(*job)
+
+
+@mock.patch('streets.utils.run_city_jobs', run_in_process)
+class RecomputeMetricValuesTests(TestCase):
+    def setUp(self):
+        self.city = make_city()
+        make_grid(self.city)
+        for name in ('ASL', 'ACO'):
+            for metric_type in ('walk', 'bike'):
+                Metric.objects.get_or_create(name=name, type=metric_type)
+
+    def test_saves_requested_metrics(self):
+        report, _ = recompute_metric_values([self.city.name], engine='numpy', metrics=['ASL'])
+
+        self.assertTrue(report[0]['ok'], report[0].get('error'))
+        self.assertEqual(report[0]['saved'], 2)
+        saved = MetricValue.objects.filter(city=self.city)
+        self.assertEqual(sorted(saved.values_list('metric__name', 'metric__type')),
+                         [('ASL', 'bike'), ('ASL', 'walk')])
+        # Lengths are measured in degrees, like the legacy engine does
+        self.assertAlmostEqual(saved.first().value, 0.001)
+
+    def test_saves_all_metrics_with_rows(self):
+        report, _ = recompute_metric_values([self.city.name], engine='numpy')
+
+        self.assertTrue(report[0]['ok'], report[0].get('error'))
+        self.assertEqual(set(MetricValue.objects.filter(city=self.city).values_list('metric__name', flat=True)),
+                         {'ASL', 'ACO'})
+
+    def test_engines_agree_and_filter(self):
+        numpy = get_metrics_engine('numpy')(self.city.name)
+        registry = get_metrics_engine('registry')(self.city.name)
+        self.assertEqual(registry.keys(), numpy.keys())
+        for key, value in registry.items():
+            self.assertAlmostEqual(value, numpy[key], places=9, msg=key)
+
+        for engine in ('numpy', 'sql', 'registry'):
+            self.assertEqual(set(get_metrics_engine(engine, ['ASL', 'ACO'])(self.city.name)),
+                             {'ASL_walk', 'ASL_bike', 'ACO_walk', 'ACO_bike'}, engine)
+
+    def test_unknown_engine_or_metric(self):
+        with self.assertRaises(ValueError):
+            get_metrics_engine('abacus')
+        with self.assertRaises(ValueError):
+            get_metrics_engine('numpy', ['XYZ'])
+        # Only the registry engine computes the non-default metrics
+        with self.assertRaises(ValueError):
+            get_metrics_engine('numpy', ['BET'])
+        get_metrics_engine('registry', ['BET'])
+
+    def test_reports_missing_city(self):
+        report, _ = recompute_metric_values(['Atlantis'], engine='numpy')
+        self.assertEqual(report, [{'city': 'Atlantis', 'ok': False, 'error': "City Atlantis not found.",
+                                   'seconds': 0.0}])
+
+
+@override_settings(RECOMPUTE_API_MAX_WORKERS=4)
+class RecomputeEndpointTests(SimpleTestCase):
+    @mock.patch('streets.utils.subprocess.Popen')
+    def test_starts_the_command_in_its_own_process(self, popen):
+        popen.return_value.pid = 4242
+        response = APIClient().post('/api/metric-values/recompute/',
+                                    {'cities': ['Rome'], 'workers': 64, 'metrics': ['ASL']}, format='json')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['pid'], 4242)
+        command = popen.call_args.args[0]
+        self.assertEqual(command[2:], ['compute_metrics', '--workers', '4', '--engine', 'numpy',
+                                       '--metrics', 'ASL', '--', 'Rome'])
+
+    @mock.patch('streets.utils.subprocess.Popen')
+    def test_rejects_unknown_metrics_before_starting(self, popen):
+        response = APIClient().post('/api/metric-values/recompute/', {'metrics': ['BET']}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        popen.assert_not_called()
+
+
+class SimplifiedEdgeTests(TestCase):
+    def setUp(self):
+        self.city = make_city()
+        self.ids = make_grid(self.city, size=3)
+        self.version = materialize_simplified_edges(self.city, verbose=False)
+
+    def test_levels_leave_out_short_edges(self):
+        # Grid streets are ~111 m: too short to draw at zoom 8, kept at zoom 14
+        self.assertEqual(SimplifiedEdge.objects.filter(city=self.city, zoom=8).count(), 0)
+        self.assertEqual(SimplifiedEdge.objects.filter(city=self.city, zoom=14).count(), Edge.objects.count())
+        self.assertTrue(is_materialized(City.objects.get(pk=self.city.pk), 14))
+
+    def test_staged_publish_deletes_edges_with_simplified_rows(self):
+        # Keep only the first row of the grid
+        row = [self.ids[0, col] for col in range(3)]
+        nodes = {node.osm_id: node for node in Node.objects.filter(osm_id__in=row)}
+        node_rows = [(osm_id, nodes[osm_id].geom.x, nodes[osm_id].geom.y) for osm_id in row]
+        edge_rows = [(edge.start_node_id, edge.end_node_id, edge.geom)
+                     for edge in Edge.objects.filter(start_node__in=row, end_node__in=row)]
+
+        stage_graph(self.city, node_rows, edge_rows)
+        diff, _ = publish_stage(self.city)
+
+        self.assertEqual(diff['edges']['deleted'], 24 - len(edge_rows))
+        self.assertEqual(Edge.objects.filter(city=self.city).count(), len(edge_rows))
+        city = City.objects.get(pk=self.city.pk)
+        self.assertGreater(city.graph_version, self.version)
+        self.assertFalse(is_materialized(city, 14))
+
+
+class SqlMetricsEngineTests(TestCase):
+    def test_matches_numpy_engine_with_float_values(self):
+        city = make_city()
+        make_grid(city)
+        sql = calculate_urban_metrics_sql(city.name)
+        numpy = calculate_urban_metrics_vectorized(city.name)
+
+        self.assertEqual(sql.keys(), numpy.keys())
+        for key, value in sql.items():
+            self.assertNotIsInstance(value, Decimal, key)
+            self.assertAlmostEqual(value, numpy[key], places=9, msg=key)
+
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="0.000" lon="0.000"/>
+  <node id="2" lat="0.000" lon="0.001"/>
+  <node id="3" lat="0.000" lon="0.002"/>
+  <node id="4" lat="0.001" lon="0.001"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><tag k="highway" v="motorway"/><tag k="oneway" v="yes"/></way>
+  <way id="11"><nd ref="2"/><nd ref="3"/><tag k="highway" v="residential"/></way>
+  <way id="12"><nd ref="2"/><nd ref="4"/><tag k="highway" v="footway"/></way>
+</osm>
+"""
+
+
+# Way 20 leaves a bbox of lat <= 0.0005 at node 7 and comes back
+BBOX_OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="5" lat="0.000" lon="0.000"/>
+  <node id="6" lat="0.000" lon="0.001"/>
+  <node id="7" lat="0.001" lon="0.002"/>
+  <node id="8" lat="0.000" lon="0.003"/>
+  <node id="9" lat="0.000" lon="0.004"/>
+  <way id="20"><nd ref="5"/><nd ref="6"/><nd ref="7"/><nd ref="8"/><nd ref="9"/><tag k="highway" v="residential"/></way>
+</osm>
+"""
+
+
+class OsmModalityTests(SimpleTestCase):
+    def read(self, modality, xml=OSM_XML, bbox=None):
+        with tempfile.NamedTemporaryFile('w', suffix='.osm') as f:
+            f.write(xml)
+            f.flush()
+            nodes, edges = read_osm_network(f.name, modality=modality, bbox=bbox)
+        return {(u, v) for u, v, _ in edges}
+
+    def test_networks_per_modality(self):
+        self.assertEqual(self.read('drive'), {(1, 2), (2, 3), (3, 2)})
+        self.assertEqual(self.read('walk'), {(2, 3), (3, 2), (2, 4), (4, 2)})
+        self.assertEqual(self.read('bike'), {(2, 3), (3, 2)})
+
+    def test_access_tags(self):
+        self.assertFalse(way_allowed({'highway': 'residential', 'foot': 'no'}, 'walk'))
+        self.assertTrue(way_allowed({'highway': 'residential', 'foot': 'no'}, 'drive'))
+        self.assertFalse(way_allowed({'highway': 'residential', 'access': 'private'}, 'bike'))
+        self.assertTrue(way_allowed({'highway': 'residential', 'access': 'no', 'bicycle': 'yes'}, 'bike'))
+        self.assertFalse(way_allowed({'highway': 'service', 'service': 'parking_aisle'}, 'drive'))
+        self.assertTrue(way_allowed({'highway': 'service', 'service': 'parking_aisle'}, 'walk'))
+
+    def test_ways_crossing_the_bbox_keep_every_inside_piece(self):
+        self.assertEqual(self.read('drive', BBOX_OSM_XML, bbox=(-1, -1, 1, 0.0005)),
+                         {(5, 6), (6, 5), (8, 9), (9, 8)})
+
+
+class GraphConditionalRequestTests(TestCase):
+    def setUp(self):
+        self.city = make_city()
+        make_grid(self.city, size=3)
+        City.bump_graph_version(self.city.pk)
+        self.client = APIClient()
+        self.urls = [f'/geojson/edges/?city={self.city.name}', f'/geojson/nodes/?city={self.city.name}',
+                     f'/api/edges/?city={self.city.pk}', f'/api/nodes/?city={self.city.pk}']
+
+    def test_matching_etag_is_not_modified_without_graph_queries(self):
+        for url in self.urls:
+            first = self.client.get(url)
+            self.assertEqual(first.status_code, 200, url)
+            self.assertIn('Last-Modified', first)
+
+            with CaptureQueriesContext(connection) as queries:
+                second = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(second.status_code, 304, url)
+            self.assertEqual(second['ETag'], first['ETag'])
+            for query in queries.captured_queries:
+                self.assertNotIn(Edge._meta.db_table, query['sql'])
+                self.assertNotIn(Node._meta.db_table, query['sql'])
+
+    def test_graph_change_invalidates_etag(self):
+        for url in self.urls:
+            etag = self.client.get(url)['ETag']
+            City.bump_graph_version(self.city.pk)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200, url)
+
+    def test_if_modified_since_alone_is_not_trusted(self):
+        first = self.client.get(self.urls[0])
+        second = self.client.get(self.urls[0], HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(second.status_code, 200)
+
+    def test_unknown_city_is_not_found(self):
+        # The ETag a request for a city without rows would have
+        etag, _ = graph_validators(City.objects.none(), 'edges-geojson')
+        response = self.client.get('/geojson/edges/?city=Atlantis', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+
+
+class StagedPublishTests(TestCase):
+    def setUp(self):
+        self.city = make_city()
+        self.ids = make_grid(self.city, size=2)
+        self.version = City.objects.get(pk=self.city.pk).graph_version
+
+    def current_rows(self):
+        node_rows = [(node.osm_id, node.geom.x, node.geom.y) for node in Node.objects.filter(city=self.city)]
+        edge_rows = [(edge.start_node_id, edge.end_node_id, edge.geom) for edge in Edge.objects.filter(city=self.city)]
+        return node_rows, edge_rows
+
+    def publish(self, node_rows, edge_rows):
+        stage_graph(self.city, node_rows, edge_rows)
+        diff, _ = publish_stage(self.city)
+        return diff, City.objects.get(pk=self.city.pk).graph_version
+
+    def test_unchanged_graph_is_a_no_op(self):
+        diff, version = self.publish(*self.current_rows())
+
+        for kind in ('nodes', 'edges'):
+            self.assertEqual(diff[kind], {'inserted': 0, 'updated': 0, 'deleted': 0})
+        self.assertEqual(version, self.version)
+
+    def test_diff_counts_and_version_bump(self):
+        node_rows, edge_rows = self.current_rows()
+        removed, moved, corner = self.ids[1, 1], self.ids[0, 1], self.ids[0, 0]
+        node_rows = [(osm_id, x + 0.0001, y) if osm_id == moved else (osm_id, x, y)
+                     for osm_id, x, y in node_rows if osm_id != removed]
+        edge_rows = [row for row in edge_rows if removed not in row[:2]]
+        node_rows.append((100, -0.001, 0.0))
+        new_line = LineString((-0.001, 0.0), (0.0, 0.0), srid=4326)
+        edge_rows += [(100, corner, new_line), (corner, 100, LineString(new_line.coords[::-1], srid=4326))]
+
+        diff, version = self.publish(node_rows, edge_rows)
+
+        self.assertEqual(diff['nodes'], {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(diff['edges'], {'inserted': 2, 'updated': 0, 'deleted': 4})
+        self.assertGreater(version, self.version)
+        self.assertFalse(Node.objects.filter(osm_id=removed).exists())
+        self.assertAlmostEqual(Node.objects.get(osm_id=moved).geom.x, 0.0011)
+        self.assertEqual(Edge.objects.filter(city=self.city).count(), 6)
+        self.assertNotIn(f"{Node._meta.db_table}_stage_{self.city.pk}", connection.introspection.table_names())
+
+    def test_shared_node_moves_to_the_published_city(self):
+        other = make_city('Otherville')
+        Node.objects.create(osm_id=200, city=other, geom=Point(0.01, 0.01, srid=4326))
+        node_rows, edge_rows = self.current_rows()
+
+        diff, _ = self.publish(node_rows + [(200, 0.01, 0.01)], edge_rows)
+
+        self.assertEqual(diff['nodes']['updated'], 1)
+        self.assertEqual(Node.objects.get(osm_id=200).city, self.city)
+
+    def test_failed_publish_drops_the_stage(self):
+        node_rows, edge_rows = self.current_rows()
+        stage_graph(self.city, node_rows[1:], edge_rows)
+        with mock.patch.object(City, 'bump_graph_version', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                publish_stage(self.city)
+
+        self.assertNotIn(f"{Node._meta.db_table}_stage_{self.city.pk}", connection.introspection.table_names())
+
+
+def random_graph(node_count=150, edge_count=450, seed=1):
+    """A random sparse directed graph, with some nodes left unreachable."""
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, node_count, edge_count)
+    targets = rng.integers(0, node_count, edge_count)
+    lengths = rng.uniform(1, 100, edge_count).round(1)
+    return CityGraph.from_edges(0, np.arange(node_count, dtype=np.int64), rng.uniform(0, 0.01, (node_count, 2)),
+                                sources, targets, lengths, np.arange(edge_count, dtype=np.int64))
+
+
+class ContractionHierarchyTests(SimpleTestCase):
+    def test_matches_dijkstra(self):
+        graph = random_graph()
+        hierarchy = ContractionHierarchy(graph, build_contraction_hierarchy(graph))
+        offsets, neighbors, lengths = graph.adjacency_lists()
+        rng = np.random.default_rng(2)
+
+        for source in rng.choice(graph.node_count, 20, replace=False).tolist():
+            reached, distances = graph.distances_from(source)
+            expected = dict(zip(reached.tolist(), distances.tolist()))
+            for target in range(graph.node_count):
+                length, path = hierarchy.shortest_path(source, target)
+                if target not in expected:
+                    self.assertEqual((length, path), (inf, []))
+                    continue
+                self.assertAlmostEqual(length, expected[target], places=6)
+                self.assertEqual((path[0], path[-1]), (source, target))
+                # The unpacked path uses original edges and adds up to the reported length
+                walked = sum(min(lengths[i] for i in range(offsets[a], offsets[a + 1]) if neighbors[i] == b)
+                             for a, b in zip(path, path[1:]))
+                self.assertAlmostEqual(walked, length, places=6)
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def walk(self, url, direction='next'):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = [row['id'] for row in response.data['results']]
+            ids = ids + page if direction == 'next' else page + ids
+            url = response.data[direction]
+        return ids
+
+    def test_metric_values_with_shared_datetimes(self):
+        cities = [make_city('Testville'), make_city('Otherville')]
+        metrics = [Metric.objects.create(name=f'T{i}', type='walk') for i in range(10)]
+        now = timezone.now()
+        MetricValue.objects.bulk_create([
+            MetricValue(metric=metric, city=city, datetime=now - timedelta(days=day), value=1.0)
+            for metric in metrics for city in cities for day in range(2)
+        ])
+        expected = list(MetricValue.objects.order_by('-datetime', '-id').values_list('id', flat=True))
+
+        forward = self.walk('/api/metric-values/?page_size=7')
+        self.assertEqual(forward, expected)
+
+        last_page = '/api/metric-values/?page_size=7'
+        while (next_url := self.client.get(last_page).data['next']):
+            last_page = next_url
+        self.assertEqual(self.walk(last_page, 'previous'), expected)
+
+    def test_edges_page_by_primary_key(self):
+        city = make_city()
+        make_grid(city, size=3)
+        expected = list(Edge.objects.order_by('pk').values_list('pk', flat=True))
+
+        self.assertEqual(self.walk(f'/api/edges/?city={city.pk}&page_size=5'), expected)
+        response = self.client.get(f'/api/edges/?city={city.pk}&page_size=100000')
+        self.assertEqual(len(response.data['results']), len(expected))
+
+    def test_malformed_keyset_cursor_is_not_found(self):
+        self.assertEqual(self.client.get('/api/metric-values/?cursor=cD1ub3Rqc29u').status_code, 404)
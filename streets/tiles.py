@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Node, Edge
+
+# Bump when the tile SQL changes so cached tiles are not reused across formats
+TILE_FORMAT = 1
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+MAX_ZOOM = 22
+# Nodes are only drawn once the map is zoomed in far enough to tell them apart
+NODE_MIN_ZOOM = 15
+# Below this zoom a tile covers a whole city, so the spatial filter is skipped
+SPATIAL_FILTER_MIN_ZOOM = 8
+
+TILE_SQL = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom,
+               ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), 4326) AS lonlat
+    ),
+    edges AS (
+        SELECT e.id, e.start_node_id AS start_node, e.end_node_id AS end_node,
+               ST_AsMVTGeom(ST_Transform(e.geom::geometry, 3857), bounds.geom, %(extent)s, %(buffer)s) AS geom
+        FROM {edge_table} e, bounds
+        WHERE e.city_id = %(city_id)s AND {edge_filter}
+    ),
+    nodes AS (
+        SELECT n.osm_id,
+               ST_AsMVTGeom(ST_Transform(n.geom::geometry, 3857), bounds.geom, %(extent)s, %(buffer)s) AS geom
+        FROM {node_table} n, bounds
+        WHERE n.city_id = %(city_id)s AND %(z)s >= %(node_min_zoom)s AND {node_filter}
+    )
+    SELECT COALESCE((SELECT ST_AsMVT(edges, 'edges', %(extent)s, 'geom') FROM edges WHERE geom IS NOT NULL), '')
+        || COALESCE((SELECT ST_AsMVT(nodes, 'nodes', %(extent)s, 'geom') FROM nodes WHERE geom IS NOT NULL), '')
+"""
+
+
+def valid_tile(z: int, x: int, y: int):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def render_tile(city_id, z: int, x: int, y: int):
+    """A Mapbox vector tile with an ``edges`` and a ``nodes`` layer for one city."""
+    if z >= SPATIAL_FILTER_MIN_ZOOM:
+        # The geography && uses the spatial index on geom
+        edge_filter = "e.geom && bounds.lonlat::geography"
+        node_filter = "n.geom && bounds.lonlat::geography"
+    else:
+        edge_filter = node_filter = "TRUE"
+    sql = TILE_SQL.format(edge_table=Edge._meta.db_table, node_table=Node._meta.db_table,
+                          edge_filter=edge_filter, node_filter=node_filter)
+    params = {'z': z, 'x': x, 'y': y, 'city_id': city_id, 'extent': TILE_EXTENT, 'buffer': TILE_BUFFER,
+              'node_min_zoom': NODE_MIN_ZOOM}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return bytes(cursor.fetchone()[0])
+
+
+def tile_cache_root(city_id):
+    return Path(settings.TILE_CACHE_DIR) / f"city_{city_id}"
+
+
+def tile_path(city_id, graph_version: int, z: int, x: int, y: int):
+    """
+    Where a tile is cached: the file name is a hash of everything the tile is
+    rendered from, under a directory per graph version of the city.
+    """
+    key = hashlib.sha256(f"{TILE_FORMAT}/{city_id}/{graph_version}/{z}/{x}/{y}".encode()).hexdigest()
+    return tile_cache_root(city_id) / f"v{graph_version}" / key[:2] / f"{key}.mvt"
+
+
+def _remove_old_versions(city_id, graph_version: int):
+    for old in tile_cache_root(city_id).glob("v*"):
+        try:
+            stale = int(old.name[1:]) < graph_version
+        except ValueError:
+            continue
+        if stale:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def get_tile(city, z: int, x: int, y: int):
+    """
+    The vector tile of a city, from the on-disk cache when it was already
+    rendered for the city's current graph version. A graph change bumps the
+    version, so stale tiles are never served; their directories are removed
+    the first time a tile of a newer version is cached.
+    """
+    path = tile_path(city.pk, city.graph_version, z, x, y)
+    try:
+        return path.read_bytes()
+    except OSError:
+        pass
+
+    tile = render_tile(city.pk, z, x, y)
+
+    new_version = not path.parent.parent.exists()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-", suffix=".mvt")
+    with os.fdopen(fd, "wb") as f:
+        f.write(tile)
+    os.replace(tmp, path)
+    if new_version:
+        _remove_old_versions(city.pk, city.graph_version)
+    return tile
@@ -1,6 +1,12 @@
 import ast
 import json
+import subprocess
+import sys
+import time
+import traceback
+from functools import partial
 import osmnx as ox
+from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.contrib.gis.geos import LineString
 from .models import City, Node, Edge, MetricValue, Metric
@@ -9,6 +15,47 @@ from django.utils import timezone
 import numpy as np
 import networkx as nx
 from django.core.exceptions import ObjectDoesNotExist
+from .parallel import run_city_jobs
+from .aggregates import calculate_urban_metrics_incremental
+from .registry import METRICS, calculate_urban_metrics_registry
+from .metrics import (
+    calculate_urban_metrics_vectorized, calculate_urban_metrics_sql,
+    get_built_up_area_km2, node_elevation, edge_data, count_edges_by_mode,
+)
+
+
+highway_type_mapping = {
+    'motorway': 'highway',
+    'motorway_link': 'highway',
+    'trunk': 'highway',
+    'trunk_link': 'highway',
+    'primary': 'urban',
+    'primary_link': 'urban',
+    'secondary': 'urban',
+    'secondary_link': 'urban',
+    'tertiary': 'urban',
+    'unclassified': 'rural',
+    'residential': 'rural',
+    'living_street': 'rural',
+    'service': 'alley',
+    'track': 'alley',
+    'path': 'alley',
+}
+
+valid_modes = {
+    "drive": "driving",
+    "walk": "pedestrian",
+    "bike": "cycling",
+    "public_transport": "public_transport"
+}
+
+
+def map_highway_type(highway_types):
+    for ht in highway_types:
+        mapped_type = highway_type_mapping.get(ht, 'unknown')
+        if mapped_type != 'unknown':
+            return mapped_type
+    return None
 
 
 def fetch_data(city_name: str, country: str, modality: str = "drive"):
@@ -18,7 +65,7 @@ def fetch_data(city_name: str, country: str, modality: str = "drive"):
     graph = ox.graph_from_place(place_name, network_type=modality)
     graph = ox.project_graph(graph, to_crs="EPSG:4326")
 
-    edges_gdf = ox.graph_to_gdfs(graph, nodes=False, edges=True).iloc[90:100]
+    edges_gdf = ox.graph_to_gdfs(graph, nodes=False, edges=True)
     nodes_ids = set()
     for (u, v, _) in edges_gdf.index:
         nodes_ids.add(u)
@@ -46,28 +93,11 @@ def save_nodes(city_name: str, nodes_gdf):
             }
         )
 
+    City.bump_graph_version(city.id)
     print(f"Saved {len(nodes_geojson['features'])} nodes to the database.")
 
 
 def save_edges(city_name: str, edges_gdf, modality: str = "drive"):
-    highway_type_mapping = {
-        'motorway': 'highway',
-        'motorway_link': 'highway',
-        'trunk': 'highway',
-        'trunk_link': 'highway',
-        'primary': 'urban',
-        'primary_link': 'urban',
-        'secondary': 'urban',
-        'secondary_link': 'urban',
-        'tertiary': 'urban',
-        'unclassified': 'rural',
-        'residential': 'rural',
-        'living_street': 'rural',
-        'service': 'alley',
-        'track': 'alley',
-        'path': 'alley',
-    }
-
     edges_geojson = json.loads(edges_gdf.to_json())
     city = City.objects.get(name=city_name)
 
@@ -98,22 +128,10 @@ def save_edges(city_name: str, edges_gdf, modality: str = "drive"):
         else:
             highway_type = {highway_type}
 
-        edge_type = None
-        for ht in highway_type:
-            mapped_type = highway_type_mapping.get(ht, 'unknown')
-            if mapped_type != 'unknown':
-                edge_type = mapped_type
-                break
-
+        edge_type = map_highway_type(highway_type)
         if edge_type is None:
             continue
 
-        valid_modes = {
-            "drive": "driving",
-            "walk": "pedestrian",
-            "bike": "cycling",
-            "public_transport": "public_transport"
-        }
         mode = valid_modes.get(modality, None)
 
         geom = LineString([tuple(coord) for coord in coords])
@@ -135,6 +153,7 @@ def save_edges(city_name: str, edges_gdf, modality: str = "drive"):
             }
         )
 
+    City.bump_graph_version(city.id)
     print(f"Saved {len(edges_geojson['features'])} edges to the database.")
 
 
@@ -166,7 +185,6 @@ def save_graphml_nodes(city_name: str, graphml_path: str, ):
             osm_id=osm_id,
             city=city,
             defaults={
-                'elevation': float(data.get('elevation', 0.0)),
                 'geom': Point(x, y),
             }
 
@@ -175,6 +193,7 @@ def save_graphml_nodes(city_name: str, graphml_path: str, ):
         if created:
             created_count += 1
 
+    City.bump_graph_version(city.id)
     print(f"Nodes imported or updated: {created_count}, skipped: {skipped_count}")
 
 
@@ -222,6 +241,7 @@ def save_graphml_edges(city_name: str, graphml_path: str):
         if created:
             created_count += 1
 
+    City.bump_graph_version(city.id)
     print(f"Edges imported: {created_count}, skipped: {skipped_count}")
 
 
@@ -296,7 +316,43 @@ def parse_float(value):
     return 0.0
 
 
-def save_metric_values(city_name: str):
+def get_metrics_engine(engine: str, metrics=None):
+    """
+    The function computing the metrics of a city by name with ``engine``.
+    With ``metrics`` (a list of codes such as ``['CIR', 'ORE']``) only those are
+    returned; the registry engine also computes only those. The other engines
+    compute the default metrics only, so asking them for another is an error.
+    """
+    engines = {
+        'numpy': calculate_urban_metrics_vectorized,
+        'sql': calculate_urban_metrics_sql,
+        'incremental': calculate_urban_metrics_incremental,
+        'registry': calculate_urban_metrics_registry,
+        'legacy': calculate_urban_metrics,
+    }
+    try:
+        compute = engines[engine]
+    except KeyError:
+        raise ValueError(f"Unknown metrics engine '{engine}'. Choose from: {', '.join(engines)}")
+    if not metrics:
+        return compute
+
+    unknown = [code for code in metrics if code not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}. Choose from: {', '.join(METRICS)}")
+    if engine == 'registry':
+        return partial(calculate_urban_metrics_registry, codes=metrics)
+    unsupported = [code for code in metrics if not METRICS[code]['default']]
+    if unsupported:
+        raise ValueError(f"The {engine} engine does not compute {', '.join(unsupported)}; use the registry engine.")
+
+    def compute_selected(city_name: str):
+        values = compute(city_name)
+        return {key: value for key, value in values.items() if key.split('_', 1)[0] in metrics}
+    return compute_selected
+
+
+def save_metric_values(city_name: str, engine: str = 'numpy'):
     try:
         city = City.objects.get(name=city_name)
     except City.DoesNotExist:
@@ -305,7 +361,7 @@ def save_metric_values(city_name: str):
 
     now = timezone.now()
 
-    metrics_result = calculate_urban_metrics(city_name)
+    metrics_result = get_metrics_engine(engine)(city_name)
 
     for metric_key, value in metrics_result.items():
         try:
@@ -330,6 +386,81 @@ def save_metric_values(city_name: str):
     print(f"Metric values for {city_name} have been successfully saved.")
 
 
+def _compute_city_metrics(city_name: str, engine: str, metrics=None):
+    start = time.perf_counter()
+    try:
+        values = get_metrics_engine(engine, metrics)(city_name)
+    except Exception:
+        return {'city': city_name, 'ok': False, 'error': traceback.format_exc(),
+                'seconds': time.perf_counter() - start}
+    return {'city': city_name, 'ok': True, 'values': values, 'seconds': time.perf_counter() - start}
+
+
+def recompute_metric_values(city_names=None, workers: int = None, engine: str = 'numpy', metrics=None):
+    """
+    Recompute and save the metrics of several cities (default: all) with one
+    worker process per city at a time. All values share one timestamp and are
+    written with a single batched upsert into MetricValue. Returns a per-city
+    report with timings, plus the wall time. ``metrics`` restricts the
+    computation to some metric codes.
+    """
+    get_metrics_engine(engine, metrics)
+    cities = City.objects.all()
+    if city_names:
+        cities = cities.filter(name__in=city_names)
+    city_ids = dict(cities.values_list('name', 'id'))
+    missing = sorted(set(city_names or []) - set(city_ids))
+
+    metric_rows = {(m.name, m.type): m for m in Metric.objects.all()}
+    now = timezone.now()
+    report = [{'city': name, 'ok': False, 'error': f"City {name} not found.", 'seconds': 0.0} for name in missing]
+    metric_values = []
+
+    wall_start = time.perf_counter()
+    jobs = [(name, engine, metrics) for name in city_ids]
+    for (city_name, *_), result in run_city_jobs(_compute_city_metrics, jobs, workers):
+        result.setdefault('city', city_name)
+        values = result.pop('values', {})
+        result['saved'] = 0
+        for metric_key, value in values.items():
+            metric = metric_rows.get(tuple(metric_key.split('_', 1)))
+            if metric is None:
+                print(f"Metric {metric_key} not found. Skipping.")
+                continue
+            metric_values.append(MetricValue(city_id=city_ids[city_name], metric=metric, datetime=now, value=value))
+            result['saved'] += 1
+        report.append(result)
+
+    MetricValue.objects.bulk_create(
+        metric_values,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['metric', 'city', 'datetime'],
+        update_fields=['value'],
+    )
+    wall_time = time.perf_counter() - wall_start
+
+    return sorted(report, key=lambda r: r['city']), wall_time
+
+
+def start_metrics_recompute(city_names=None, workers: int = None, engine: str = 'numpy', metrics=None):
+    """
+    Start ``manage.py compute_metrics`` in its own process and return it
+    without waiting. Its process pool and database connections stay out of
+    the caller's process; ``workers`` is capped at RECOMPUTE_API_MAX_WORKERS.
+    Raises ValueError for an unknown engine or metric before starting.
+    """
+    get_metrics_engine(engine, metrics)
+    workers = max(1, min(workers or settings.RECOMPUTE_API_MAX_WORKERS, settings.RECOMPUTE_API_MAX_WORKERS))
+    command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'compute_metrics',
+               '--workers', str(workers), '--engine', engine]
+    if metrics:
+        command += ['--metrics', *metrics]
+    # City names go after '--' so that none is read as an option
+    command += ['--', *(city_names or [])]
+    return subprocess.Popen(command, start_new_session=True)
+
+
 def calculate_urban_metrics(city_name: str):
     city = City.objects.get(name=city_name)
 
@@ -353,14 +484,16 @@ def calculate_urban_metrics(city_name: str):
         street_angles.append(angle)
     angle_counts = [0] * 36
     for angle in street_angles:
-        angle_index = int(angle // 10)
+        # (bearing + 360) % 360 can round to exactly 360.0
+        angle_index = min(int(angle // 10), 35)
         angle_counts[angle_index] += 1
     total_angles = len(street_angles)
     entropy = -sum((count / total_angles) * log(count / total_angles) for count in angle_counts if count > 0)
 
     # 3. Road Density
     total_street_segments = Edge.objects.filter(city=city).count()
-    road_density = total_street_segments / city.built_up_area_km2 if city.built_up_area_km2 > 0 else 0
+    built_up_area_km2 = get_built_up_area_km2(city)
+    road_density = total_street_segments / built_up_area_km2 if built_up_area_km2 > 0 else 0
 
     # 4. Average Steepness
     total_steepness = 0
@@ -368,8 +501,9 @@ def calculate_urban_metrics(city_name: str):
     for edge in Edge.objects.filter(city=city).select_related('start_node', 'end_node'):
         node1, node2 = edge.start_node, edge.end_node
         if node1 and node2:
+            elevation1, elevation2 = node_elevation(node1), node_elevation(node2)
             elevation_difference = abs(
-                node1.elevation - node2.elevation) if node1.elevation is not None and node2.elevation is not None else 0
+                elevation1 - elevation2) if elevation1 is not None and elevation2 is not None else 0
             horizontal_distance = edge.geom.length  # 直接使用 geom 的长度作为水平距离
             if horizontal_distance > 0:
                 steepness = elevation_difference / horizontal_distance
@@ -385,29 +519,30 @@ def calculate_urban_metrics(city_name: str):
 
     # 6. Intersection Density
     all_nodes = Node.objects.filter(city=city)
-    node_edge_counts = {node.id: 0 for node in all_nodes}
+    node_edge_counts = {node.pk: 0 for node in all_nodes}
     for edge in Edge.objects.filter(city=city).select_related('start_node', 'end_node'):
         if edge.start_node_id in node_edge_counts:
             node_edge_counts[edge.start_node_id] += 1
         if edge.end_node_id in node_edge_counts:
             node_edge_counts[edge.end_node_id] += 1
     intersection_count = sum(1 for count in node_edge_counts.values() if count >= 3)
-    intersection_density = intersection_count / city.built_up_area_km2 if city.built_up_area_km2 > 0 else 0
+    intersection_density = intersection_count / built_up_area_km2 if built_up_area_km2 > 0 else 0
 
     # 7. Walking/Driving Segments Ratio
-    walking_edges = Edge.objects.filter(city=city, data__mode='pedestrian').count()
-    driving_edges = Edge.objects.filter(city=city, data__mode='driving').count()
+    walking_edges = count_edges_by_mode(city, 'pedestrian')
+    driving_edges = count_edges_by_mode(city, 'driving')
     walking_driving_ratio = walking_edges / driving_edges if driving_edges > 0 else 0
 
     # 8. Biking/Driving Segments Ratio
-    biking_edges = Edge.objects.filter(city=city, data__mode='cycling').count()
+    biking_edges = count_edges_by_mode(city, 'cycling')
     biking_driving_ratio = biking_edges / driving_edges if driving_edges > 0 else 0
 
     # 9. Average Biking Score
     total_biking_score = 0
     count_biking = 0
     for edge in Edge.objects.filter(city=city):
-        biking_score = calculate_biking_score(edge.data.get('speed_limit', 0), edge.data.get('mode') == 'cycling')
+        data = edge_data(edge)
+        biking_score = calculate_biking_score(data.get('speed_limit', 0), data.get('mode') == 'cycling')
         total_biking_score += biking_score
         count_biking += 1
     average_biking_score = total_biking_score / count_biking if count_biking > 0 else 0
@@ -416,13 +551,14 @@ def calculate_urban_metrics(city_name: str):
     total_walking_score = 0
     count_walking = 0
     for edge in Edge.objects.filter(city=city):
-        walking_score = calculate_walking_score(edge.data.get('speed_limit', 0), edge.data.get('mode') == 'pedestrian')
+        data = edge_data(edge)
+        walking_score = calculate_walking_score(data.get('speed_limit', 0), data.get('mode') == 'pedestrian')
         total_walking_score += walking_score
         count_walking += 1
     average_walking_score = total_walking_score / count_walking if count_walking > 0 else 0
 
     # 11. Connectivity
-    node_edge_counts = {node.id: 0 for node in all_nodes}  # Reinitialize node_edge_counts
+    node_edge_counts = {node.pk: 0 for node in all_nodes}  # Reinitialize node_edge_counts
     for edge in Edge.objects.filter(city=city).select_related('start_node', 'end_node'):
         node_edge_counts[edge.start_node_id] += 1
         node_edge_counts[edge.end_node_id] += 1
@@ -1,4 +1,5 @@
 import numpy as np
+import shapely
 from django.shortcuts import render
 from rest_framework import generics
 import json
@@ -6,7 +7,7 @@ from .models import City, MetricValue, Metric, Node, Edge
 from .serializers import MetricValueSerializer, MetricSerializer, CitySerializer, MetricValueCreateUpdateSerializer, \
     NodeSerializer, EdgeSerializer, NodeGeoJSONSerializer, EdgeGeoJSONSerializer
 from rest_framework import viewsets
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponse, Http404
 from django.db.models import Q
 from django.contrib.gis.geos import Polygon
 from rest_framework.generics import ListAPIView
@@ -23,6 +24,49 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import filters
+from .utils import start_metrics_recompute
+from .aggregates import track_graph_change, graph_changes
+from .isochrones import isochrones
+from .routing import route
+from .graph import get_city_graph
+from .orientation import city_orientation
+from .geojson import parse_bbox, stream_nodes, stream_edges
+from .tiles import get_tile, valid_tile
+from .pagination import PrimaryKeyCursorPagination, MetricValueCursorPagination
+from .conditional import graph_conditional_response
+
+
+class GraphVersionMixin:
+    """
+    Bump the city's graph version and update its metric aggregates whenever
+    nodes or edges are written through the API. ``node_fields`` name the
+    fields holding the nodes a record touches.
+    """
+    node_fields = ()
+
+    def perform_create(self, serializer):
+        records = serializer.validated_data
+        records = records if isinstance(records, list) else [records]
+        with track_graph_change(graph_changes(records, self.node_fields)):
+            serializer.save()
+
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        updated = {name: serializer.validated_data.get(name, getattr(instance, name))
+                   for name in ('city', *self.node_fields)}
+        with track_graph_change(graph_changes([instance, updated], self.node_fields)):
+            serializer.save()
+
+    def perform_destroy(self, instance):
+        with track_graph_change(graph_changes([instance], self.node_fields)):
+            instance.delete()
+
+    def list(self, request, *args, **kwargs):
+        # Lists only change with the graph, so conditional requests are answered from the City rows
+        city_id = request.query_params.get('city', None)
+        cities = City.objects.filter(pk=city_id) if city_id and city_id.isdigit() else City.objects.all()
+        return graph_conditional_response(
+            request, cities, self.basename, lambda: super(GraphVersionMixin, self).list(request, *args, **kwargs))
 
 
 def db_map_view(request):
@@ -35,6 +79,7 @@ def city_metrics_page(request):
 
 class MetricValueViewSet(viewsets.ModelViewSet):
     queryset = MetricValue.objects.all()
+    pagination_class = MetricValueCursorPagination
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
@@ -71,6 +116,30 @@ class MetricValueViewSet(viewsets.ModelViewSet):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'], url_path='recompute')
+    def recompute(self, request):
+        cities = request.data.get('cities') or None
+        engine = request.data.get('engine', 'numpy')
+        workers = request.data.get('workers')
+        metrics = request.data.get('metrics') or None
+
+        if cities is not None and not isinstance(cities, list):
+            return Response({"error": "'cities' must be a list of city names."}, status=status.HTTP_400_BAD_REQUEST)
+        if metrics is not None and not isinstance(metrics, list):
+            return Response({"error": "'metrics' must be a list of metric codes."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            workers = int(workers) if workers is not None else None
+            # The process pool runs in its own process, away from this request's connection
+            process = start_metrics_recompute(cities, workers=workers, engine=engine, metrics=metrics)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            "status": "started",
+            "pid": process.pid,
+            "cities": cities or "all",
+        }, status=status.HTTP_202_ACCEPTED)
+
 
 class MetricViewSet(viewsets.ModelViewSet):
     queryset = Metric.objects.all()
@@ -104,12 +173,14 @@ class CityViewSet(viewsets.ModelViewSet):
                 return Response({"error": f"City '{city_name}' not found."}, status=status.HTTP_404_NOT_FOUND)
 
             deleted_count, _ = Node.objects.filter(city=city).delete()
+            City.bump_graph_version(city.id)
             return Response({
                 "message": f"Deleted {deleted_count} node(s) (and associated edges) for city '{city_name}'."
             }, status=status.HTTP_200_OK)
 
         else:
             deleted_count, _ = Node.objects.all().delete()
+            City.bump_graph_version(*City.objects.values_list('id', flat=True))
             return Response({
                 "message": f"Deleted {deleted_count} node(s) (and associated edges) from the entire database."
             }, status=status.HTTP_200_OK)
@@ -144,9 +215,11 @@ class CityViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class NodeViewSet(viewsets.ModelViewSet):
+class NodeViewSet(GraphVersionMixin, viewsets.ModelViewSet):
     queryset = Node.objects.all()
     serializer_class = NodeSerializer
+    pagination_class = PrimaryKeyCursorPagination
+    node_fields = ('osm_id',)
 
     def get_queryset(self):
         city_id = self.request.query_params.get('city', None)
@@ -161,14 +234,16 @@ class NodeViewSet(viewsets.ModelViewSet):
     def bulk_create(self, request):
         serializer = self.get_serializer(data=request.data, many=True)
         if serializer.is_valid():
-            serializer.save()
+            self.perform_create(serializer)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class EdgeViewSet(viewsets.ModelViewSet):
+class EdgeViewSet(GraphVersionMixin, viewsets.ModelViewSet):
     queryset = Edge.objects.all()
     serializer_class = EdgeSerializer
+    pagination_class = PrimaryKeyCursorPagination
+    node_fields = ('start_node', 'end_node')
 
     def get_queryset(self):
         city_id = self.request.query_params.get('city', None)
@@ -183,46 +258,182 @@ class EdgeViewSet(viewsets.ModelViewSet):
     def bulk_create(self, request):
         serializer = self.get_serializer(data=request.data, many=True)
         if serializer.is_valid():
-            serializer.save()
+            self.perform_create(serializer)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class NodeGeoJSONView(generics.ListAPIView):
-    serializer_class = NodeGeoJSONSerializer
-
-    def get_queryset(self):
-        queryset = Node.objects.all()
-
-        city_name = self.request.query_params.get('city', None)
-        if city_name:
-            city = get_object_or_404(City, name=city_name)
-            queryset = queryset.filter(city=city)
-
-        bbox = self.request.query_params.get('bbox', None)
-        if bbox:
-            lng1, lat1, lng2, lat2 = map(float, bbox.split(','))
-            polygon = Polygon.from_bbox((lng1, lat1, lng2, lat2))
-            queryset = queryset.filter(geom__within=polygon)
-
-        return queryset
-
-
-class EdgeGeoJSONView(generics.ListAPIView):
-    serializer_class = EdgeGeoJSONSerializer
-
-    def get_queryset(self):
-        queryset = Edge.objects.all()
-        city_name = self.request.query_params.get('city', None)
-        if city_name:
-            city = get_object_or_404(City, name=city_name)
-            queryset = queryset.filter(city=city)
-
-        bbox = self.request.query_params.get('bbox', None)
-        if bbox:
-            lng1, lat1, lng2, lat2 = map(float, bbox.split(','))
-            polygon = Polygon.from_bbox((lng1, lat1, lng2, lat2))
-            queryset = queryset.filter(geom__within=polygon)
-
-        return queryset
-
+class NodeGeoJSONView(APIView):
+    """
+    GET /geojson/nodes/?city=Milan&bbox=lng1,lat1,lng2,lat2
+
+    Nodes as a GeoJSON FeatureCollection, streamed straight from PostGIS.
+    """
+
+    def get(self, request):
+        return geojson_response(request, 'nodes-geojson', stream_nodes)
+
+
+class EdgeGeoJSONView(APIView):
+    """
+    GET /geojson/edges/?city=Milan&bbox=lng1,lat1,lng2,lat2&zoom=12
+
+    Edges as a GeoJSON FeatureCollection, streamed straight from PostGIS.
+    ``zoom`` returns them simplified for that map zoom, without the edges too
+    short to see; ``tolerance`` (degrees) only simplifies.
+    """
+
+    def get(self, request):
+        params = request.query_params
+        try:
+            zoom = int(params['zoom']) if params.get('zoom') else None
+            tolerance = float(params['tolerance']) if params.get('tolerance') else None
+            if zoom is not None and tolerance is not None:
+                raise ValueError("Give either 'zoom' or 'tolerance', not both.")
+            if (zoom is not None and zoom < 0) or (tolerance is not None and tolerance < 0):
+                raise ValueError("'zoom' and 'tolerance' must not be negative.")
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return geojson_response(
+            request, 'edges-geojson', lambda city, bbox: stream_edges(city, bbox, zoom=zoom, tolerance=tolerance))
+
+
+def geojson_response(request, kind, stream):
+    city_name = request.query_params.get('city', None)
+    try:
+        bbox = parse_bbox(request.query_params['bbox']) if request.query_params.get('bbox') else None
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # An unknown city is a 404 whatever the preconditions say
+    city = get_object_or_404(City, name=city_name) if city_name else None
+    cities = City.objects.filter(pk=city.pk) if city else City.objects.all()
+    return graph_conditional_response(
+        request, cities, kind,
+        lambda: StreamingHttpResponse(stream(city, bbox), content_type='application/json'))
+
+
+def tile_view(request, city, z, x, y):
+    """
+    GET /tiles/<city>/<z>/<x>/<y>.mvt
+
+    A Mapbox vector tile of a city's network with ``edges`` and ``nodes`` layers.
+    """
+    if not valid_tile(z, x, y):
+        raise Http404("Tile out of range.")
+    city = get_object_or_404(City, name=city)
+    return HttpResponse(get_tile(city, z, x, y), content_type='application/vnd.mapbox-vector-tile')
+
+
+class IsochroneView(APIView):
+    """
+    GET /api/isochrones/?city=Milan&lon=9.19&lat=45.46&budgets=5,10,15&unit=minutes&mode=walk
+
+    Isochrone polygons and reachable-node counts around a point, one feature per budget.
+    """
+
+    def get(self, request):
+        city = get_object_or_404(City, name=request.query_params.get('city'))
+        try:
+            lon = float(request.query_params['lon'])
+            lat = float(request.query_params['lat'])
+            budgets = [float(b) for b in request.query_params.get('budgets', '5,10,15').split(',') if b]
+            result = isochrones(
+                city, lon, lat, budgets,
+                unit=request.query_params.get('unit', 'minutes'),
+                mode=request.query_params.get('mode', 'walk'),
+            )
+        except KeyError as e:
+            return Response({"error": f"Missing parameter {e}."}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+
+class RouteView(APIView):
+    """
+    GET /api/route/?city=Milan&from=9.18,45.46&to=9.20,45.48
+
+    The shortest route between two points as a GeoJSON LineString Feature with its length in meters.
+    """
+
+    def get(self, request):
+        city = get_object_or_404(City, name=request.query_params.get('city'))
+        try:
+            from_lonlat = tuple(map(float, request.query_params['from'].split(',')))
+            to_lonlat = tuple(map(float, request.query_params['to'].split(',')))
+            if len(from_lonlat) != 2 or len(to_lonlat) != 2:
+                raise ValueError("'from' and 'to' must be given as lon,lat.")
+        except KeyError as e:
+            return Response({"error": f"Missing parameter {e}."}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            feature = route(city, from_lonlat, to_lonlat)
+        except LookupError as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if feature is None:
+            return Response({"error": "No route between these points."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(feature)
+
+
+class SnapView(APIView):
+    """
+    POST /api/snap/ {"city": "Milan", "points": [[9.19, 45.46], ...], "max_distance": 200}
+
+    Snap many points to their nearest network node in one call. Points farther
+    than the optional ``max_distance`` (meters) from any node get ``null``.
+    """
+
+    def post(self, request):
+        city = get_object_or_404(City, name=request.data.get('city'))
+        max_distance = request.data.get('max_distance')
+        try:
+            points = np.asarray(request.data.get('points', []), dtype=np.float64)
+            if points.size and (points.ndim != 2 or points.shape[1] != 2):
+                raise ValueError("'points' must be a list of [lon, lat] pairs.")
+            max_distance = float(max_distance) if max_distance is not None else None
+            graph = get_city_graph(city)
+            nodes, distances = graph.nearest_nodes(points)
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        snapped = [
+            {
+                'node': int(graph.node_ids[node]),
+                'coordinates': graph.coords[node].tolist(),
+                'distance': float(distance),
+            } if max_distance is None or distance <= max_distance else None
+            for node, distance in zip(nodes.tolist(), distances.tolist())
+        ]
+        return Response({'city': city.name, 'points': snapped})
+
+
+class OrientationView(APIView):
+    """
+    GET /api/orientation/?city=Milan&bins=36&undirected=true&weighted=true&bbox=lng1,lat1,lng2,lat2
+
+    Street orientation histogram and entropy of a city, for polar plots. ``polygon``
+    (a GeoJSON geometry) restricts it to a district, ``bbox`` to a rectangle.
+    """
+
+    def get(self, request):
+        city = get_object_or_404(City, name=request.query_params.get('city'))
+        params = request.query_params
+        try:
+            bbox = tuple(map(float, params['bbox'].split(','))) if params.get('bbox') else None
+            if bbox is not None and len(bbox) != 4:
+                raise ValueError("'bbox' must be lng1,lat1,lng2,lat2.")
+            polygon = shapely.from_geojson(params['polygon']) if params.get('polygon') else None
+            result = city_orientation(
+                city,
+                bins=int(params.get('bins', 36)),
+                undirected=params.get('undirected', 'false').lower() in ('1', 'true', 'yes'),
+                weighted=params.get('weighted', 'false').lower() in ('1', 'true', 'yes'),
+                bbox=bbox,
+                polygon=polygon,
+            )
+        except (ValueError, shapely.errors.GEOSException) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)